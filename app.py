@@ -1,22 +1,79 @@
 import os
+import click
+from functools import cached_property
 from dotenv import load_dotenv
 
 from flask import (Flask, render_template, request, flash, redirect, session,
-    g, jsonify)
+    g, jsonify, abort)
+from flask.ctx import _AppCtxGlobals
 from flask_wtf.csrf import CSRFProtect
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from forms import (UserAddForm, EditProfileForm, LoginForm,
     MessageForm, CSRFProtectForm)
-from models import (db, connect_db, User, Message, Like, DEFAULT_IMAGE_URL,
-    DEFAULT_HEADER_IMAGE_URL)
+from models import (db, connect_db, User, Message, Like,
+    DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
+from timeline import (get_timeline, fan_out_message, add_followed_messages,
+    remove_followed_messages, refresh_fanout_mode, backfill_timelines,
+    trim_timelines)
+from counters import (record_message, record_follow, before_message_deleted,
+    before_user_deleted, reconcile_counters)
+from pagination import (get_cursor_arg, paginate, split_page,
+    MESSAGES_PER_PAGE)
+from search import (search_users, list_users_page, typeahead, search_cache,
+                    TYPEAHEAD_LIMIT)
+from current_user import (load_current_user, forget_current_user,
+                          current_user_cache, CurrentUserGone)
+from passwords import PasswordPoolBusy, get_password_pool
+from fragments import fragment_cache, render_message_item
+from instrumentation import begin_request, instrument_app, render_metrics
+from db_pool import engine_options, pool_stats, connection_budget
+from serialization import (MESSAGE_COLUMNS, message_data,
+                           serialize_messages, negotiate, encode)
+from replicas import (replica_reads, route_request, use_primary,
+                      init_replicas, DEFAULT_PIN_SECONDS)
+from query_analysis import (query_report, DEFAULT_SAMPLE_RATE,
+                            DEFAULT_SLOW_QUERY_MS, DEFAULT_N_PLUS_ONE_THRESHOLD)
+from follow_graph import follow_graph, add_follow, remove_follow
+from streams import (broker, publish_message, publish_message_deleted,
+                     publish_follow, DEFAULT_BUFFER_SIZE, DEFAULT_HEARTBEAT,
+                     DEFAULT_TIMEOUT)
+from likes import (apply_likes, toggle_like, get_liked_ids_among,
+                   get_likes_count, like_buffer, parse_likes_request,
+                   like_states)
+from http_caching import (apply_cache_policy, not_modified, static_url,
+    home_validators, get_profile_or_404, message_validators)
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
+
+class WarblerGlobals(_AppCtxGlobals):
+    """ Flask's `g`, plus forms most requests never touch: each is only
+    built the first time a view or template uses it. """
+
+    @cached_property
+    def csrf_form(self):
+        """ CSRF-only form for POST buttons (logout, follow, like, ...). """
+
+        return CSRFProtectForm()
+
+    @cached_property
+    def message_form(self):
+        """ Message form for navbar message sending. """
+
+        return MessageForm()
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
+app.add_template_global(render_message_item, 'message_item')
+app.add_template_global(static_url)
+app.after_request(apply_cache_policy)
 csrf = CSRFProtect(app)
 csrf.init_app(app)
 
@@ -26,38 +83,119 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
 app.config['SQLALCHEMY_ECHO'] = False
+# connection pool (see db_pool.py for the DB_* variables)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+# read replicas (see replicas.py): comma-separated URLs, and how long after
+# a write a browser keeps reading from the primary
+app.config['REPLICA_DATABASE_URIS'] = [
+    url.strip().replace("postgres://", "postgresql://")
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()]
+app.config['REPLICA_PIN_SECONDS'] = float(
+    os.environ.get('REPLICA_PIN_SECONDS', DEFAULT_PIN_SECONDS))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 
+# request threads per worker process (gunicorn --threads); sizes the
+# password pool (and the db-pool-budget default). Under uvicorn, asgi.py
+# defaults it to its WSGI thread pool's size instead.
+app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 1))
+# worker processes (gunicorn/uvicorn --workers default to WEB_CONCURRENCY)
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# password hashing (see passwords.py): bcrypt cost, and how many hashes may
+# run / wait at once per process (default: from WEB_THREADS)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+if 'PASSWORD_POOL_WORKERS' in os.environ:
+    app.config['PASSWORD_POOL_WORKERS'] = int(
+        os.environ['PASSWORD_POOL_WORKERS'])
+if 'PASSWORD_POOL_QUEUE_DEPTH' in os.environ:
+    app.config['PASSWORD_POOL_QUEUE_DEPTH'] = int(
+        os.environ['PASSWORD_POOL_QUEUE_DEPTH'])
+
+# write-behind likes (see likes.py): off unless LIKES_WRITE_BEHIND is set;
+# only with a single worker process (WEB_CONCURRENCY=1)
+app.config['LIKES_WRITE_BEHIND'] = (
+    os.environ.get('LIKES_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'))
+app.config['LIKES_FLUSH_INTERVAL'] = float(
+    os.environ.get('LIKES_FLUSH_INTERVAL', 1.0))
+app.config['LIKES_FLUSH_SIZE'] = int(os.environ.get('LIKES_FLUSH_SIZE', 500))
+
+# instrumentation (see instrumentation.py): a JSON log line per request, on
+# unless REQUEST_LOG=0; /metrics needs `Authorization: Bearer <token>` with
+# METRICS_TOKEN, and is off without one unless METRICS_PUBLIC=1 (or debug)
+app.config['REQUEST_LOG'] = os.environ.get('REQUEST_LOG', '1') != '0'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['METRICS_PUBLIC'] = os.environ.get('METRICS_PUBLIC') == '1'
+
+# N+1/slow query detection (see query_analysis.py) on a sample of requests
+app.config['QUERY_SAMPLE_RATE'] = float(
+    os.environ.get('QUERY_SAMPLE_RATE', DEFAULT_SAMPLE_RATE))
+app.config['SLOW_QUERY_MS'] = float(
+    os.environ.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS))
+app.config['N_PLUS_ONE_THRESHOLD'] = int(
+    os.environ.get('N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD))
+
+# API responses (see serialization.py): JSON_BACKEND=json to encode JSON
+# with the standard library rather than orjson
+app.config['JSON_BACKEND'] = os.environ.get('JSON_BACKEND', 'orjson')
+
+# live timeline updates (see streams.py): STREAM_TRANSPORT=local or postgres
+# to turn them on
+app.config['STREAM_TRANSPORT'] = os.environ.get('STREAM_TRANSPORT', '')
+app.config['STREAM_LISTEN_URL'] = (
+    os.environ.get('STREAM_LISTEN_URL', '').replace(
+        "postgres://", "postgresql://") or None)
+app.config['STREAM_BUFFER_SIZE'] = int(
+    os.environ.get('STREAM_BUFFER_SIZE', DEFAULT_BUFFER_SIZE))
+app.config['STREAM_HEARTBEAT'] = float(
+    os.environ.get('STREAM_HEARTBEAT', DEFAULT_HEARTBEAT))
+app.config['STREAM_TIMEOUT'] = float(
+    os.environ.get('STREAM_TIMEOUT', DEFAULT_TIMEOUT))
+
 # need this for now until we can debug the csrf issue...
 app.config['WTF_CSRF_ENABLED'] = False
 
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+instrument_app(app)
+init_replicas(app, db)
+
+if app.config['LIKES_WRITE_BEHIND']:
+    like_buffer.start(app)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+@app.before_request
+def reset_g():
+    """Start each request with an empty `g` (and its instrumentation and
+    choice of database).
+
+    connect_db leaves an app context pushed, and Flask reuses it for requests
+    on the same thread rather than pushing a fresh one, so otherwise `g`
+    (request-scoped lookups, forms) would carry over between requests.
+    """
+
+    g.__dict__.clear()
+    begin_request()
+    route_request()
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
-@app.before_request
-def create_csrf_only_form():
-    """ Adds CSFR only form for use in all routes. """
-    
-    g.csrf_form = CSRFProtectForm()
-
 # add in before_request that validates current user
 
 def do_login(user):
@@ -66,13 +204,6 @@ def do_login(user):
     session[CURR_USER_KEY] = user.id
 
 
-@app.before_request
-def create_message_form():
-    """ Adds a message form for navbar message sending. """
-
-    g.message_form = MessageForm()
-
-
 def do_logout():
     """Log out user."""
 
@@ -131,6 +262,7 @@ def login():
             form.password.data)
 
         if user:
+            db.session.commit() # saves a rehashed password, if any
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -157,31 +289,90 @@ def logout():
 
 
 
+##############################################################################
+# Request-scoped lookups for the current user
+
+
+def get_liked_ids(messages):
+    """Which of `messages` has the current user liked? Returns a set of ids.
+
+    Only looks at the messages passed in (not the user's whole like
+    history), and keeps answers on `g` for the rest of the request.
+    """
+
+    checked = g.setdefault('liked_ids_checked', set())
+    liked = g.setdefault('liked_ids', set())
+
+    unchecked = {msg.id for msg in messages} - checked
+
+    if unchecked:
+        liked |= get_liked_ids_among(g.user.id, unchecked)
+        checked |= unchecked
+
+    return liked
+
+
+def get_followed_ids(users):
+    """Which of `users` does the current user follow? Returns a set of ids.
+
+    Answers are kept on `g` for the rest of the request, so only users not
+    asked about yet cost anything: one query for the lot.
+    """
+
+    checked = g.setdefault('followed_ids_checked', set())
+    followed = g.setdefault('followed_ids', set())
+
+    unchecked = {user.id for user in users} - checked
+
+    if unchecked:
+        followed |= g.user.following_ids_among(unchecked)
+        checked |= unchecked
+
+    return followed
+
+
 ##############################################################################
 # General user routes:
 
+
+
 @app.get('/users')
+@replica_reads
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location (ranked, paged with 'page'). Without one, lists every user a
+    page at a time (paged with 'after', the last user id seen).
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    search = request.args.get('q')
+    search = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', type=int)
+    next_after = None
+    has_next = False
 
     if not search:
-        users = User.query.all()
+        users, next_after = list_users_page(after)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_next = search_users(search, page)
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=users,
+        search=search,
+        page=page,
+        has_next=has_next,
+        next_after=next_after,
+        followed_ids=get_followed_ids(users))
 
 
 @app.get('/users/<int:user_id>')
+@replica_reads
 def show_user(user_id):
     """Show user profile."""
 
@@ -189,13 +380,25 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    likes = [msg.id for msg in g.user.liked_messages]
+    user, validators = get_profile_or_404(user_id)
+
+    unchanged = not_modified(*validators)
+    if unchanged:
+        return unchanged
+
+    messages, next_cursor = get_user_messages_page(user, get_cursor_arg())
+    likes = get_liked_ids(messages)
 
-    return render_template('users/show.html', user=user, likes=likes)
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=messages,
+        next_cursor=next_cursor,
+        likes=likes)
 
 
 @app.get('/users/<int:user_id>/following')
+@replica_reads
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -204,10 +407,15 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+
+    return render_template(
+        'users/following.html',
+        user=user,
+        followed_ids=get_followed_ids(user.following))
 
 
 @app.get('/users/<int:user_id>/followers')
+@replica_reads
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -216,19 +424,36 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+
+    return render_template(
+        'users/followers.html',
+        user=user,
+        followed_ids=get_followed_ids(user.followers))
 
 
 @app.get('/users/<int:user_id>/liked_messages')
+@replica_reads
 def show_liked_messages(user_id):
-    """ Show all liked messages for the current user. """
+    """ Show liked messages for this user, most recently liked first. """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user = User.query.get_or_404(user_id)
+    messages, next_cursor = get_liked_messages_page(user, get_cursor_arg())
+
+    if user.id == g.user.id:
+        likes = {msg.id for msg in messages}
+    else:
+        likes = get_liked_ids(messages)
 
-    return render_template("users/liked_messages.html",  user=g.user)
+    return render_template(
+        "users/liked_messages.html",
+        user=user,
+        messages=messages,
+        next_cursor=next_cursor,
+        likes=likes)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -243,8 +468,13 @@ def start_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    if add_follow(g.user.id, followed_user.id):
+        record_follow(g.user.id, followed_user.id)
+        add_followed_messages(g.user.id, followed_user)
+        refresh_fanout_mode(followed_user)
+        publish_follow(g.user.id, followed_user.id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -260,9 +490,14 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.query.get_or_404(follow_id)
+
+    if remove_follow(g.user.id, followed_user.id):
+        record_follow(g.user.id, followed_user.id, -1)
+        remove_followed_messages(g.user.id, followed_user.id)
+        refresh_fanout_mode(followed_user)
+        publish_follow(g.user.id, followed_user.id, following=False)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -295,6 +530,8 @@ def edit_profile():
 
             db.session.add(user)
             db.session.commit()
+            forget_current_user(user.id)
+            fragment_cache.delete_owner(user.id)
 
             flash("Profile updated.", "success")
             return redirect(f"/users/{user.id}")
@@ -317,8 +554,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    before_user_deleted(g.user)
+    db.session.delete(g.user.model)
     db.session.commit()
+    forget_current_user(g.user.id)
+    fragment_cache.delete_owner(g.user.id)
 
     return redirect("/signup")
 
@@ -342,6 +582,11 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+
+        record_message(g.user.id)
+        fan_out_message(msg)
+        publish_message(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -350,6 +595,7 @@ def add_message():
 
 
 @app.get('/messages/<int:message_id>')
+@replica_reads
 def show_message(message_id):
     """Show a message."""
 
@@ -357,8 +603,15 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    likes = [msg.id for msg in g.user.liked_messages]
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+    likes = get_liked_ids([msg])
+
+    unchanged = not_modified(*message_validators(msg, likes))
+    if unchanged:
+        return unchanged
 
     return render_template('messages/show.html', msg=msg, likes=likes)
 
@@ -376,8 +629,14 @@ def delete_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
+
+    before_message_deleted(msg)
+    publish_message_deleted(msg)
+
+    # timeline entries go with it (ON DELETE CASCADE on timelines.message_id)
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.delete(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -388,18 +647,10 @@ def like_unlike_message(message_id):
     form = g.csrf_form
 
     if form.validate_on_submit():
-        # grab user's of current likes (list of message_ids)
-        target_message = Message.query.get(message_id)
-        liked_message_ids = {msg.id for msg in g.user.liked_messages} # --> this is a set; O(1) for sets!
-        # see if message_id is in ^ list
-        if message_id in liked_message_ids:
-            # if it is, .remove() message from user's likes 
-            g.user.liked_messages.remove(target_message)
-        else:
-            # if it is not, grab message based on message_id and .append()
-            g.user.liked_messages.append(target_message)
+        target_message = Message.query.get_or_404(message_id)
 
-        db.session.commit() 
+        toggle_like(g.user.id, message_id)
+        db.session.commit()
 
         serialized = target_message.serialize()
 
@@ -421,25 +672,196 @@ def like_message():
     form = g.csrf_form
 
     if form.validate_on_submit():
-        redirect_loc = request.form["redirect_loc"]
+        message_id = request.form.get("message_id", type=int)
 
-        # use our ORM to do this instead - .append()
-        message = request.form["message_id"]
-        like = Like.query.get((g.user.id, message))
+        if message_id is None:
+            abort(400)
 
-        if like:
-            db.session.delete(like)
-            db.session.commit()
-            return redirect(redirect_loc)
+        msg = Message.query.get_or_404(message_id)
+        toggle_like(g.user.id, msg.id)
+        db.session.commit()
 
-        else:
-            new_like = Like(user_id=g.user.id, message_id=message)
-            db.session.add(new_like)
-            db.session.commit()
-            return redirect(redirect_loc)
+    return redirect(request.form.get("redirect_loc", "/"))
+
+
+@app.post('/api/likes')
+def set_likes_api():
+    """ Handle AJAX request to like and/or unlike many messages at once.
+
+    Takes JSON like {"like": [message ids], "unlike": [message ids]}.
+    Responds with the resulting state of each message given, whether the
+    request changed it or not, and the user's like count:
+
+        {"likes": {"<message id>": true/false, ...}, "likes_count": 12}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    try:
+        like_ids, unlike_ids = parse_likes_request(
+            request.get_json(silent=True))
+    except ValueError as error:
+        return (jsonify(error=str(error)), 400)
+
+    apply_likes(g.user.id, like_ids, unlike_ids)
+    db.session.commit()
+
+    # messages that don't exist can't be liked
+    liked = get_liked_ids_among(g.user.id, like_ids)
+
+    return jsonify(
+        likes=like_states(like_ids, unlike_ids, liked),
+        likes_count=get_likes_count(g.user.model))
+
+
+
+##############################################################################
+# Paginated message lists (shared by the pages and the "load more" API)
+
+
+def get_home_messages_page(user, before, columns=None):
+    """ One page of the home timeline for `user`: (messages, next_cursor).
+
+    With `columns` (serialization.MESSAGE_COLUMNS, for the APIs), the
+    messages are rows of those, rather than Messages; likewise below.
+    """
+
+    if follow_graph.following(user):
+        messages = get_timeline(
+            user, MESSAGES_PER_PAGE + 1, before, columns=columns)
+        return split_page(messages, MESSAGES_PER_PAGE)
+
+    return paginate(
+        Message.query.options(joinedload(Message.user)) if columns is None
+        else db.session.query(*columns),
+        Message.timestamp,
+        Message.id,
+        before)
+
+
+def get_user_messages_page(user, before, columns=None):
+    """ One page of messages written by `user`: (messages, next_cursor).
+
+    `msg.user` resolves from the identity map, since `user` is loaded.
+    """
+
+    return paginate(
+        (Message.query if columns is None else db.session.query(*columns))
+        .filter(Message.user_id == user.id),
+        Message.timestamp,
+        Message.id,
+        before)
+
+
+def get_liked_messages_page(user, before, columns=None):
+    """ One page of messages liked by `user`, most recent like first:
+    (messages, next_cursor). """
+
+    # the list comes from the likes table, so write out the current user's
+    # buffered likes before they look at their own
+    if user.id == g.user.id and like_buffer.has_pending(user.id):
+        like_buffer.flush()
+        use_primary()
+
+    if columns is None:
+        query = (db.session.query(Message, Like.timestamp.label('liked_at'))
+                 .options(joinedload(Message.user)))
+        key = lambda row: (row.liked_at, row.Message.id)
     else:
-        return redirect(redirect_loc)
+        query = db.session.query(*columns, Like.timestamp.label('liked_at'))
+        key = lambda row: (row.liked_at, row.id)
+
+    rows, next_cursor = paginate(
+        query
+        .join(Like, Like.message_id == Message.id)
+        .filter(Like.user_id == user.id),
+        Like.timestamp,
+        Like.message_id,
+        before,
+        key=key)
+
+    if columns is None:
+        rows = [row.Message for row in rows]
+
+    return rows, next_cursor
+
+
+def api_response(status=200, **data):
+    """ JSON response, or MessagePack if the client prefers it (see
+    serialization.py). """
+
+    mimetype = negotiate(request.headers.get('Accept'))
+
+    return (encode(data, mimetype, app.config['JSON_BACKEND']),
+            status,
+            {'Content-Type': mimetype, 'Vary': 'Accept'})
+
+
+def page_response(rows, next_cursor):
+    """ API response for one page of message rows. """
+
+    return api_response(
+        messages=serialize_messages(message_data(rows)),
+        next=next_cursor)
+
+
+@app.get('/api/timeline')
+@replica_reads
+def get_home_timeline_api():
+    """ Handle AJAX request for the next page of the home timeline. """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
 
+    return page_response(*get_home_messages_page(
+        g.user, get_cursor_arg(), columns=MESSAGE_COLUMNS))
+
+
+@app.get('/api/users/<int:user_id>/messages')
+@replica_reads
+def get_user_messages_api(user_id):
+    """ Handle AJAX request for the next page of a user's messages. """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    user = User.query.get_or_404(user_id)
+
+    return page_response(*get_user_messages_page(
+        user, get_cursor_arg(), columns=MESSAGE_COLUMNS))
+
+
+@app.get('/api/users/<int:user_id>/liked_messages')
+@replica_reads
+def get_liked_messages_api(user_id):
+    """ Handle AJAX request for the next page of a user's liked messages. """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    user = User.query.get_or_404(user_id)
+
+    return page_response(*get_liked_messages_page(
+        user, get_cursor_arg(), columns=MESSAGE_COLUMNS))
+
+
+@app.get('/api/users/search')
+@replica_reads
+def search_users_api():
+    """ Handle AJAX typeahead request: up to `limit` (at most
+    TYPEAHEAD_LIMIT) users best matching `q`. """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    search = request.args.get('q', '').strip()
+    limit = request.args.get('limit', TYPEAHEAD_LIMIT, type=int)
+
+    if not search:
+        return jsonify(users=[])
+
+    return jsonify(users=typeahead(search, limit))
 
 
 ##############################################################################
@@ -447,50 +869,194 @@ def like_message():
 
 
 @app.get('/')
+@replica_reads
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users if following anyone,
-        or all users if not following anyone (or else it looks broken)
+    - logged in: most recent messages of followed_users if following anyone,
+        or all users if not following anyone (or else it looks broken),
+        a page at a time
+
+    Followed users' messages come from the precomputed timeline (see
+    timeline.py).
     """
 
     if g.user:
-        following = [user.id for user in g.user.following] + [g.user.id]
-
-        liked_message_ids = {msg.id for msg in g.user.liked_messages} # --> this is a set; O(1) for sets!
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        if len(following) == 1:
-            messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages, likes=liked_message_ids)
+        unchanged = not_modified(*home_validators())
+        if unchanged:
+            return unchanged
+
+        messages, next_cursor = get_home_messages_page(
+            g.user, get_cursor_arg())
+        liked_message_ids = get_liked_ids(messages)
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            next_cursor=next_cursor,
+            likes=liked_message_ids)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(CurrentUserGone)
+def current_user_gone(error):
+    """The logged-in user was deleted (on another worker, or outside the
+    app) while their snapshot was still cached: log them out."""
+
+    db.session.rollback()
+    forget_current_user(error.user_id)
+    do_logout()
+    g.user = None
+
+    return redirect("/")
+
+
+@app.errorhandler(PasswordPoolBusy)
+def password_pool_busy(error):
+    """Too many logins/signups at once: fail fast and ask the client to
+    retry, rather than queueing requests behind bcrypt."""
+
+    app.logger.warning("password pool full: %s", get_password_pool().stats())
+
+    return ("Too many sign-ins right now; please try again in a moment.",
+            503,
+            {"Retry-After": "1"})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
-
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+# Metrics
+
+
+def metrics_authorized():
+    """ Whether the request may see metrics: it has the METRICS_TOKEN, or
+    none is set and metrics are public (METRICS_PUBLIC, or in debug or
+    testing). """
+
+    token = app.config['METRICS_TOKEN']
+
+    if not token:
+        return app.config['METRICS_PUBLIC'] or app.debug or app.testing
+
+    return request.headers.get('Authorization') == f"Bearer {token}"
+
+
+@app.get('/metrics')
+def metrics():
+    """ Per-route request histograms and cache/pool stats for this worker,
+    in Prometheus' text format. """
+
+    if not metrics_authorized():
+        return ("Access unauthorized.", 401)
+
+    values = {}
+
+    for prefix, stats in (
+            ('password_pool', get_password_pool().stats()),
+            ('like_buffer', like_buffer.stats()),
+            ('fragment_cache', fragment_cache.stats()),
+            ('search_cache', search_cache.stats()),
+            ('current_user_cache', current_user_cache.stats()),
+            ('follow_graph', follow_graph.stats()),
+            ('stream', broker.stats()),
+            ('db_pool', pool_stats(db.engine))):
+        for name, value in stats.items():
+            if name in ('hits', 'misses', 'evictions', 'completed',
+                        'rejected', 'flushes', 'flushed', 'failures',
+                        'checkouts', 'timeouts', 'wait_seconds',
+                        'dispatched', 'delivered', 'stale'):
+                name += '_total'
+            values[f'warbler_{prefix}_{name}'] = (
+                f"{prefix.replace('_', ' ')}: {name}", float(value))
+
+    return (render_metrics(values), 200,
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@app.get('/metrics/queries')
+def query_metrics():
+    """ This worker's sampled SQL, totalled by route and statement shape,
+    most total time first (?limit=, default 50), as JSON. """
+
+    if not metrics_authorized():
+        return ("Access unauthorized.", 401)
+
+    limit = request.args.get('limit', 50, type=int)
+
+    return jsonify(
+        sampled_requests=dict(query_report.requests),
+        dropped=query_report.dropped,
+        queries=query_report.ranked(limit),
+    )
+
+
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('backfill-timelines')
+def backfill_timelines_command():
+    """Rebuild every precomputed home timeline from messages and follows."""
+
+    count = backfill_timelines()
+    db.session.commit()
+
+    print(f"Wrote {count} timeline entries.")
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines_command():
+    """Delete the oldest entries of timelines over their size limit."""
+
+    count = trim_timelines()
+    db.session.commit()
+
+    print(f"Deleted {count} timeline entries.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recount users' message/follow/like counters and repair any drift."""
+
+    count = reconcile_counters()
+    db.session.commit()
+
+    print(f"Repaired counters for {count} users.")
+
+
+@app.cli.command('db-pool-budget')
+@click.option('--workers', type=int,
+              default=lambda: app.config['WEB_CONCURRENCY'],
+              help="gunicorn worker processes (default: $WEB_CONCURRENCY)")
+@click.option('--threads', type=int,
+              default=lambda: app.config['WEB_THREADS'],
+              help="threads per worker (default: $WEB_THREADS)")
+def db_pool_budget_command(workers, threads):
+    """Compare the connections the app may open with max_connections."""
+
+    options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    per_worker, total = connection_budget(options, workers, threads)
+
+    max_connections = int(db.session.execute(
+        text("SHOW max_connections")).scalar())
+    reserved = int(db.session.execute(
+        text("SHOW superuser_reserved_connections")).scalar())
+    in_use = db.session.execute(text(
+        "SELECT count(*) FROM pg_stat_activity "
+        "WHERE backend_type = 'client backend'")).scalar()
+    available = max_connections - reserved
+
+    print(f"{workers} workers x {per_worker} connections = {total}")
+    print(f"server allows {available} ({max_connections} max_connections - "
+          f"{reserved} reserved); {in_use} in use now")
+
+    if per_worker < threads:
+        print("warning: fewer connections than threads per worker; requests "
+              "will wait for them")
+
+    if total > available:
+        print("warning: the workers may open more connections than the "
+              "server allows; lower DB_POOL_SIZE/DB_MAX_OVERFLOW or use "
+              "PgBouncer (DB_PGBOUNCER=1)")
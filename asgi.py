@@ -0,0 +1,370 @@
+"""Async JSON API for Warbler, and the ASGI app that serves it.
+
+/api/v2 is for clients that keep many requests open at once (e.g. mobile
+apps polling their feed): its views are coroutines on SQLAlchemy's asyncio
+engine (asyncpg), so a process waiting on the database for one request
+keeps serving others, instead of a gunicorn worker (and a connection)
+being tied up per request.
+
+    GET  /api/v2/feed               the home timeline, a page at a time
+    GET  /api/v2/users/<id>         a profile, and a page of their messages
+    GET  /api/v2/likes              the current user's liked messages
+    POST /api/v2/likes              like/unlike messages (as /api/likes)
+
+and /api/stream/timeline, the homepage's live updates (see streams.py),
+which a process can hold open for any number of browsers at once.
+
+Responses have the same shapes and encodings as the Flask API (see
+serialization.py: JSON, or MessagePack if asked for; `next` cursors;
+{"error": ...}), and users sign in the same way: the Flask session cookie.
+Everything else is the Flask app, mounted underneath, so
+
+    uvicorn asgi:app --workers 4
+
+serves the whole site (Flask views run in a thread pool of WEB_THREADS
+threads, default 10, which also sizes the password pool). Or keep the
+Flask app on gunicorn and route /api/v2 to uvicorn.
+
+The async engine uses the same database and pool settings as the Flask app
+(see db_pool.py), but its own connections.
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, CURR_USER_KEY
+from follow_graph import follow_graph
+from likes import (apply_likes, get_liked_ids_among, get_likes_count,
+                   like_buffer, like_states, parse_likes_request)
+from models import Like, Message, User
+from pagination import (CURSOR_ARG, MESSAGES_PER_PAGE, apply_keyset,
+                        decode_cursor, split_page)
+from serialization import (MESSAGE_COLUMNS, USER_COLUMNS, UserData, encode,
+                           message_data, negotiate, serialize_messages,
+                           serialize_user)
+from streams import Subscription, broker, event_stream, get_transport
+from timeline import (fanout_on_read_authors_query, merge_timeline,
+                      newer_messages_query, pulled_messages_query,
+                      timeline_query)
+
+
+def create_engine_for(config):
+    """ Async engine for the Flask app's database and pool settings. """
+
+    url = make_url(config['SQLALCHEMY_DATABASE_URI']).set(
+        drivername='postgresql+asyncpg')
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+    if options.get('poolclass') is NullPool:
+        # PgBouncer in transaction mode: asyncpg's named prepared statements
+        # would outlive the transaction's server connection
+        url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+        options['connect_args'] = {'statement_cache_size': 0}
+    else:
+        # the default async pool, rather than db_pool.TimedQueuePool
+        options.pop('poolclass', None)
+
+    return create_async_engine(url, **options)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # asyncpg connections belong to an event loop: make the engine in the
+    # server's
+    engine = create_engine_for(flask_app.config)
+    app.state.sessions = sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False)
+
+    transport = get_transport(flask_app)
+    if transport is not None:
+        transport.start(broker)
+
+    yield
+
+    if transport is not None:
+        await run_in_threadpool(transport.stop)
+    await engine.dispose()
+
+
+##############################################################################
+# Helpers
+
+
+def api_response(request, status=200, **data):
+    """ JSON response, or MessagePack if the client prefers it (as
+    app.api_response). """
+
+    mimetype = negotiate(request.headers.get('accept'))
+
+    return Response(encode(data, mimetype, flask_app.config['JSON_BACKEND']),
+                    status, headers={'Vary': 'Accept'}, media_type=mimetype)
+
+
+def unauthorized(request):
+    return api_response(request, 401, error="Access unauthorized.")
+
+
+def get_session_user_id(request):
+    """ The signed-in user's id from the Flask session cookie, or None. """
+
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+
+    if not cookie:
+        return None
+
+    serializer = flask_app.session_interface.get_signing_serializer(
+        flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    try:
+        return serializer.loads(cookie, max_age=max_age).get(CURR_USER_KEY)
+    except BadSignature:
+        return None
+
+
+async def get_current_user(request, session):
+    """ The signed-in User, or None. """
+
+    user_id = get_session_user_id(request)
+
+    if user_id is None:
+        return None
+
+    return await session.get(User, user_id)
+
+
+def get_cursor(request):
+    """ Decoded cursor from the querystring, or None for the first page. """
+
+    cursor = request.query_params.get(CURSOR_ARG)
+
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(400, "Bad cursor.")
+
+
+def page_response(request, rows, next_cursor, **data):
+    """ API response for one page of message rows. """
+
+    return api_response(
+        request,
+        **data,
+        messages=serialize_messages(message_data(rows)),
+        next=next_cursor)
+
+
+async def http_error(request, exc):
+    return api_response(request, exc.status_code, error=exc.detail)
+
+
+##############################################################################
+# Views
+
+
+async def feed(request):
+    """ One page of the current user's home timeline (as /api/timeline). """
+
+    async with request.app.state.sessions() as session:
+        user = await get_current_user(request, session)
+
+        if user is None:
+            return unauthorized(request)
+
+        before = get_cursor(request)
+        limit = MESSAGES_PER_PAGE + 1
+
+        following = await session.run_sync(
+            lambda sync: follow_graph.following(user, sync))
+
+        if following:
+            messages = (await session.execute(timeline_query(
+                user.id, limit, before, MESSAGE_COLUMNS))).all()
+            pulled_author_ids = (await session.scalars(
+                fanout_on_read_authors_query(user.id))).all()
+
+            if pulled_author_ids:
+                pulled = (await session.execute(pulled_messages_query(
+                    pulled_author_ids, limit, before, MESSAGE_COLUMNS))).all()
+                messages = merge_timeline(messages, pulled, limit)
+        else:
+            messages = (await session.execute(
+                apply_keyset(select(*MESSAGE_COLUMNS), Message.timestamp,
+                             Message.id, before)
+                .limit(limit))).all()
+
+        return page_response(
+            request, *split_page(messages, MESSAGES_PER_PAGE))
+
+
+async def user_detail(request):
+    """ A user's profile, and one page of their messages. """
+
+    async with request.app.state.sessions() as session:
+        if await get_current_user(request, session) is None:
+            return unauthorized(request)
+
+        user = (await session.execute(
+            select(*USER_COLUMNS)
+            .where(User.id == request.path_params['user_id']))).first()
+
+        if user is None:
+            raise HTTPException(404, "Not found.")
+
+        messages = (await session.execute(
+            apply_keyset(
+                select(*MESSAGE_COLUMNS).where(Message.user_id == user.id),
+                Message.timestamp,
+                Message.id,
+                get_cursor(request))
+            .limit(MESSAGES_PER_PAGE + 1))).all()
+
+        return page_response(
+            request, *split_page(messages, MESSAGES_PER_PAGE),
+            user=serialize_user(UserData._make(user)))
+
+
+async def likes(request):
+    """ GET: one page of the current user's liked messages, most recently
+    liked first. POST: like and/or unlike messages, taking and returning
+    the same JSON as /api/likes. """
+
+    async with request.app.state.sessions() as session:
+        user = await get_current_user(request, session)
+
+        if user is None:
+            return unauthorized(request)
+
+        if request.method == 'POST':
+            return await set_likes(request, session, user)
+
+        # the list comes from the likes table (see app.get_liked_messages_page)
+        if like_buffer.has_pending(user.id):
+            await run_in_threadpool(like_buffer.flush)
+
+        rows = (await session.execute(
+            apply_keyset(
+                select(*MESSAGE_COLUMNS, Like.timestamp.label('liked_at'))
+                .join(Like, Like.message_id == Message.id)
+                .where(Like.user_id == user.id),
+                Like.timestamp,
+                Like.message_id,
+                get_cursor(request))
+            .limit(MESSAGES_PER_PAGE + 1))).all()
+
+        return page_response(request, *split_page(
+            rows, MESSAGES_PER_PAGE, key=lambda row: (row.liked_at, row.id)))
+
+
+async def set_likes(request, session, user):
+    data = None
+
+    # JSON only, like Flask's get_json: a form can't post it cross-site
+    if request.headers.get('content-type', '').startswith(
+            'application/json'):
+        try:
+            data = await request.json()
+        except ValueError:
+            pass
+
+    try:
+        like_ids, unlike_ids = parse_likes_request(data)
+    except ValueError as error:
+        return api_response(request, 400, error=str(error))
+
+    # the likes functions are synchronous; run_sync runs them on this
+    # session's connection without blocking the event loop
+    await session.run_sync(
+        lambda sync: apply_likes(user.id, like_ids, unlike_ids, sync))
+    await session.commit()
+
+    liked, likes_count = await session.run_sync(lambda sync: (
+        get_liked_ids_among(user.id, like_ids, sync),
+        get_likes_count(user, sync)))
+
+    return api_response(
+        request,
+        likes=like_states(like_ids, unlike_ids, liked),
+        likes_count=likes_count)
+
+
+async def timeline_stream(request):
+    """ Server-sent events: new messages on the current user's home
+    timeline, as they're posted (see streams.py). """
+
+    if get_transport(flask_app) is None:
+        raise HTTPException(404, "Not found.")
+
+    config = flask_app.config
+
+    async with request.app.state.sessions() as session:
+        user = await get_current_user(request, session)
+
+        if user is None:
+            return unauthorized(request)
+
+        author_ids = await session.run_sync(
+            lambda sync: follow_graph.following(user, sync))
+
+        subscription = Subscription(
+            user.id, author_ids, config['STREAM_BUFFER_SIZE'],
+            asyncio.get_running_loop())
+        broker.subscribe(subscription)
+
+        try:
+            # reconnecting: was anything posted while we were away?
+            last_id = request.headers.get('last-event-id', '')
+
+            if last_id.isdigit() and await session.scalar(
+                    newer_messages_query(user.id, int(last_id))):
+                subscription.mark_missed()
+        except BaseException:
+            broker.unsubscribe(subscription)
+            raise
+
+    # the database connection has gone back to the pool by now
+    return StreamingResponse(
+        event_stream(subscription, config['STREAM_HEARTBEAT'],
+                     config['STREAM_TIMEOUT']),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
+##############################################################################
+# The ASGI app
+
+
+# threads running Flask views (a2wsgi's default); the password pool is sized
+# from this, as for `gunicorn --threads`
+DEFAULT_WSGI_THREADS = 10
+
+wsgi_threads = int(os.environ.get('WEB_THREADS', DEFAULT_WSGI_THREADS))
+flask_app.config['WEB_THREADS'] = wsgi_threads
+
+routes = [
+    Route('/api/v2/feed', feed),
+    Route('/api/v2/users/{user_id:int}', user_detail),
+    Route('/api/v2/likes', likes, methods=['GET', 'POST']),
+    Route('/api/stream/timeline', timeline_stream),
+    Mount('/', WSGIMiddleware(flask_app, workers=wsgi_threads)),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan,
+                exception_handlers={HTTPException: http_error})
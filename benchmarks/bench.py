@@ -0,0 +1,445 @@
+"""Route benchmarks for Warbler.
+
+Seeds a benchmark database (BENCH_DATABASE_URL, default
+postgresql:///warbler_bench) with generated data, then times the main
+routes, logged in as a sample of users:
+
+    home        GET /
+    search      GET /users?q=<username prefix>
+    profile     GET /users/<id>
+    message     GET /messages/<id>
+    like        POST /api/likes (like, then unlike)
+
+first through the Flask test client (in this process, so it also counts SQL
+statements per request), then through a real gunicorn server, with several
+clients at once. Reports p50/p95/p99 latency and requests/sec per route,
+and compares them with benchmarks/baseline.json:
+
+    python -m benchmarks.bench                  # run, compare with baseline
+    python -m benchmarks.bench --save-baseline  # run, make it the baseline
+
+Exits with status 1, listing each regression, if any route fails requests,
+its p95 latency or requests/sec is worse than the baseline's by more than
+--tolerance (and, for latency, --slack-ms), or its typical (median) request
+runs more SQL statements than before. Latency depends on the machine: save
+a baseline on the machine you compare on. Statement counts don't, so those
+can be compared anywhere.
+
+Run from the repo root. --reuse skips seeding (if the benchmark database
+was seeded by an earlier run).
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from random import Random
+from time import monotonic, perf_counter, sleep
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).with_name('baseline.json')
+
+DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler_bench')
+
+os.environ['DATABASE_URL'] = DATABASE_URL
+os.environ.setdefault('SECRET_KEY', 'warbler-benchmarks')
+
+ROUTES = ('home', 'search', 'profile', 'message', 'like')
+
+# how many users the requests are spread over
+NUM_VIEWERS = 20
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20_000)
+    parser.add_argument('--follows', type=int, default=100_000)
+    parser.add_argument('--seed', default='warbler',
+                        help="seed for the data and the requests made")
+    parser.add_argument('--reuse', action='store_true',
+                        help="don't reseed the benchmark database")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="timed requests per route")
+    parser.add_argument('--warmup', type=int, default=20,
+                        help="untimed requests per route, first")
+    parser.add_argument('--no-gunicorn', action='store_true',
+                        help="only benchmark through the test client")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="gunicorn worker processes")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="clients sending requests to gunicorn at once")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="how much worse than the baseline is a "
+                             "regression (0.5 = 50%%)")
+    parser.add_argument('--slack-ms', type=float, default=2.0,
+                        help="latency changes smaller than this are noise")
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+
+    return parser.parse_args(args)
+
+
+##############################################################################
+# Data
+
+
+def ensure_database(url):
+    """ Create the database at `url` if it doesn't exist. """
+
+    url = make_url(url)
+    engine = create_engine(
+        url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+
+    with engine.connect() as conn:
+        exists = conn.scalar(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {'name': url.database})
+
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+
+    engine.dispose()
+
+
+def seed(options):
+    """ Generate a data set of the requested size and load it. """
+
+    from seed import seed_database
+
+    with tempfile.TemporaryDirectory() as folder:
+        subprocess.run([
+            sys.executable, ROOT / 'generator' / 'create_csvs.py',
+            '--users', str(options.users),
+            '--messages', str(options.messages),
+            '--follows', str(options.follows),
+            '--seed', options.seed,
+            '--out', folder,
+        ], check=True)
+
+        seed_database(folder)
+
+
+def describe_dataset(db):
+    """ Row counts of the main tables. """
+
+    return {table: db.session.scalar(text(f"SELECT count(*) FROM {table}"))
+            for table in ('users', 'messages', 'follows')}
+
+
+def make_requests(db, options, count):
+    """ {route: [(method, path, json body, session cookie), ...]}, `count`
+    of each, for a sample of users, messages and searches. """
+
+    from app import app, CURR_USER_KEY
+    from models import Message, User
+
+    rng = Random(options.seed)
+    user_ids = db.session.scalars(db.select(User.id)).all()
+    message_ids = db.session.scalars(db.select(Message.id)).all()
+    usernames = db.session.scalars(db.select(User.username)).all()
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = [
+        'session=' + serializer.dumps({CURR_USER_KEY: user_id})
+        for user_id in rng.sample(user_ids, min(NUM_VIEWERS, len(user_ids)))]
+
+    def like(i):
+        message_id = message_ids[i // 2 % len(message_ids)]
+        return {'like' if i % 2 == 0 else 'unlike': [message_id]}
+
+    return {
+        'home': [('GET', '/', None, rng.choice(cookies))
+                 for _ in range(count)],
+        'search': [('GET', f'/users?q={rng.choice(usernames)[:3]}', None,
+                    rng.choice(cookies))
+                   for _ in range(count)],
+        'profile': [('GET', f'/users/{rng.choice(user_ids)}', None,
+                     rng.choice(cookies))
+                    for _ in range(count)],
+        'message': [('GET', f'/messages/{rng.choice(message_ids)}', None,
+                     rng.choice(cookies))
+                    for _ in range(count)],
+        # each viewer likes and then unlikes the same message
+        'like': [('POST', '/api/likes', like(i),
+                  cookies[i // 2 % len(cookies)])
+                 for i in range(count)],
+    }
+
+
+##############################################################################
+# Measuring
+
+
+def percentile(ordered, p):
+    """ The `p`th percentile (nearest rank) of the sorted list `ordered`. """
+
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies, elapsed, errors, statements=None):
+    """ Results for one route, given each request's latency (seconds) and,
+    if known, how many SQL statements each ran. """
+
+    ordered = sorted(latencies)
+
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+    }
+
+    if statements is not None:
+        # the median is what a warm worker runs; the mean includes cache
+        # misses (logged-in user, fragments, ...)
+        result['statements_p50'] = percentile(sorted(statements), 50)
+        result['statements_mean'] = round(
+            sum(statements) / len(statements), 2)
+
+    return result
+
+
+def bench_test_client(db, warmup, timed):
+    """ Time each route through the Flask test client, one request at a
+    time. """
+
+    from app import app
+
+    client = app.test_client(use_cookies=False)
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+
+    def send(method, path, body, cookie):
+        return client.open(
+            path, method=method, json=body, headers={'Cookie': cookie})
+
+    results = {}
+
+    for route in ROUTES:
+        for request in warmup[route]:
+            send(*request)
+
+        latencies = []
+        counts = []
+        errors = 0
+        event.listen(db.engine, 'before_cursor_execute', count)
+        started = perf_counter()
+
+        for request in timed[route]:
+            statements = 0
+            sent = perf_counter()
+            response = send(*request)
+            latencies.append(perf_counter() - sent)
+            counts.append(statements)
+            errors += response.status_code >= 400
+
+        elapsed = perf_counter() - started
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+        results[route] = summarize(latencies, elapsed, errors, counts)
+
+    return results
+
+
+def start_gunicorn(options):
+    """ Start gunicorn serving the app, and wait until it answers. """
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn',
+         '--workers', str(options.workers),
+         '--bind', f'127.0.0.1:{options.port}',
+         '--log-level', 'warning',
+         'app:app'],
+        cwd=ROOT)
+
+    deadline = monotonic() + 30
+
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', options.port), 1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("gunicorn didn't start")
+
+
+def bench_gunicorn(options, warmup, timed):
+    """ Time each route through gunicorn, with --concurrency clients. """
+
+    def send(request):
+        method, path, body, cookie = request
+        headers = {'Cookie': cookie}
+
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        conn = http.client.HTTPConnection('127.0.0.1', options.port)
+        sent = perf_counter()
+
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            return perf_counter() - sent, response.status >= 400
+        finally:
+            conn.close()
+
+    server = start_gunicorn(options)
+    results = {}
+
+    try:
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            for route in ROUTES:
+                list(pool.map(send, warmup[route]))
+
+                started = perf_counter()
+                outcomes = list(pool.map(send, timed[route]))
+                elapsed = perf_counter() - started
+
+                results[route] = summarize(
+                    [latency for latency, _ in outcomes],
+                    elapsed,
+                    sum(error for _, error in outcomes))
+    finally:
+        server.terminate()
+        server.wait()
+
+    return results
+
+
+##############################################################################
+# Reporting
+
+
+def print_results(mode, results):
+    print(f"\n{mode}")
+    print(f"{'route':<10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'req/s':>9}{'SQL/req':>9}{'errors':>8}")
+
+    for route, result in results.items():
+        print(f"{route:<10}{result['p50_ms']:>9}{result['p95_ms']:>9}"
+              f"{result['p99_ms']:>9}{result['requests_per_sec']:>9}"
+              f"{result.get('statements_mean', '-'):>9}"
+              f"{result['errors']:>8}")
+
+
+def find_regressions(baseline, current, tolerance, slack_ms):
+    """ Lines describing each way `current` is worse than `baseline`. """
+
+    regressions = []
+
+    for mode, results in current['results'].items():
+        for route, now in results.items():
+            before = baseline['results'].get(mode, {}).get(route)
+
+            if before is None:
+                continue
+
+            where = f"{mode} {route}"
+
+            if now['errors']:
+                regressions.append(f"{where}: {now['errors']} errors")
+
+            if now['p95_ms'] > max(before['p95_ms'] * (1 + tolerance),
+                                   before['p95_ms'] + slack_ms):
+                regressions.append(
+                    f"{where}: p95 {now['p95_ms']}ms, "
+                    f"baseline {before['p95_ms']}ms")
+
+            if (now['requests_per_sec']
+                    < before['requests_per_sec'] * (1 - tolerance)):
+                regressions.append(
+                    f"{where}: {now['requests_per_sec']} req/s, "
+                    f"baseline {before['requests_per_sec']} req/s")
+
+            if (now.get('statements_p50', 0)
+                    > before.get('statements_p50', math.inf)):
+                regressions.append(
+                    f"{where}: {now['statements_p50']} SQL statements "
+                    f"per request, baseline {before['statements_p50']}")
+
+    return regressions
+
+
+def main(args=None):
+    options = get_options(args)
+
+    ensure_database(DATABASE_URL)
+
+    # importing the app connects it to the benchmark database
+    sys.path.insert(0, str(ROOT))
+    from app import db
+
+    if not options.reuse:
+        seed(options)
+
+    current = {'dataset': describe_dataset(db), 'results': {}}
+
+    warmup = make_requests(db, options, options.warmup)
+    timed = make_requests(db, options, options.requests)
+    db.session.commit()
+
+    current['results']['test_client'] = bench_test_client(db, warmup, timed)
+    print_results('test client', current['results']['test_client'])
+
+    if not options.no_gunicorn:
+        current['results']['gunicorn'] = bench_gunicorn(options, warmup, timed)
+        print_results(
+            f"gunicorn ({options.workers} workers, "
+            f"{options.concurrency} clients)",
+            current['results']['gunicorn'])
+
+    if options.save_baseline:
+        options.baseline.write_text(json.dumps(current, indent=2) + '\n')
+        print(f"\nsaved as the baseline ({options.baseline})")
+        return 0
+
+    if not options.baseline.exists():
+        print("\nno baseline to compare with (run with --save-baseline)")
+        return 0
+
+    baseline = json.loads(options.baseline.read_text())
+
+    if baseline['dataset'] != current['dataset']:
+        print(f"\nbaseline is for a different data set "
+              f"({baseline['dataset']}), not comparing")
+        return 0
+
+    regressions = find_regressions(
+        baseline, current, options.tolerance, options.slack_ms)
+
+    if regressions:
+        print("\nREGRESSIONS against the baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+
+    print("\nno regressions against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
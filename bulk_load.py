@@ -0,0 +1,201 @@
+"""Bulk loading CSV files into Warbler's database (see seed.py).
+
+Each CSV is streamed straight into its table: with PostgreSQL's COPY, the
+file is sent to the server in COPY_BUFFER_BYTES pieces, never parsed or held
+in Python; other databases get executemany INSERTs of INSERT_CHUNK_ROWS
+rows at a time. Either way, memory use doesn't grow with the file.
+
+On PostgreSQL, the loaded tables' indexes, primary keys, unique and foreign
+key constraints (and foreign keys pointing at them) are dropped for the
+load and rebuilt once at the end, which is much faster than updating them
+row by row. Rebuilding checks the data: duplicates or dangling references
+fail the load. Everything happens in the caller's transaction, so a failed
+load leaves the database as it was.
+
+A CSV's header row names its columns; an `id` column may be given, and
+the tables' id sequences are moved past the loaded ids afterwards.
+"""
+
+import csv
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from time import perf_counter
+
+from sqlalchemy import text
+
+from models import db, User, Message, Follows
+
+# (file name, model), in the order they must be loaded
+CSV_TABLES = (
+    ('users.csv', User),
+    ('messages.csv', Message),
+    ('follows.csv', Follows),
+)
+
+COPY_BUFFER_BYTES = 1024 * 1024
+INSERT_CHUNK_ROWS = 10_000
+
+# memory for each index rebuild (PostgreSQL's maintenance_work_mem)
+INDEX_BUILD_MEMORY = '512MB'
+
+
+def _rate(rows, seconds):
+    per_second = rows / max(seconds, 1e-6)
+
+    return f"{rows:,} rows in {seconds:.1f}s ({per_second:,.0f} rows/s)"
+
+
+def _read_header(file):
+    return next(csv.reader([file.readline()]))
+
+
+def copy_csv(table, path):
+    """ Stream the CSV at `path` into `table` with COPY. Returns the number
+    of rows loaded. """
+
+    quote = db.engine.dialect.identifier_preparer.quote
+
+    with open(path, newline='') as file:
+        columns = ', '.join(quote(name) for name in _read_header(file))
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY {quote(table.name)} ({columns}) FROM STDIN "
+            "WITH (FORMAT csv)",
+            file,
+            size=COPY_BUFFER_BYTES)
+
+        return cursor.rowcount
+
+
+def insert_csv(table, path, chunk_rows=INSERT_CHUNK_ROWS):
+    """ Load the CSV at `path` into `table` with INSERTs of `chunk_rows`
+    rows at a time. Returns the number of rows loaded. """
+
+    rows = 0
+
+    with open(path, newline='') as file:
+        reader = csv.DictReader(file)
+
+        while chunk := list(islice(reader, chunk_rows)):
+            db.session.execute(table.insert(), chunk)
+            rows += len(chunk)
+
+    return rows
+
+
+def _deferrable_ddl(table_names):
+    """ (drop, create) statements for the indexes and constraints that can
+    wait until `table_names` are loaded: create in the order given, drop in
+    reverse. """
+
+    drop = []
+    create = []
+
+    constraints = db.session.execute(text("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid::regclass::text = ANY(:tables)
+              AND contype IN ('p', 'u')
+           OR contype = 'f'
+              AND (conrelid::regclass::text = ANY(:tables)
+                   OR confrelid::regclass::text = ANY(:tables))
+        ORDER BY contype = 'f', conrelid::regclass::text, conname
+        """), {'tables': list(table_names)})
+
+    indexes = db.session.execute(text("""
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid::regclass::text = ANY(:tables)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint
+                          WHERE conindid = indexrelid)
+        ORDER BY indexrelid::regclass::text
+        """), {'tables': list(table_names)}).all()
+
+    for table, name, definition in constraints:
+        drop.append(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+        create.append(
+            f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+
+    # secondary indexes go after the keys, before the foreign keys
+    keys = sum(1 for statement in create if 'FOREIGN KEY' not in statement)
+
+    drop[keys:keys] = [f'DROP INDEX {name}' for name, _ in indexes]
+    create[keys:keys] = [definition for _, definition in indexes]
+
+    return list(reversed(drop)), create
+
+
+@contextmanager
+def deferred_indexes(table_names, report=print):
+    """ Drop the indexes and constraints on `table_names` (PostgreSQL) for
+    the duration of the block, and rebuild them after it. """
+
+    drop, create = _deferrable_ddl(table_names)
+
+    for statement in drop:
+        db.session.execute(text(statement))
+
+    yield
+
+    started = perf_counter()
+    db.session.execute(
+        text(f"SET LOCAL maintenance_work_mem = '{INDEX_BUILD_MEMORY}'"))
+
+    for statement in create:
+        db.session.execute(text(statement))
+
+    report(f"rebuilt {len(create)} indexes and constraints "
+           f"in {perf_counter() - started:.1f}s")
+
+
+def _reset_sequences(tables):
+    for table in tables:
+        if 'id' in table.c and table.c.id.autoincrement:
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),"
+                f" coalesce(max(id), 0) + 1, false) FROM {table.name}"))
+
+
+def load_csvs(directory, report=print, use_copy=None):
+    """ Load the CSVs in CSV_TABLES from `directory`, reporting rows/sec for
+    each (and the index rebuild) through `report`. Uses COPY (and defers
+    indexes) on PostgreSQL, unless `use_copy` says otherwise.
+
+    Returns {table name: rows loaded}. The caller commits.
+    """
+
+    postgres = db.engine.dialect.name == 'postgresql'
+
+    if use_copy is None:
+        use_copy = postgres
+
+    tables = [model.__table__ for _, model in CSV_TABLES]
+    loaded = {}
+
+    if postgres:
+        db.session.execute(text("SET LOCAL synchronous_commit = off"))
+
+    deferring = (deferred_indexes([table.name for table in tables], report)
+                 if postgres else nullcontext())
+
+    with deferring:
+        for (filename, _), table in zip(CSV_TABLES, tables):
+            path = f"{directory}/{filename}"
+            started = perf_counter()
+
+            if use_copy:
+                rows = copy_csv(table, path)
+            else:
+                rows = insert_csv(table, path)
+
+            loaded[table.name] = rows
+            report(f"{table.name}: {_rate(rows, perf_counter() - started)}")
+
+    if postgres:
+        _reset_sequences(tables)
+
+        for table in tables:
+            db.session.execute(text(f"ANALYZE {table.name}"))
+
+    return loaded
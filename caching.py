@@ -0,0 +1,80 @@
+"""Small in-process caches for Warbler.
+
+These live in each worker process; nothing here is shared between workers,
+so anything cached must be fine to serve slightly stale (bounded by `ttl`).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    """ Thread-safe LRU cache with an optional time-to-live.
+
+    Holds at most `maxsize` entries, evicting the least recently used one
+    first. Entries older than `ttl` seconds (if given) count as missing.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """ Cached value for `key`, or `default`. """
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """ Cache `value` under `key`, evicting old entries if full. """
+
+        with self._lock:
+            self._data[key] = (monotonic(), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """ Drop `key` if cached. """
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Drop everything. """
+
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """ Entries and hit/miss counts, as a dict. """
+
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _expired(self, entry):
+        return self.ttl is not None and monotonic() - entry[0] > self.ttl
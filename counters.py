@@ -0,0 +1,132 @@
+"""Denormalized per-user counters for Warbler.
+
+`users` carries messages_count, following_count, followers_count and
+likes_count so profile headers don't have to load whole collections just to
+count them. Every route that adds or removes a message, follow or like
+adjusts them in the same transaction, and reconcile_counters() repairs any
+drift (e.g. after a bulk load).
+"""
+
+from sqlalchemy import func, or_, select, update
+
+from models import db, Follows, Like, Message, User
+
+
+def _adjust(user_ids, column, delta, session=None, follows_changed=False):
+    """ Add `delta` to `column` for the given user(s). `user_ids` may be a
+    single id, a list or a select of ids. Runs in `session` (default
+    db.session). With `follows_changed`, also bumps their follows_version
+    (see follow_graph.py). """
+
+    if isinstance(user_ids, int):
+        criteria = User.id == user_ids
+    else:
+        criteria = User.id.in_(user_ids)
+
+    values = {column: column + delta}
+
+    if follows_changed:
+        values[User.follows_version] = User.follows_version + 1
+
+    (session or db.session).execute(
+        update(User)
+        .where(criteria)
+        .values(values)
+        .execution_options(synchronize_session='fetch'))
+
+
+def record_message(user_id, delta=1):
+    """ `user_id` posted (delta=1) or deleted (delta=-1) a message. """
+
+    _adjust(user_id, User.messages_count, delta)
+
+
+def record_follow(follower_id, followed_id, delta=1):
+    """ `follower_id` started (delta=1) or stopped (delta=-1) following
+    `followed_id`. """
+
+    _adjust(follower_id, User.following_count, delta)
+    _adjust(followed_id, User.followers_count, delta)
+
+
+def record_likes(user_id, delta, session=None):
+    """ `user_id` liked (delta > 0) or unliked (delta < 0) messages. """
+
+    _adjust(user_id, User.likes_count, delta, session)
+
+
+def before_message_deleted(msg):
+    """ Adjust counters for a message about to be deleted: its author's
+    messages_count and the likes_count of everyone who liked it. """
+
+    record_message(msg.user_id, -1)
+
+    _adjust(
+        select(Like.user_id).where(Like.message_id == msg.id),
+        User.likes_count,
+        -1)
+
+
+def before_user_deleted(user):
+    """ Adjust other users' counters for a user about to be deleted
+    (their follows, and likes of their messages, are cascaded away). """
+
+    _adjust(
+        select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == user.id),
+        User.following_count,
+        -1,
+        follows_changed=True)
+
+    _adjust(
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user.id),
+        User.followers_count,
+        -1,
+        follows_changed=True)
+
+    likes_lost = (
+        select(func.count())
+        .select_from(Like)
+        .join(Message, Message.id == Like.message_id)
+        .where(Message.user_id == user.id)
+        .where(Like.user_id == User.id)
+        .scalar_subquery())
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(
+            select(Like.user_id)
+            .join(Message, Message.id == Like.message_id)
+            .where(Message.user_id == user.id)))
+        .values(likes_count=User.likes_count - likes_lost)
+        .execution_options(synchronize_session='fetch'))
+
+
+def reconcile_counters():
+    """ Recount every counter from the underlying tables and fix the ones
+    that drifted. Returns the number of users repaired. """
+
+    def count(model, column):
+        return (
+            select(func.count())
+            .select_from(model)
+            .where(column == User.id)
+            .scalar_subquery())
+
+    actual = {
+        User.messages_count: count(Message, Message.user_id),
+        User.following_count: count(Follows, Follows.user_following_id),
+        User.followers_count: count(Follows, Follows.user_being_followed_id),
+        User.likes_count: count(Like, Like.user_id),
+    }
+
+    # follows written behind the app's back (e.g. a bulk load) show up as
+    # drifted follow counts: bump those users' follows_version too
+    result = db.session.execute(
+        update(User)
+        .where(or_(*(column != value for column, value in actual.items())))
+        .values({**actual, User.follows_version: User.follows_version + 1})
+        .execution_options(synchronize_session='fetch'))
+
+    return result.rowcount
@@ -0,0 +1,112 @@
+"""The logged-in user (`g.user`) for Warbler.
+
+Every request needs the logged-in user, but most only need their id and
+profile fields (navbar, "is this my message?" checks, ...). Those are kept
+in a per-worker cache, so a typical request doesn't touch the users table;
+the full User row is only loaded when something needs more (relationships,
+counters, deleting the user, ...).
+
+Views that change a user's profile fields must call `forget_current_user`
+so the next request sees the change. Other workers may serve the old
+snapshot for up to CURRENT_USER_CACHE_TTL seconds. If the user's row turns
+out to be gone meanwhile (deleted on another worker, or outside the app),
+loading it raises CurrentUserGone, and the app logs them out.
+"""
+
+from caching import TTLCache
+from follow_graph import follow_graph
+from models import db, User
+
+CURRENT_USER_CACHE_SIZE = 4096
+CURRENT_USER_CACHE_TTL = 60
+
+SNAPSHOT_FIELDS = ('id', 'username', 'email', 'image_url',
+                   'header_image_url', 'bio', 'location')
+
+current_user_cache = TTLCache(
+    maxsize=CURRENT_USER_CACHE_SIZE, ttl=CURRENT_USER_CACHE_TTL)
+
+
+class CurrentUserGone(Exception):
+    """ The logged-in user's row no longer exists, though their snapshot was
+    still cached. """
+
+    def __init__(self, user_id):
+        super().__init__(user_id)
+        self.user_id = user_id
+
+
+class CurrentUser:
+    """ The logged-in user, built from a cached snapshot.
+
+    Profile fields (SNAPSHOT_FIELDS) are plain attributes; anything else is
+    read from the User row, loaded on first use (see `model`).
+    """
+
+    __slots__ = SNAPSHOT_FIELDS + ('_model',)
+
+    def __init__(self, fields, model=None):
+        for name, value in zip(SNAPSHOT_FIELDS, fields):
+            setattr(self, name, value)
+
+        self._model = model
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    @property
+    def model(self):
+        """ The User row for this user (loaded once per request). """
+
+        if self._model is None:
+            self._model = db.session.get(User, self.id)
+
+            if self._model is None:
+                raise CurrentUserGone(self.id)
+
+        return self._model
+
+    @model.setter
+    def model(self, user):
+        self._model = user
+
+    # follows come from the follow graph (see follow_graph.py), checked
+    # against the follows_version of whoever's set is used
+
+    def is_followed_by(self, other_user):
+        return self.id in follow_graph.following(other_user)
+
+    def is_following(self, other_user):
+        return other_user.id in follow_graph.following(self)
+
+    def following_ids_among(self, user_ids):
+        return follow_graph.following(self).among(user_ids)
+
+
+def load_current_user(user_id):
+    """ CurrentUser for `user_id`, or None if there's no such user. """
+
+    fields = current_user_cache.get(user_id)
+
+    if fields is not None:
+        return CurrentUser(fields)
+
+    user = db.session.get(User, user_id)
+
+    if user is None:
+        return None
+
+    fields = tuple(getattr(user, name) for name in SNAPSHOT_FIELDS)
+    current_user_cache.set(user_id, fields)
+
+    return CurrentUser(fields, model=user)
+
+
+def forget_current_user(user_id):
+    """ Drop the cached snapshot for `user_id` (after a profile change or
+    deleting the user). """
+
+    current_user_cache.delete(user_id)
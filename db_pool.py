@@ -0,0 +1,152 @@
+"""Database connection pool settings and stats for Warbler.
+
+`engine_options()` turns DB_* environment variables into
+SQLALCHEMY_ENGINE_OPTIONS:
+
+    DB_POOL_SIZE=5          connections each worker process keeps open
+    DB_MAX_OVERFLOW=10      extra connections it may open when they're busy
+    DB_POOL_TIMEOUT=30      seconds to wait for one before giving up
+    DB_POOL_RECYCLE=1800    reopen connections older than this (seconds)
+    DB_POOL_PRE_PING=1      check a connection is alive before using it
+    DB_PGBOUNCER=1          connect through PgBouncer in transaction mode
+
+Each process can have up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so
+with gunicorn the database needs (workers * that) of its max_connections,
+plus whatever else connects (`flask db-pool-budget` does the sums). A sync
+worker only handles one request at a time, so it rarely needs more than one
+or two; a gthread worker needs about one per thread.
+
+With DB_PGBOUNCER, PgBouncer does the pooling: each checkout opens a
+(cheap) connection to PgBouncer and closing it hands the server connection
+back, so SQLAlchemy's pool is off (NullPool). In transaction mode a session
+only has its server connection for one transaction, so don't rely on
+session state (plain SET, LISTEN, advisory locks, temp tables across
+commits) through it; SET LOCAL is fine.
+
+Otherwise the pool is a `TimedQueuePool`, which counts how long checkouts
+wait for a connection; `pool_stats()` has that and how full the pool is,
+for /metrics.
+"""
+
+import os
+from threading import Lock
+from time import perf_counter
+
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from instrumentation import current_stats
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = 1800
+
+
+def _flag(environ, name, default):
+    return environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+def engine_options(environ=os.environ):
+    """ SQLALCHEMY_ENGINE_OPTIONS from DB_* variables in `environ`. """
+
+    if _flag(environ, 'DB_PGBOUNCER', ''):
+        return {'poolclass': NullPool}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        'max_overflow': int(
+            environ.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW)),
+        'pool_timeout': float(
+            environ.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)),
+        'pool_recycle': int(
+            environ.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE)),
+        'pool_pre_ping': _flag(environ, 'DB_POOL_PRE_PING', '1'),
+    }
+
+
+class CheckoutStats:
+    """ Thread-safe totals of pool checkout waits. """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._lock = Lock()
+
+    def observe(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.timeouts += timed_out
+
+    def clear(self):
+        with self._lock:
+            self.checkouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.timeouts = 0
+
+
+checkout_stats = CheckoutStats()
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout waited (in
+    `checkout_stats`, and as the current request's pool timing). """
+
+    def _do_get(self):
+        started = perf_counter()
+        timed_out = False
+
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            seconds = perf_counter() - started
+            checkout_stats.observe(seconds, timed_out)
+            stats = current_stats()
+
+            if stats is not None:
+                stats.add('pool', seconds)
+
+
+def pool_stats(engine):
+    """ How full `engine`'s pool is, and its checkout waits so far. """
+
+    pool = engine.pool
+    stats = {
+        'checkouts': checkout_stats.checkouts,
+        'wait_seconds': checkout_stats.wait_seconds,
+        'max_wait_seconds': checkout_stats.max_wait_seconds,
+        'timeouts': checkout_stats.timeouts,
+    }
+
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + pool._max_overflow
+        stats.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            saturation=pool.checkedout() / capacity if capacity > 0 else 0,
+        )
+
+    return stats
+
+
+def connection_budget(options, workers, threads=1):
+    """ (connections each worker may open, total for `workers` processes)
+    with engine `options`. Without a pool, that's one per thread. """
+
+    if options.get('poolclass') is NullPool:
+        per_worker = threads
+    else:
+        per_worker = options['pool_size'] + max(options['max_overflow'], 0)
+
+    return per_worker, per_worker * workers
@@ -0,0 +1,280 @@
+"""Who follows whom, cached as compact id sets.
+
+"Is the current user following X?" (follow buttons), "is this user following
+anyone?" (the homepage) and "who do they follow?" (timeline streams) only
+need user ids, not User rows and relationship collections. `follow_graph`
+keeps each user's following (and, when asked for, followers) ids as an
+IdSet: a sorted array of 4-byte ints, searched with bisect, and intersected
+by merging.
+
+The sets are cached per worker, but checked against the database on every
+use, so every worker sees a follow as soon as it commits. `users` has a
+follows_version, bumped in the same transaction as any change to the user's
+follows or followers (`add_follow`/`remove_follow`, and deleting a user; see
+counters.py). Each cached set is labelled with the version it was loaded
+at, and only served to a request whose User row has that version: the row
+the request loads anyway (the homepage, the APIs), or loads instead of
+querying `follows`. A request reading from a replica gets the set matching
+the replica's row. This worker's own follows update its cached sets in place
+when they commit; anyone else's just fail the check, and the set is
+reloaded.
+
+Anything else that writes `follows` must bump follows_version for both
+users, as `add_follow` does.
+"""
+
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from caching import TTLCache
+from models import db, Follows, User
+
+FOLLOW_GRAPH_SIZE = 8192
+# only bounds how long unused sets take up memory: sets are checked against
+# follows_version whenever they're used
+FOLLOW_GRAPH_TTL = 600
+
+# session.info key for follows waiting on a commit
+PENDING_KEY = 'follow_graph_changes'
+
+
+class IdSet:
+    """ Immutable set of user ids, kept sorted in an array('i'). """
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids=()):
+        self.ids = array('i', sorted(set(ids)))
+
+    @classmethod
+    def from_sorted(cls, ids):
+        """ IdSet of `ids`, which are already sorted and distinct. """
+
+        id_set = cls.__new__(cls)
+        id_set.ids = array('i', ids)
+
+        return id_set
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, user_id):
+        return _has(self.ids, user_id)
+
+    def __repr__(self):
+        return f"<IdSet of {len(self.ids)}>"
+
+    def among(self, user_ids):
+        """ Which of `user_ids` are in this set, as a set. """
+
+        return {user_id for user_id in user_ids if user_id in self}
+
+    def intersection(self, other):
+        """ IdSet of the ids in both this and `other` (an IdSet). """
+
+        small, large = sorted((self.ids, other.ids), key=len)
+
+        # much smaller: binary search each of its ids in the other
+        if len(small) * 16 < len(large):
+            return IdSet.from_sorted(
+                user_id for user_id in small if _has(large, user_id))
+
+        both = []
+        i = j = 0
+
+        while i < len(small) and j < len(large):
+            if small[i] < large[j]:
+                i += 1
+            elif small[i] > large[j]:
+                j += 1
+            else:
+                both.append(small[i])
+                i += 1
+                j += 1
+
+        return IdSet.from_sorted(both)
+
+    def with_id(self, user_id):
+        """ Copy of this set with `user_id` added. """
+
+        if user_id in self:
+            return self
+
+        i = bisect_left(self.ids, user_id)
+
+        return IdSet.from_sorted(self.ids[:i] + array('i', [user_id])
+                                 + self.ids[i:])
+
+    def without_id(self, user_id):
+        """ Copy of this set with `user_id` removed. """
+
+        if user_id not in self:
+            return self
+
+        i = bisect_left(self.ids, user_id)
+
+        return IdSet.from_sorted(self.ids[:i] + self.ids[i + 1:])
+
+
+def _has(ids, user_id):
+    """ Is `user_id` in sorted `ids`? """
+
+    i = bisect_left(ids, user_id)
+
+    return i < len(ids) and ids[i] == user_id
+
+
+class FollowGraph:
+    """ Thread-safe cache of users' following and follower IdSets, each
+    labelled with the follows_version it was loaded at. """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = Lock()
+        self.stale = 0
+
+    def following(self, user, session=None):
+        """ IdSet of the users `user` follows, as of `user.follows_version`
+        (`user` is a User, or the CurrentUser). Runs in `session` (default
+        db.session) if not cached at that version. """
+
+        return self._get(
+            ('following', user.id),
+            user.follows_version,
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user.id)
+            .order_by(Follows.user_being_followed_id),
+            session)
+
+    def followers(self, user, session=None):
+        """ IdSet of the users following `user`. """
+
+        return self._get(
+            ('followers', user.id),
+            user.follows_version,
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user.id)
+            .order_by(Follows.user_following_id),
+            session)
+
+    def changed(self, follower_id, followed_id, following, versions):
+        """ `follower_id` started (or stopped) following `followed_id`,
+        taking their follows_versions to `versions` ({user id: version}):
+        update any cached sets of theirs that were current just before. """
+
+        with self._lock:
+            for key, user_id in ((('following', follower_id), followed_id),
+                                 (('followers', followed_id), follower_id)):
+                cached = self._cache.get(key)
+                version = versions[key[1]]
+
+                if cached is None:
+                    continue
+
+                if cached[0] == version - 1:
+                    id_set = cached[1]
+                    self._cache.set(key, (
+                        version,
+                        id_set.with_id(user_id) if following
+                        else id_set.without_id(user_id)))
+                else:
+                    self._cache.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        return {**self._cache.stats(), 'stale': self.stale}
+
+    def _get(self, key, version, query, session):
+        cached = self._cache.get(key)
+
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        # loaded after the version was read, so at least that new
+        id_set = IdSet.from_sorted((session or db.session).scalars(query))
+
+        with self._lock:
+            if cached is not None:
+                self.stale += 1
+
+            # don't replace a newer set with one for a lagging replica
+            current = self._cache.get(key)
+            if current is None or current[0] <= version:
+                self._cache.set(key, (version, id_set))
+
+        return id_set
+
+
+follow_graph = FollowGraph(FOLLOW_GRAPH_SIZE, FOLLOW_GRAPH_TTL)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    for change in session.info.pop(PENDING_KEY, ()):
+        follow_graph.changed(*change)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def _record_change(follower_id, followed_id, following):
+    """ Bump both users' follows_version, and queue the change for the
+    cache (applied on commit). """
+
+    versions = dict(db.session.execute(
+        update(User)
+        .where(User.id.in_([follower_id, followed_id]))
+        .values(follows_version=User.follows_version + 1)
+        .returning(User.id, User.follows_version)
+        .execution_options(synchronize_session=False)).all())
+
+    db.session.info.setdefault(PENDING_KEY, []).append(
+        (follower_id, followed_id, following, versions))
+
+
+def add_follow(follower_id, followed_id):
+    """ Have `follower_id` follow `followed_id`, if they don't already.
+    Returns whether they didn't. The caller commits. """
+
+    result = db.session.execute(
+        insert(Follows)
+        .values(user_following_id=follower_id,
+                user_being_followed_id=followed_id)
+        .on_conflict_do_nothing())
+
+    if not result.rowcount:
+        return False
+
+    _record_change(follower_id, followed_id, True)
+
+    return True
+
+
+def remove_follow(follower_id, followed_id):
+    """ Have `follower_id` stop following `followed_id`. Returns whether
+    they were. The caller commits. """
+
+    result = db.session.execute(
+        delete(Follows)
+        .where(Follows.user_following_id == follower_id)
+        .where(Follows.user_being_followed_id == followed_id))
+
+    if not result.rowcount:
+        return False
+
+    _record_change(follower_id, followed_id, False)
+
+    return True
@@ -0,0 +1,157 @@
+"""Rendered-fragment cache for message lists.
+
+A message's <li> in a list (home, profile, liked messages) only depends on
+the message and its author's username and image, apart from the like star,
+which depends on the viewer. So the rest is rendered once per worker
+(templates/messages/_list_item.html) and kept here, and only the star is
+added per request.
+
+Cached markup is versioned by the author's username and image, so a profile
+change makes it miss everywhere; edit_profile also drops that author's
+entries here to free the memory right away. Messages can't be edited, only
+deleted (see delete_message).
+"""
+
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, g
+from markupsafe import Markup
+
+FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+LIKE_BUTTON = Markup(
+    '<div class="like-buttons">'
+    '<button class="btn btn-link messages-like">'
+    '<i class="bi bi-star"></i></button></div>')
+
+UNLIKE_BUTTON = Markup(
+    '<div class="like-buttons">'
+    '<button class="btn btn-link messages-like">'
+    '<i class="bi bi-star-fill"></i></button></div>')
+
+# a message's <li>: format with its id, body and buttons
+LIST_ITEM = Markup('<li class="list-group-item" id="{}">{}{}</li>')
+
+
+class FragmentCache:
+    """ Thread-safe LRU cache of rendered markup, bounded by memory.
+
+    Entries are (key, version) -> markup, plus the id of the user the markup
+    belongs to; a lookup with a different version is a miss. Evicts least
+    recently used entries once the markup held exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, version):
+        """ Cached markup for `key` at `version`, or None. """
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, version, owner_id, markup):
+        """ Cache `markup` for `key` at `version`, evicting old entries if
+        over the size limit. """
+
+        size = sys.getsizeof(markup)
+
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (version, owner_id, markup, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes and self._data:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def delete(self, key):
+        """ Drop `key` if cached. """
+
+        with self._lock:
+            self._remove(key)
+
+    def delete_owner(self, owner_id):
+        """ Drop every entry belonging to `owner_id`. """
+
+        with self._lock:
+            for key in [key for key, entry in self._data.items()
+                        if entry[1] == owner_id]:
+                self._remove(key)
+
+    def clear(self):
+        """ Drop everything. """
+
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """ Entries, memory held and hit/miss counts, as a dict. """
+
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+
+        if entry is not None:
+            self.bytes -= entry[3]
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+
+def render_message_body(msg):
+    """ Markup for `msg` in a list, without the like star (cached). """
+
+    version = (msg.user.username, msg.user.image_url)
+    body = fragment_cache.get(msg.id, version)
+
+    if body is None:
+        template = current_app.jinja_env.get_template(
+            'messages/_list_item.html')
+        body = Markup(template.render(msg=msg))
+        fragment_cache.set(msg.id, version, msg.user_id, body)
+
+    return body
+
+
+def render_message_item(msg, likes):
+    """ The <li> for `msg` in a message list: the cached body, plus a like
+    star for the current user (filled if `msg.id` is in `likes`). """
+
+    if msg.user_id == g.user.id:
+        buttons = ''
+    elif msg.id in likes:
+        buttons = UNLIKE_BUTTON
+    else:
+        buttons = LIKE_BUTTON
+
+    return LIST_ITEM.format(msg.id, render_message_body(msg), buttons)
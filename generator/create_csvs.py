@@ -2,19 +2,43 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a production-sized
+data set:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 100000000 --workers 8 --out /tmp/warbler-big
+
+and load it with `python seed.py /tmp/warbler-big`.
+
+Output only depends on the options (not on --workers, or the time): rows are
+made in chunks, each with its own random generator seeded from --seed, and
+written out in order as they're ready, so memory use stays flat however big
+the files get. Nothing is fetched from the network.
+
+Follows and messages are skewed like real ones: how many followers a user
+has, and how much they post, follow a power law (--popularity, --activity),
+so there are a few celebrities and a long tail. Every user follows about
+the same number of others (follows / users). Users are written with their
+ids, which messages and follows refer to.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from random import Random
+from time import perf_counter
+
+from helpers import (CITIES, EMAIL_DOMAINS, FIRST_NAMES, LAST_NAMES,
+                     get_random_datetime, get_random_sentence, power_law_rank,
+                     power_law_sample, rank_shuffler)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
@@ -22,9 +46,10 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# every user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +57,201 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# header image URLs to use for users (served by the app itself)
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def chunk_rng(options, name, chunk):
+    """Random generator for one chunk of one file: the same for the same
+    --seed, whichever process makes it."""
+
+    return Random(f"{options.seed}:{name}:{chunk}")
+
+
+def chunks(total, size):
+    """(chunk number, first row, end row) covering rows 0..total - 1."""
+
+    return [(number, start, min(start + size, total))
+            for number, start in enumerate(range(0, total, size))]
+
+
+def to_csv(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+
+    return out.getvalue()
+
+
+def make_users(options, chunk, start, end):
+    rng = chunk_rng(options, 'users', chunk)
+    rows = []
+
+    for i in range(start + 1, end + 1):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+
+        rows.append([
+            i,
+            f"{first}.{last}{i}@{rng.choice(EMAIL_DOMAINS)}",
+            f"{first}{last}{i}",
+            rng.choice(image_urls),
+            PASSWORD_HASH,
+            get_random_sentence(rng),
+            rng.choice(header_image_urls),
+            rng.choice(CITIES),
+        ])
+
+    return to_csv(rows)
+
+
+def make_messages(options, chunk, start, end):
+    rng = chunk_rng(options, 'messages', chunk)
+    author = rank_shuffler(options.users)
+    rows = []
+
+    for _ in range(start, end):
+        rows.append([
+            get_random_sentence(rng)[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng, options.end),
+            author(power_law_rank(rng, options.users, options.activity)),
+        ])
+
+    return to_csv(rows)
+
+
+def make_follows(options, chunk, start, end):
+    """Follows by users start + 1 .. end: each follows a share of the total,
+    picking who by popularity.
+
+    Each pick is a power law draw, retrying repeats, for up to n draws a
+    follower; past that (when they follow a large share of everyone, and
+    the popular users keep coming up) the rest are sampled without
+    replacement, which costs about n for that follower whatever the skew.
+    """
+
+    rng = chunk_rng(options, 'follows', chunk)
+    n = options.users
+    popular = rank_shuffler(n)
+    rows = []
+
+    for follower in range(start + 1, end + 1):
+        count = (options.follows * follower // n
+                 - options.follows * (follower - 1) // n)
+
+        followed = set()
+        draws = 0 if count * 2 <= n - 1 else n
+
+        while len(followed) < count and draws < n:
+            user = popular(power_law_rank(rng, n, options.popularity))
+            draws += 1
+            if user != follower:
+                followed.add(user)
+
+        if len(followed) < count:
+            ranks = (rank for rank in range(1, n + 1)
+                     if popular(rank) != follower
+                     and popular(rank) not in followed)
+            followed.update(popular(rank) for rank in power_law_sample(
+                rng, ranks, options.popularity, count - len(followed)))
+
+        rows.extend([user, follower] for user in sorted(followed))
+
+    return to_csv(rows)
+
+
+def generate(options, pool, make_chunk, parts):
+    """Yield each chunk's CSV text, in order. With a process pool, keeps a
+    few chunks per worker in progress (so finished chunks never pile up)."""
+
+    if pool is None:
+        for part in parts:
+            yield make_chunk(options, *part)
+        return
+
+    running = deque()
+
+    for part in parts:
+        running.append(pool.submit(make_chunk, options, *part))
+
+        if len(running) >= options.workers * 2:
+            yield running.popleft().result()
+
+    while running:
+        yield running.popleft().result()
+
+
+def write_csv(options, pool, name, headers, make_chunk, total, chunk_rows):
+    """Write `name`, generating chunks of `chunk_rows` rows (on `pool`, if
+    given) and writing each as soon as it and those before it are done."""
+
+    path = os.path.join(options.out, name)
+    started = perf_counter()
+
+    with open(path, 'w', newline='') as file:
+        csv.writer(file).writerow(headers)
+
+        for text in generate(options, pool, make_chunk,
+                             chunks(total, chunk_rows)):
+            file.write(text)
+
+    print(f"{path}: {perf_counter() - started:.1f}s")
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--seed', default='warbler',
+                        help="same seed, same data")
+    parser.add_argument('--popularity', type=float, default=1.0,
+                        help="power law exponent for follower counts")
+    parser.add_argument('--activity', type=float, default=0.8,
+                        help="power law exponent for message counts")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2023, 1, 1),
+                        help="messages are from the two years before this")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes to generate rows in")
+    parser.add_argument('--chunk-rows', type=int, default=100_000)
+    parser.add_argument('--out', default='generator',
+                        help="folder to write the CSVs in")
+
+    options = parser.parse_args(args)
+
+    if options.follows > options.users * (options.users - 1):
+        parser.error("more follows than there are pairs of users")
+
+    return options
+
+
+def main(args=None):
+    options = get_options(args)
+    os.makedirs(options.out, exist_ok=True)
+
+    # follows are made a follower at a time: size their chunks to about
+    # --chunk-rows rows
+    per_user = max(1, options.follows // max(options.users, 1))
+    followers_per_chunk = max(1, options.chunk_rows // per_user)
+
+    pool = (ProcessPoolExecutor(options.workers)
+            if options.workers > 1 else None)
+
+    try:
+        write_csv(options, pool, 'users.csv', USERS_CSV_HEADERS,
+                  make_users, options.users, options.chunk_rows)
+        write_csv(options, pool, 'messages.csv', MESSAGES_CSV_HEADERS,
+                  make_messages, options.messages, options.chunk_rows)
+        write_csv(options, pool, 'follows.csv', FOLLOWS_CSV_HEADERS,
+                  make_follows, options.users, followers_per_chunk)
+    finally:
+        if pool:
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,173 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from heapq import nsmallest
+from math import gcd
 
+FIRST_NAMES = [
+    "james", "mary", "robert", "patricia", "john", "jennifer", "michael",
+    "linda", "david", "elizabeth", "william", "barbara", "richard", "susan",
+    "joseph", "jessica", "thomas", "sarah", "chris", "karen", "daniel", "lisa",
+    "matthew", "nancy", "anthony", "betty", "mark", "sandra", "paul", "ashley",
+    "steven", "kim", "andrew", "emily", "kevin", "donna", "brian", "michelle",
+    "george", "carol", "tim", "amanda", "jason", "melissa", "ryan", "deborah",
+]
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+LAST_NAMES = [
+    "smith", "johnson", "williams", "brown", "jones", "garcia", "miller",
+    "davis", "rodriguez", "martinez", "hernandez", "lopez", "gonzalez",
+    "wilson", "anderson", "thomas", "taylor", "moore", "jackson", "martin",
+    "lee", "perez", "thompson", "white", "harris", "sanchez", "clark",
+    "ramirez", "lewis", "robinson", "walker", "young", "allen", "king",
+    "wright", "scott", "torres", "nguyen", "hill", "flores", "green", "adams",
+]
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+EMAIL_DOMAINS = ["gmail.com", "yahoo.com", "hotmail.com", "example.com"]
 
-    return datetime.fromtimestamp(random_timestamp)
+CITIES = [
+    "Springfield", "Riverside", "Fairview", "Franklin", "Greenville",
+    "Bristol", "Clinton", "Georgetown", "Salem", "Madison", "Arlington",
+    "Ashland", "Burlington", "Manchester", "Oxford", "Milton", "Newport",
+    "Dover", "Hudson", "Kingston", "Marion", "Jackson", "Lebanon", "Auburn",
+]
+
+WORDS = """
+    able about above act add after again against age ago agree air all allow
+    also always among amount and animal answer any appear area arm army art
+    ask attack away baby back bad bag ball bank bar base beat beautiful become
+    bed before begin behind believe best better between big bill bit black
+    blood blue board body book born both box boy break bring brother build
+    business buy call camera campaign can car card care carry case catch cause
+    cell center central century certain chair chance change character charge
+    check child choice church citizen city civil claim class clear close coach
+    cold collection college color come common community company compare
+    computer concern condition consider contain continue control cost could
+    country couple course court cover create crime cultural culture cup
+    current customer cut dark data daughter day dead deal death debate decade
+    decide deep defense degree describe design detail develop die difference
+    difficult dinner direction discover discuss disease doctor dog door down
+    draw dream drive drop drug during each early east easy eat economy edge
+    effect effort eight either election else end energy enjoy enough enter
+    entire environment especially establish even evening event ever every
+    evidence exactly example expect experience expert explain eye face fact
+    factor fail fall family far fast father fear federal feel few field fight
+    figure fill film final finally financial find fine finger finish fire firm
+    first fish five floor fly focus follow food foot force foreign forget form
+    former forward four free friend from front full fund future game garden
+    gas general generation get girl give glass goal good government great
+    green ground group grow growth guess gun guy hair half hand hang happen
+    happy hard have head health hear heart heat heavy help her here herself
+    high himself history hit hold home hope hospital hot hotel hour house how
+    however huge human hundred husband idea identify image imagine impact
+    important improve include increase indeed indicate individual industry
+    information inside instead institution interest interesting international
+    interview into investment involve issue item itself job join just keep key
+    kid kill kind kitchen know knowledge land language large last late later
+    laugh law lawyer lay lead leader learn least leave left leg legal less let
+    letter level lie life light like likely line list listen little live local
+    long look lose loss lot love low machine magazine main maintain major make
+    manage manager many market marriage material matter maybe mean measure
+    media medical meet meeting member memory mention message method middle
+    might military million mind minute miss mission model modern moment money
+    month more morning most mother mouth move movement movie much music must
+    myself name nation national natural nature near nearly necessary need
+    network never new news newspaper next nice night none nor north note
+    nothing notice now number occur off offer office officer official often
+    oil old once one only onto open operation opportunity option order
+    organization other others our out outside over own owner page pain
+    painting paper parent part participant particular party pass past patient
+    pattern pay peace people per perform perhaps period person personal phone
+    physical pick picture piece place plan plant play player point police
+    policy political poor popular population position positive possible power
+    practice prepare present president pressure pretty prevent price private
+    probably problem process produce product production professional professor
+    program project property protect prove provide public pull purpose push
+    put quality question quickly quite race radio raise range rate rather
+    reach read ready real reality realize really reason receive recent
+    recently recognize record red reduce reflect region relate relationship
+    religious remain remember remove report represent republican require
+    research resource respond response rest result return reveal rich right
+    rise risk road rock role room rule run safe same save say scene school
+    science scientist score sea season seat second section security see seek
+    seem sell send senior sense series serious serve service set seven several
+    shake share she shoot short shot should shoulder show side sign
+    significant similar simple simply since sing single sister sit site
+    situation six size skill skin small smile social society soldier some
+    somebody someone something sometimes son song soon sort sound source south
+    southern space speak special specific speech spend sport spring staff
+    stage stand standard star start state statement station stay step still
+    stock stop store story strategy street strong structure student study
+    stuff style subject success successful such suddenly suffer suggest summer
+    support sure surface system table take talk task tax teach teacher team
+    technology television tell ten tend term test than thank that their them
+    themselves then theory there these they thing think third this those
+    though thought thousand threat three through throughout throw thus time
+    today together tonight too top total tough toward town trade traditional
+    training travel treat treatment tree trial trip trouble true truth try
+    turn two type under understand unit until upon use usually value various
+    very victim view violence visit voice vote wait walk wall want war watch
+    water way weapon wear week weight well west western what whatever when
+    where whether which while white who whole whom whose why wide wife will
+    win wind window wish with within without woman wonder word work worker
+    world worry would write writer wrong yard yeah year yes yet you young
+    your yourself
+""".split()
+
+
+def get_random_datetime(rng, end, year_gap=2):
+    """Get a random datetime within `year_gap` years before `end`, using the
+    random.Random `rng`."""
+
+    span = end - end.replace(year=end.year - year_gap)
+
+    return end - timedelta(seconds=rng.uniform(0, span.total_seconds()))
+
+
+def get_random_sentence(rng, min_words=4, max_words=20):
+    """Get a random sentence of common English words."""
+
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+
+    return " ".join(words).capitalize() + "."
+
+
+def power_law_rank(rng, n, exponent):
+    """Get a random rank from 1 to n, where rank r comes up in proportion to
+    1 / r ** exponent (so rank 1 most often). Constant time: it inverts the
+    distribution's (continuous) CDF rather than building a table."""
+
+    u = rng.random()
+
+    if exponent == 1:
+        rank = (n + 1) ** u
+    else:
+        a = 1 - exponent
+        rank = (((n + 1) ** a - 1) * u + 1) ** (1 / a)
+
+    return min(int(rank), n)
+
+
+def power_law_sample(rng, ranks, exponent, k):
+    """Get k distinct ranks from `ranks`, weighted as power_law_rank does
+    (1 / r ** exponent), without replacement.
+
+    Each rank gets an exponential key scaled by r ** exponent and the k
+    smallest win (weighted sampling by exponential keys). That's O(len(ranks)
+    log k), whereas drawing ranks and rejecting repeats stalls once k is a
+    large share of them and the popular ones keep coming up."""
+
+    keys = ((rng.expovariate(1) * rank ** exponent, rank) for rank in ranks)
+
+    return [rank for _, rank in nsmallest(k, keys)]
+
+
+def rank_shuffler(n):
+    """Get a function mapping ranks 1..n onto user ids 1..n one-to-one, so the
+    most popular users aren't simply the lowest ids."""
+
+    stride = int(n * 0.618) or 1
+
+    while gcd(stride, n) != 1:
+        stride += 1
+
+    return lambda rank: (rank - 1) * stride % n + 1
@@ -0,0 +1,285 @@
+"""HTTP caching policy for Warbler.
+
+Static files: templates link them with `static_url`, which adds a content
+fingerprint (?v=...), so those URLs can be cached "forever" (immutable);
+a changed file gets a new URL.
+
+Pages: the home timeline, profiles and single messages get weak ETags, so
+a browser refreshing an unchanged page gets a 304 without the page being
+rendered (or most of its data being loaded). Each ETag is built from a few
+cheap values that change whenever the page would (see the *_validators
+functions below), plus the viewer, the template sources and a time bucket
+(pages embed a CSRF token, which expires).
+
+The home timeline's validators include a fingerprint of the page's own
+messages and their authors, so a deleted message or a renamed author
+further down the page changes its ETag too.
+
+Everything else stays `no-store`.
+"""
+
+import hashlib
+import os
+from functools import cache
+from time import time
+
+from flask import abort, current_app, g, request, session, url_for
+from sqlalchemy import exists, func, literal, select, union
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import aliased
+
+from current_user import CurrentUserGone
+from likes import like_buffer
+from models import db, Follows, Like, Message, User
+from pagination import MESSAGES_PER_PAGE, apply_keyset, get_cursor_arg
+from timeline import (fanout_on_read_authors_query, pulled_messages_query,
+                      timeline_query)
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# pages are re-rendered at least this often, so their CSRF tokens stay fresh
+# (flask-wtf's WTF_CSRF_TIME_LIMIT defaults to an hour)
+PAGE_MAX_REUSE_SECONDS = 30 * 60
+
+
+##############################################################################
+# Static files
+
+
+@cache
+def _file_fingerprint(path, mtime):
+    with open(path, 'rb') as file:
+        return hashlib.blake2b(file.read(), digest_size=6).hexdigest()
+
+
+def static_url(filename):
+    """ URL for a static file, fingerprinted with its contents. """
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    return url_for(
+        'static',
+        filename=filename,
+        v=_file_fingerprint(path, os.path.getmtime(path)))
+
+
+##############################################################################
+# ETags for pages
+
+
+@cache
+def _templates_version():
+    """ Fingerprint of every template (so a deploy changes every ETag). """
+
+    digest = hashlib.blake2b(digest_size=6)
+
+    for folder in current_app.jinja_loader.searchpath:
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as file:
+                    digest.update(file.read())
+
+    return digest.hexdigest()
+
+
+def page_etag(*validators):
+    """ Weak ETag (without the W/ and quotes) for the current user's view of
+    a page, given values that change whenever its content does. """
+
+    parts = (
+        _templates_version(),
+        int(time() // PAGE_MAX_REUSE_SECONDS),
+        g.user.id,
+        g.user.username,
+        g.user.image_url,
+        request.full_path,
+    ) + validators
+
+    return hashlib.blake2b(
+        repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def not_modified(*validators):
+    """ 304 response if the client's copy of this page is current, else
+    None (and the page will be sent with an ETag, see `apply_cache_policy`).
+
+    Pages rendered with pending flash messages are never cached: the
+    flashes are consumed by rendering. Nor are pages for users with likes
+    still in the write-behind buffer (the validators can't see those).
+    """
+
+    if session.get('_flashes') or like_buffer.has_pending(g.user.id):
+        return None
+
+    etag = page_etag(*validators)
+    g.etag = etag
+
+    if request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def apply_cache_policy(response):
+    """ Set caching headers on `response` (an after_request hook). """
+
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+
+    elif 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    else:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
+
+    return response
+
+
+##############################################################################
+# Validators: cheap values that change when a page's content does
+
+
+def _last_like_at(user_id):
+    return (select(func.max(Like.timestamp))
+            .where(Like.user_id == user_id)
+            .scalar_subquery())
+
+
+def _home_page_fingerprint(user_id, before):
+    """ Scalar subquery: a hash of the ids and authors (name and avatar) of
+    the messages on `user_id`'s home page starting at `before`, and of the
+    one after them (whether there's a next page).
+
+    Messages can't be edited, so this changes exactly when the page's list
+    does. It reads the same index ranges as the page itself, but not the
+    messages' text.
+    """
+
+    limit = MESSAGES_PER_PAGE + 1
+    columns = (Message.id, Message.timestamp)
+    following = exists().where(Follows.user_following_id == user_id)
+
+    candidates = union(
+        timeline_query(user_id, limit, before, columns).where(following),
+        pulled_messages_query(
+            fanout_on_read_authors_query(user_id), limit, before, columns)
+        .where(following),
+        apply_keyset(select(*columns), Message.timestamp, Message.id, before)
+        .limit(limit)
+        .where(~following),
+    ).subquery()
+
+    page = (select(candidates)
+            .order_by(candidates.c.timestamp.desc(), candidates.c.id.desc())
+            .limit(limit)
+            .subquery())
+
+    return (
+        select(func.md5(func.string_agg(
+            func.concat(Message.id, ':', User.username, ':', User.image_url),
+            aggregate_order_by(
+                literal(','), page.c.timestamp.desc(), page.c.id.desc()))))
+        .select_from(page)
+        .join(Message, Message.id == page.c.id)
+        .join(User, User.id == Message.user_id)
+        .scalar_subquery())
+
+
+def home_validators():
+    """ Values that change when the current user's home timeline page does:
+    their counters and latest like, and the fingerprint of the page's
+    messages (see `_home_page_fingerprint`).
+
+    One query, which also loads the current user's row (the page shows their
+    counters).
+    """
+
+    user = g.user
+
+    row = db.session.execute(
+        select(
+            User,
+            _last_like_at(user.id),
+            _home_page_fingerprint(user.id, get_cursor_arg()))
+        .where(User.id == user.id)).first()
+
+    if row is None:
+        raise CurrentUserGone(user.id)
+
+    viewer = user.model = row[0]
+
+    return (
+        viewer.messages_count,
+        viewer.following_count,
+        viewer.followers_count,
+        viewer.likes_count,
+    ) + tuple(row[1:])
+
+
+def get_profile_or_404(user_id):
+    """ (user, validators) for `user_id`'s profile page, as the current user
+    sees it. The validators change when the page does: the profile's fields
+    and counters, its newest message, and the current user's like count and
+    latest like.
+
+    One query, which also loads the user.
+    """
+
+    viewer = aliased(User)
+
+    viewer_likes_count = (select(viewer.likes_count)
+                          .where(viewer.id == g.user.id)
+                          .scalar_subquery())
+
+    latest_message = (select(Message.id)
+                      .where(Message.user_id == User.id)
+                      .order_by(Message.timestamp.desc(), Message.id.desc())
+                      .limit(1)
+                      .scalar_subquery())
+
+    row = db.session.execute(
+        select(
+            User,
+            viewer_likes_count,
+            _last_like_at(g.user.id),
+            latest_message)
+        .where(User.id == user_id)).first()
+
+    if row is None:
+        abort(404)
+
+    user = row[0]
+
+    return user, (
+        user.username,
+        user.image_url,
+        user.header_image_url,
+        user.bio,
+        user.location,
+        user.messages_count,
+        user.following_count,
+        user.followers_count,
+        user.likes_count,
+    ) + tuple(row[1:])
+
+
+def message_validators(msg, likes):
+    """ Values that change when a single message's page does, given the
+    current user's `likes` among it (no queries). """
+
+    return (
+        msg.text,
+        msg.timestamp,
+        msg.user.username,
+        msg.user.image_url,
+        msg.user.followers_count,
+        msg.id in likes,
+    )
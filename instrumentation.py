@@ -0,0 +1,343 @@
+"""Per-request timing and SQL instrumentation for Warbler.
+
+Every request records (on `g.request_stats`) how many SQL statements it ran
+and for how long, and how long it spent rendering templates and in bcrypt.
+When it's done, that's
+
+- sent back in a `Server-Timing` header (browser dev tools show it),
+- logged as one JSON line on the "warbler.requests" logger, and
+- added to per-route histograms, served in Prometheus' text format by the
+  /metrics view (see `render_metrics`).
+
+Each is a few perf_counter() calls and dict updates per request or
+statement, cheap enough to leave on in production. Histograms live in each
+worker process: Prometheus sees whichever worker answers the scrape, so
+scrape workers individually (or compare rates, not totals) when running
+several.
+
+A sample of requests (QUERY_SAMPLE_RATE) also keep each statement they run,
+for N+1 and slow query detection (see query_analysis.py).
+
+Timing a block of code for a request: `with timed('bcrypt'): ...`.
+"""
+
+import json
+import logging
+import sys
+from bisect import bisect_left
+from contextlib import contextmanager
+from random import random
+from threading import Lock
+from time import perf_counter
+
+from flask import before_render_template, current_app, g, has_app_context
+from flask import request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from query_analysis import DEFAULT_SAMPLE_RATE, analyze_request
+
+logger = logging.getLogger('warbler.requests')
+
+# histogram buckets: request/db/template seconds, and statements per request
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class RequestStats:
+    """ What one request has done so far. """
+
+    __slots__ = ('started', 'statements', 'db_seconds', 'timings',
+                 'statement_log', '_statement_started', '_template_started')
+
+    def __init__(self, sampled=False):
+        self.started = perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.timings = {}
+        # [(statement, seconds), ...] if sampled for query analysis
+        self.statement_log = [] if sampled else None
+        self._statement_started = []
+        self._template_started = []
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+def begin_request():
+    """ Start recording stats for the current request (call first thing,
+    in a before_request hook). """
+
+    rate = current_app.config.get('QUERY_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)
+    g.request_stats = RequestStats(sampled=random() < rate)
+
+
+def current_stats():
+    """ The current request's RequestStats, or None outside a request (CLI
+    commands, background threads). """
+
+    if has_app_context():
+        return g.get('request_stats')
+
+    return None
+
+
+@contextmanager
+def timed(name):
+    """ Add the time spent in the block to the current request's `name`
+    timing (if in a request). """
+
+    started = perf_counter()
+
+    try:
+        yield
+    finally:
+        stats = current_stats()
+
+        if stats is not None:
+            stats.add(name, perf_counter() - started)
+
+
+##############################################################################
+# Recording
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = current_stats()
+
+    if stats is not None:
+        stats._statement_started.append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current_stats()
+
+    if stats is not None and stats._statement_started:
+        seconds = perf_counter() - stats._statement_started.pop()
+        stats.statements += 1
+        stats.db_seconds += seconds
+
+        if stats.statement_log is not None and statement is not None:
+            stats.statement_log.append((statement, seconds))
+
+
+def _handle_error(exception_context):
+    # a failed statement still counts (and after_cursor_execute won't run)
+    _after_cursor_execute(*(None,) * 6)
+
+
+def _before_render_template(sender, template, context, **extra):
+    stats = current_stats()
+
+    if stats is not None:
+        stats._template_started.append(perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    stats = current_stats()
+
+    if stats is not None and stats._template_started:
+        stats.add('template', perf_counter() - stats._template_started.pop())
+
+
+##############################################################################
+# Histograms
+
+
+class Histogram:
+    """ Thread-safe Prometheus-style histogram, with a series per set of
+    label values. """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, label_values, value):
+        """ Count `value` in the series for `label_values` (a tuple, in the
+        order of `labels`). """
+
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(label_values)
+
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        """ This histogram in Prometheus' text format, as a list of lines. """
+
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = sorted(
+                (values, list(counts), total, count)
+                for values, (counts, total, count) in self._series.items())
+
+        for values, counts, total, count in series:
+            labels = ','.join(f'{name}="{value}"'
+                              for name, value in zip(self.labels, values))
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} '
+                             f'{cumulative}')
+
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+
+        return lines
+
+
+ROUTE_LABELS = ('route', 'method')
+
+request_seconds = Histogram(
+    'warbler_request_seconds',
+    "Time to handle a request.",
+    ROUTE_LABELS + ('status',), SECONDS_BUCKETS)
+
+db_seconds = Histogram(
+    'warbler_request_db_seconds',
+    "Time a request spent running SQL.",
+    ROUTE_LABELS, SECONDS_BUCKETS)
+
+db_statements = Histogram(
+    'warbler_request_db_statements',
+    "SQL statements a request ran.",
+    ROUTE_LABELS, STATEMENT_BUCKETS)
+
+template_seconds = Histogram(
+    'warbler_request_template_seconds',
+    "Time a request spent rendering templates.",
+    ROUTE_LABELS, SECONDS_BUCKETS)
+
+bcrypt_seconds = Histogram(
+    'warbler_request_bcrypt_seconds',
+    "Time a request spent hashing/checking passwords (including waiting "
+    "for the password pool).",
+    ROUTE_LABELS, SECONDS_BUCKETS)
+
+HISTOGRAMS = (request_seconds, db_seconds, db_statements, template_seconds,
+              bcrypt_seconds)
+
+
+def render_metrics(values):
+    """ Every histogram, plus `values` ({name: (description, value)}), in
+    Prometheus' text format. Names ending in _total are counters, the rest
+    gauges. """
+
+    lines = []
+
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    for name, (description, value) in sorted(values.items()):
+        kind = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+##############################################################################
+# Reporting (after each request)
+
+
+def server_timing(stats, total):
+    """ Server-Timing header value for a request's `stats`. """
+
+    parts = [f'db;desc="SQL ({stats.statements})";'
+             f'dur={stats.db_seconds * 1000:.2f}']
+
+    for name, seconds in stats.timings.items():
+        parts.append(f'{name};dur={seconds * 1000:.2f}')
+
+    parts.append(f'total;dur={total * 1000:.2f}')
+
+    return ', '.join(parts)
+
+
+def finish_request(response):
+    """ Report the current request's stats: Server-Timing header, log line
+    and histograms (an after_request hook). """
+
+    stats = g.pop('request_stats', None)
+
+    if stats is None:
+        return response
+
+    total = perf_counter() - stats.started
+
+    # route patterns, not paths, so the number of series stays bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (route, request.method)
+
+    request_seconds.observe(labels + (str(response.status_code),), total)
+    db_seconds.observe(labels, stats.db_seconds)
+    db_statements.observe(labels, stats.statements)
+    template_seconds.observe(labels, stats.timings.get('template', 0.0))
+
+    if 'bcrypt' in stats.timings:
+        bcrypt_seconds.observe(labels, stats.timings['bcrypt'])
+
+    response.headers['Server-Timing'] = server_timing(stats, total)
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'ms': round(total * 1000, 2),
+            'db_statements': stats.statements,
+            'db_ms': round(stats.db_seconds * 1000, 2),
+            **{f'{name}_ms': round(seconds * 1000, 2)
+               for name, seconds in stats.timings.items()},
+        }))
+
+    if stats.statement_log:
+        analyze_request(current_app.config, request.method, request.path,
+                        route, stats.statement_log)
+
+    return response
+
+
+def instrument_app(app):
+    """ Instrument `app`'s requests. `begin_request` must be called at the
+    start of each (see app.reset_g). Logs request lines to stderr if
+    app.config['REQUEST_LOG'] is set. """
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    app.after_request(finish_request)
+
+    if app.config.get('REQUEST_LOG') and not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
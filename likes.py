@@ -0,0 +1,452 @@
+"""Liking and unliking messages for Warbler.
+
+Likes are set, not toggled: `set_likes` takes the messages a user wants
+liked and the ones they want unliked, and makes it so with one INSERT and
+one DELETE, however many messages are involved. Repeating a request changes
+nothing (so clients can safely retry, and coalesce clicks).
+
+Write-behind mode (LIKES_WRITE_BEHIND): views call `apply_likes` instead,
+which only records what each user wants in this worker's `like_buffer` and
+returns; repeated clicks on the same message collapse to the last one. A
+background thread writes everything buffered to the likes table in one
+transaction every LIKES_FLUSH_INTERVAL seconds, or sooner once
+LIKES_FLUSH_SIZE likes are waiting, and once more when the process exits.
+The thread starts with the first buffered like, in the process that
+buffered it (so in each forked worker, not a `gunicorn --preload` master).
+
+Reads of a user's own like state go through the buffer too (see
+`LikeBuffer.overlay`), so they see their clicks right away. The buffer is
+per process, though, and another process couldn't see it: its pages would
+show likes flipping back until the flush, and its ETags (see
+http_caching.py) could promise them unchanged. So write-behind mode only
+runs with a single worker process (WEB_CONCURRENCY=1, with as many threads
+as you like); the user's likes_count and liked-messages list catch up at the
+next flush.
+"""
+
+import atexit
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from sqlalchemy import (DateTime, Integer, column, delete, literal, select,
+                        tuple_, values)
+from sqlalchemy.dialects.postgresql import insert
+
+from counters import record_likes
+from models import db, Like, Message, User
+
+logger = logging.getLogger(__name__)
+
+# most message ids one request may like/unlike
+MAX_LIKES_BATCH = 100
+
+# write-behind defaults: flush at least this often (seconds), or as soon as
+# this many likes/unlikes are waiting
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_FLUSH_SIZE = 500
+
+
+def parse_likes_request(data):
+    """ (like_ids, unlike_ids) from an API request body like {"like":
+    [message ids], "unlike": [message ids]}. Raises ValueError, with a
+    message for the client, if it isn't one. """
+
+    if not isinstance(data, dict):
+        data = {}
+
+    like_ids = data.get('like', [])
+    unlike_ids = data.get('unlike', [])
+
+    if not (isinstance(like_ids, list) and isinstance(unlike_ids, list)
+            and all(type(id) is int for id in like_ids + unlike_ids)):
+        raise ValueError("Expected lists of message ids.")
+
+    like_ids = set(like_ids)
+    unlike_ids = set(unlike_ids)
+
+    if like_ids & unlike_ids:
+        raise ValueError("Can't like and unlike the same message.")
+
+    if len(like_ids) + len(unlike_ids) > MAX_LIKES_BATCH:
+        raise ValueError(f"At most {MAX_LIKES_BATCH} messages at a time.")
+
+    return like_ids, unlike_ids
+
+
+def like_states(like_ids, unlike_ids, liked):
+    """ {"<message id>": liked?} for an API response: the messages asked
+    about, given the ids among `like_ids` now `liked`. """
+
+    return {
+        **{str(id): id in liked for id in like_ids},
+        **{str(id): False for id in unlike_ids},
+    }
+
+
+def set_likes(user_id, like_ids=(), unlike_ids=(), session=None):
+    """ Make `user_id` like every message in `like_ids` and none in
+    `unlike_ids`. Unknown message ids are ignored.
+
+    Returns (liked, unliked): the ids whose state actually changed.
+    Keeps the user's likes_count in step; the caller commits. Runs in
+    `session` (default db.session).
+    """
+
+    session = session or db.session
+    liked = set()
+    unliked = set()
+
+    if like_ids:
+        now = datetime.utcnow()
+
+        liked = set(session.scalars(
+            insert(Like)
+            .from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                select(literal(user_id), Message.id, literal(now))
+                .where(Message.id.in_(like_ids)))
+            .on_conflict_do_nothing()
+            .returning(Like.message_id)))
+
+    if unlike_ids:
+        unliked = set(session.scalars(
+            delete(Like)
+            .where(Like.user_id == user_id)
+            .where(Like.message_id.in_(unlike_ids))
+            .returning(Like.message_id)))
+
+    if len(liked) != len(unliked):
+        record_likes(user_id, len(liked) - len(unliked), session)
+
+    return liked, unliked
+
+
+def write_likes(ops):
+    """ Apply many users' likes at once: `ops` maps (user_id, message_id) to
+    (liked, when). One INSERT and one DELETE for the lot, plus a counter
+    update per user whose likes_count changed. Likes of messages or by users
+    that no longer exist are dropped. The caller commits.
+    """
+
+    changed = Counter()
+    to_like = [(user_id, message_id, when)
+               for (user_id, message_id), (liked, when) in ops.items()
+               if liked]
+    to_unlike = [key for key, (liked, _) in ops.items() if not liked]
+
+    if to_like:
+        wanted = values(
+            column('user_id', Integer),
+            column('message_id', Integer),
+            column('timestamp', DateTime),
+            name='wanted').data(to_like)
+
+        changed.update(db.session.scalars(
+            insert(Like)
+            .from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                select(wanted)
+                .join(Message, Message.id == wanted.c.message_id)
+                .join(User, User.id == wanted.c.user_id))
+            .on_conflict_do_nothing()
+            .returning(Like.user_id)))
+
+    if to_unlike:
+        changed.subtract(db.session.scalars(
+            delete(Like)
+            .where(tuple_(Like.user_id, Like.message_id).in_(to_unlike))
+            .returning(Like.user_id)))
+
+    for user_id, delta in changed.items():
+        if delta:
+            record_likes(user_id, delta)
+
+
+class LikeBufferUnavailable(Exception):
+    """ Write-behind mode was asked for with several worker processes. """
+
+
+class LikeBuffer:
+    """ This worker's buffered likes/unlikes, waiting to be written.
+
+    Holds user_id -> {message_id: (liked, when)}: only the last thing each
+    user asked for each message. Thread-safe. Does nothing (and `enabled` is
+    False) until `start`ed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.flush_size = DEFAULT_FLUSH_SIZE
+
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.last_flush_seconds = 0.0
+
+        self._pending = {}
+        self._pending_count = 0
+        self._flushing = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wake = Event()
+        self._stopping = Event()
+        self._thread = None
+        self._thread_pid = None
+
+    def start(self, app):
+        """ Buffer likes for `app` from now on, flushing on a background
+        thread (started on first use) and at exit. Reads
+        LIKES_FLUSH_INTERVAL and LIKES_FLUSH_SIZE from its config.
+
+        Raises LikeBufferUnavailable if the app runs several worker processes
+        (WEB_CONCURRENCY).
+        """
+
+        if app.config.get('WEB_CONCURRENCY', 1) > 1:
+            raise LikeBufferUnavailable(
+                "LIKES_WRITE_BEHIND needs a single worker process "
+                "(WEB_CONCURRENCY=1): other processes can't see its buffer")
+
+        self.app = app
+        self.flush_interval = app.config.get(
+            'LIKES_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        self.flush_size = app.config.get(
+            'LIKES_FLUSH_SIZE', DEFAULT_FLUSH_SIZE)
+        self.enabled = True
+
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Stop buffering: write out everything waiting, and stop the
+        background thread. """
+
+        if not self.enabled:
+            return
+
+        self.enabled = False
+
+        with self._lock:
+            thread = self._thread if self._thread_pid == os.getpid() else None
+            self._thread = self._thread_pid = None
+
+        if thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            thread.join()
+
+        self.flush()
+
+        atexit.unregister(self.stop)
+
+    def add(self, user_id, like_ids=(), unlike_ids=()):
+        """ Buffer `user_id` liking `like_ids` and unliking `unlike_ids`. """
+
+        now = datetime.utcnow()
+
+        with self._lock:
+            self._start_flusher()
+            wanted = self._pending.setdefault(user_id, {})
+            before = len(wanted)
+
+            for message_id in like_ids:
+                wanted[message_id] = (True, now)
+
+            for message_id in unlike_ids:
+                wanted[message_id] = (False, now)
+
+            self._pending_count += len(wanted) - before
+            full = self._pending_count >= self.flush_size
+
+        if full:
+            self._wake.set()
+
+    def pending_for(self, user_id):
+        """ {message_id: liked} for everything `user_id` has buffered (and
+        not yet written). """
+
+        with self._lock:
+            return {message_id: liked
+                    for source in (self._flushing, self._pending)
+                    for message_id, (liked, _)
+                    in source.get(user_id, {}).items()}
+
+    def has_pending(self, user_id):
+        """ Has `user_id` got likes/unlikes not yet written? """
+
+        with self._lock:
+            return user_id in self._pending or user_id in self._flushing
+
+    def overlay(self, user_id, message_ids, liked):
+        """ `liked` (the ids among `message_ids` that the database says
+        `user_id` likes), updated with their buffered likes/unlikes. """
+
+        with self._lock:
+            for source in (self._flushing, self._pending):
+                for message_id, (is_liked, _) in source.get(
+                        user_id, {}).items():
+                    if message_id not in message_ids:
+                        continue
+                    if is_liked:
+                        liked.add(message_id)
+                    else:
+                        liked.discard(message_id)
+
+        return liked
+
+    def flush(self):
+        """ Write everything buffered so far, in one transaction. Returns how
+        many likes/unlikes were written.
+
+        If writing fails, the batch goes back in the buffer (behind anything
+        newer for the same messages) to be retried at the next flush.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                batch = self._flushing = self._pending
+                self._pending = {}
+                self._pending_count = 0
+
+            if not batch:
+                return 0
+
+            ops = {(user_id, message_id): op
+                   for user_id, wanted in batch.items()
+                   for message_id, op in wanted.items()}
+            started = monotonic()
+
+            try:
+                with self.app.app_context():
+                    write_likes(ops)
+                    db.session.commit()
+
+            except Exception:
+                logger.exception("writing %d buffered likes failed", len(ops))
+
+                with self._lock:
+                    for user_id, wanted in batch.items():
+                        newer = self._pending.setdefault(user_id, {})
+                        for message_id, op in wanted.items():
+                            if message_id not in newer:
+                                newer[message_id] = op
+                                self._pending_count += 1
+                    self._flushing = {}
+                    self.failures += 1
+
+                return 0
+
+            with self._lock:
+                self._flushing = {}
+                self.flushes += 1
+                self.flushed += len(ops)
+                self.last_flush_seconds = monotonic() - started
+
+            return len(ops)
+
+    def stats(self):
+        """ Buffered-but-unwritten likes/unlikes (`pending`, including any
+        being written right now) and flush counts, as a dict. """
+
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'pending': self._pending_count + sum(
+                    len(wanted) for wanted in self._flushing.values()),
+                'flushes': self.flushes,
+                'flushed': self.flushed,
+                'failures': self.failures,
+                'last_flush_seconds': self.last_flush_seconds,
+                'flush_interval': self.flush_interval,
+                'flush_size': self.flush_size,
+            }
+
+    def _start_flusher(self):
+        # this process's thread, if it hasn't one yet (a forked worker
+        # doesn't inherit its parent's); call holding self._lock
+        if self._thread_pid == os.getpid():
+            return
+
+        self._stopping.clear()
+        self._thread = Thread(
+            target=self._run, name='like-buffer-flusher', daemon=True)
+        self._thread.start()
+        self._thread_pid = os.getpid()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+            if not self._stopping.is_set():
+                self.flush()
+
+
+like_buffer = LikeBuffer()
+
+
+def _liked_ids_among(user_id, message_ids, session=None):
+    return set((session or db.session).scalars(
+        select(Like.message_id)
+        .where(Like.user_id == user_id)
+        .where(Like.message_id.in_(message_ids))))
+
+
+def get_liked_ids_among(user_id, message_ids, session=None):
+    """ Which of `message_ids` does `user_id` like, counting likes/unlikes
+    still in the buffer? """
+
+    liked = _liked_ids_among(user_id, message_ids, session)
+
+    return like_buffer.overlay(user_id, set(message_ids), liked)
+
+
+def apply_likes(user_id, like_ids=(), unlike_ids=(), session=None):
+    """ `set_likes`, or in write-behind mode, buffer them. The caller
+    commits. """
+
+    if like_buffer.enabled:
+        like_buffer.add(user_id, like_ids, unlike_ids)
+    else:
+        set_likes(user_id, like_ids, unlike_ids, session)
+
+
+def get_likes_count(user, session=None):
+    """ `user`'s likes_count, counting likes/unlikes still in the buffer. """
+
+    count = user.likes_count
+    pending = like_buffer.pending_for(user.id)
+
+    if pending:
+        stored = _liked_ids_among(user.id, pending, session)
+        count += sum(liked - (message_id in stored)
+                     for message_id, liked in pending.items())
+
+    return count
+
+
+def toggle_like(user_id, message_id):
+    """ Like `message_id` for `user_id` if they don't already, else unlike
+    it. Returns True if it is now liked (never, for a message that doesn't
+    exist). The caller commits. """
+
+    if like_buffer.enabled:
+        if message_id in get_liked_ids_among(user_id, [message_id]):
+            like_buffer.add(user_id, unlike_ids=[message_id])
+            return False
+
+        like_buffer.add(user_id, like_ids=[message_id])
+        return True
+
+    _, unliked = set_likes(user_id, unlike_ids=[message_id])
+
+    if unliked:
+        return False
+
+    liked, _ = set_likes(user_id, like_ids=[message_id])
+    return bool(liked)
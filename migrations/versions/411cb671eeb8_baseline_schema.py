@@ -0,0 +1,68 @@
+"""baseline schema
+
+The schema seed.py used to create with db.create_all(). Databases created
+that way can be brought under migrations with `flask db stamp 411cb671eeb8`
+followed by `flask db upgrade`.
+
+Revision ID: 411cb671eeb8
+Revises:
+Create Date: 2026-10-18 06:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '411cb671eeb8'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.Text(), nullable=False),
+    sa.Column('username', sa.Text(), nullable=False),
+    sa.Column('image_url', sa.Text(), nullable=True),
+    sa.Column('header_image_url', sa.Text(), nullable=True),
+    sa.Column('bio', sa.Text(), nullable=True),
+    sa.Column('location', sa.Text(), nullable=True),
+    sa.Column('password', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email'),
+    sa.UniqueConstraint('username')
+    )
+
+    op.create_table('follows',
+    sa.Column('user_being_followed_id', sa.Integer(), nullable=False),
+    sa.Column('user_following_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_being_followed_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_following_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_being_followed_id', 'user_following_id')
+    )
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('text', sa.String(length=140), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    op.create_table('likes',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+
+
+def downgrade():
+    op.drop_table('likes')
+    op.drop_table('messages')
+    op.drop_table('follows')
+    op.drop_table('users')
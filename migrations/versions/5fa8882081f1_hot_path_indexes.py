@@ -0,0 +1,73 @@
+"""hot path indexes
+
+Secondary indexes for the query shapes in app.py that otherwise fall back
+to sequential scans:
+
+- follows(user_following_id, ...): "who does X follow" (the primary key
+  only covers "who follows X")
+- likes(message_id) and timelines(message_id): the ON DELETE CASCADE when a
+  message is deleted
+- users.username trigram (pg_trgm, GIN): `username LIKE '%q%'` search
+- users(id) WHERE fanout_on_read: the fan-out-on-read authors a timeline
+  read merges in
+
+Built CONCURRENTLY so upgrading a live database doesn't lock writes.
+
+Revision ID: 5fa8882081f1
+Revises: e854a224c372
+Create Date: 2026-10-18 06:22:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5fa8882081f1'
+down_revision = 'e854a224c372'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_follows_user_following_id', 'follows',
+            ['user_following_id', 'user_being_followed_id'],
+            unique=False, postgresql_concurrently=True)
+        op.create_index(
+            'ix_likes_message_id', 'likes', ['message_id'],
+            unique=False, postgresql_concurrently=True)
+        op.create_index(
+            'ix_timelines_message_id', 'timelines', ['message_id'],
+            unique=False, postgresql_concurrently=True)
+        op.create_index(
+            'ix_users_username_trgm', 'users', ['username'],
+            unique=False, postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+            postgresql_concurrently=True)
+        op.create_index(
+            'ix_users_fanout_on_read', 'users', ['id'],
+            unique=False, postgresql_where=sa.text('fanout_on_read'),
+            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_users_fanout_on_read', table_name='users',
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_users_username_trgm', table_name='users',
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_timelines_message_id', table_name='timelines',
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_likes_message_id', table_name='likes',
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_follows_user_following_id', table_name='follows',
+            postgresql_concurrently=True)
@@ -0,0 +1,56 @@
+"""user search indexes
+
+Replaces the username-only trigram GIN index with the two indexes user
+search reads from:
+
+- lower(username) COLLATE "C" (btree): username prefix matches, read in
+  order with a LIMIT
+- trigram GiST over username, bio and location: fuzzy matches, read
+  nearest first (KNN) with a LIMIT
+
+Built CONCURRENTLY so upgrading a live database doesn't lock writes.
+
+Revision ID: a3c9d2f1b7e4
+Revises: 5fa8882081f1
+Create Date: 2026-10-18 07:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c9d2f1b7e4'
+down_revision = '5fa8882081f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_users_username_prefix', 'users',
+            [sa.text('(lower(username) COLLATE "C")')],
+            unique=False, postgresql_concurrently=True)
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_users_search_trgm ON users "
+            "USING gist ((username || ' ' || coalesce(bio, '') || ' ' "
+            "|| coalesce(location, '')) gist_trgm_ops)")
+        op.drop_index(
+            'ix_users_username_trgm', table_name='users',
+            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_users_username_trgm', 'users', ['username'],
+            unique=False, postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_users_search_trgm', table_name='users',
+            postgresql_concurrently=True)
+        op.drop_index(
+            'ix_users_username_prefix', table_name='users',
+            postgresql_concurrently=True)
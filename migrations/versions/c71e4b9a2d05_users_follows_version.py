@@ -0,0 +1,31 @@
+"""users.follows_version
+
+A counter bumped whenever a user's follows or followers change, so cached
+copies of their follow sets (see follow_graph.py) can tell they're stale.
+
+Revision ID: c71e4b9a2d05
+Revises: a3c9d2f1b7e4
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71e4b9a2d05'
+down_revision = 'a3c9d2f1b7e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column(
+            'follows_version', sa.Integer(), nullable=False,
+            server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('follows_version')
@@ -0,0 +1,94 @@
+"""timelines, counters and keyset indexes
+
+Adds the precomputed timelines table, the users counter columns and
+fanout_on_read flag, likes.timestamp, and the (.., timestamp, id) indexes
+used for keyset pagination. Counters are filled in here; timelines are not
+(run `flask backfill-timelines` after upgrading).
+
+Revision ID: e854a224c372
+Revises: 411cb671eeb8
+Create Date: 2026-10-18 06:21:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e854a224c372'
+down_revision = '411cb671eeb8'
+branch_labels = None
+depends_on = None
+
+COUNTERS = ['messages_count', 'following_count', 'followers_count',
+            'likes_count']
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        for counter in COUNTERS:
+            batch_op.add_column(sa.Column(
+                counter, sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column(
+            'fanout_on_read', sa.Boolean(), nullable=False,
+            server_default=sa.false()))
+
+    op.execute("""
+        UPDATE users SET
+            messages_count = (SELECT count(*) FROM messages
+                              WHERE messages.user_id = users.id),
+            following_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_following_id = users.id),
+            followers_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_being_followed_id = users.id),
+            likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.user_id = users.id)
+    """)
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column(
+            'timestamp', sa.DateTime(), nullable=False,
+            server_default=sa.func.now()))
+        batch_op.create_index(
+            'ix_likes_user_id_timestamp',
+            ['user_id', 'timestamp', 'message_id'], unique=False)
+
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_messages_timestamp', ['timestamp', 'id'], unique=False)
+        batch_op.create_index(
+            'ix_messages_user_id_timestamp',
+            ['user_id', 'timestamp', 'id'], unique=False)
+
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    with op.batch_alter_table('timelines', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_timelines_user_id_timestamp',
+            ['user_id', 'timestamp', 'message_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('timelines', schema=None) as batch_op:
+        batch_op.drop_index('ix_timelines_user_id_timestamp')
+
+    op.drop_table('timelines')
+
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.drop_index('ix_messages_user_id_timestamp')
+        batch_op.drop_index('ix_messages_timestamp')
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_likes_user_id_timestamp')
+        batch_op.drop_column('timestamp')
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('fanout_on_read')
+        for counter in reversed(COUNTERS):
+            batch_op.drop_column(counter)
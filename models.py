@@ -2,11 +2,15 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
+from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hash_password, check_password, needs_rehash
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+migrate = Migrate()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
@@ -17,6 +21,12 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -29,12 +39,29 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (primary key lookup)"""
+
+        return db.session.scalar(
+            db.select(
+                db.select(cls)
+                .where(cls.user_being_followed_id == followed_id)
+                .where(cls.user_following_id == follower_id)
+                .exists()))
+
 
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
+    __table_args__ = (
+        # the (few) users whose messages are fanned out on read
+        db.Index('ix_users_fanout_on_read', 'id',
+                 postgresql_where=db.text('fanout_on_read')),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -75,6 +102,53 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counters, kept in step by the routes (see counters.py)
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped whenever the user's follows or followers change, so cached
+    # follow sets can tell they're stale (see follow_graph.py)
+    follows_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set once the user has more followers than TIMELINE_FANOUT_LIMIT; their
+    # messages are then merged into timelines at read time (see timeline.py)
+    fanout_on_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -101,7 +175,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -123,13 +197,18 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the user's hash was made at a different cost than the configured
+        one, it is replaced with a new one (the caller should commit).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
                 return user
 
         return False
@@ -137,16 +216,65 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(
+            follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(
+            follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set of ids, answered with a single query.
+        """
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id)
+            .where(Follows.user_being_followed_id.in_(user_ids))))
+
+    def serialize(self):
+        """ Serializes user's public profile for jsonification. """
+
+        return {
+            "id": self.id,
+            "username": self.username,
+            "image_url": self.image_url,
+            "header_image_url": self.header_image_url,
+            "bio": self.bio,
+            "location": self.location,
+            "messages_count": self.messages_count,
+            "following_count": self.following_count,
+            "followers_count": self.followers_count,
+            "likes_count": self.likes_count,
+        }
+
+
+# User search (see search.py): username prefix matches come off a C-collated
+# btree, so they are index-ordered; fuzzy matches over username, bio and
+# location use pg_trgm word similarity and nearest-neighbour ordering (GiST).
+
+USERNAME_PREFIX_KEY = db.func.lower(User.username).collate('C')
+
+USER_SEARCH_DOCUMENT = (
+    User.username
+    + ' ' + db.func.coalesce(User.bio, '')
+    + ' ' + db.func.coalesce(User.location, ''))
+
+db.Index('ix_users_username_prefix', USERNAME_PREFIX_KEY)
+
+db.Index(
+    'ix_users_search_trgm',
+    USER_SEARCH_DOCUMENT.label('search_document'),
+    postgresql_using='gist',
+    postgresql_ops={'search_document': 'gist_trgm_ops'},
+)
 
 
 class Message(db.Model):
@@ -154,6 +282,11 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_timestamp', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -186,11 +319,50 @@ class Message(db.Model):
             "user_id": self.user_id,
         }
 
+class TimelineEntry(db.Model):
+    """ Precomputed home timeline row: `message_id` shows up in the home
+    feed of `user_id`. Filled on write (see timeline.py). """
+
+    __tablename__ = 'timelines'
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # for the ON DELETE CASCADE when a message is deleted
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # copy of messages.timestamp so the feed can be read straight off the
+    # (user_id, timestamp) index without touching messages first
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
 class Like(db.Model):
     """ Join table containg which messages have been liked by which users. """
 
     __tablename__ = 'likes'
 
+    __table_args__ = (
+        db.Index('ix_likes_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -203,7 +375,25 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # when the like happened; liked messages are listed newest like first
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+
+
 
+# the user search index needs pg_trgm (db.create_all() in the tests;
+# migrations create it themselves)
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'),
+)
 
 
 def connect_db(app):
@@ -215,3 +405,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    migrate.init_app(app, db)
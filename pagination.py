@@ -0,0 +1,88 @@
+"""Keyset (cursor) pagination for Warbler message lists.
+
+Pages are ordered newest first by (timestamp, id). The cursor handed to the
+client encodes the key of the last row on the page; the next page starts
+strictly below it, so every page is one index range scan no matter how far
+back the user has scrolled (no OFFSET).
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import tuple_
+
+MESSAGES_PER_PAGE = 50
+CURSOR_ARG = 'before'
+
+
+def encode_cursor(timestamp, id):
+    """ Opaque cursor string for the key (timestamp, id). """
+
+    raw = f"{timestamp.isoformat()}|{id}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ Inverse of encode_cursor. Raises ValueError for a bad cursor. """
+
+    padded = cursor + '=' * (-len(cursor) % 4)
+    raw = urlsafe_b64decode(padded.encode()).decode()
+    timestamp, id = raw.split('|')
+
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+def get_cursor_arg():
+    """ Decoded cursor from the querystring, or None for the first page.
+
+    Aborts with 400 if the cursor can't be decoded.
+    """
+
+    cursor = request.args.get(CURSOR_ARG)
+
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def message_key(msg):
+    """ Sort key of a message: (timestamp, id). """
+
+    return (msg.timestamp, msg.id)
+
+
+def apply_keyset(query, timestamp_col, id_col, before):
+    """ Order `query` newest first on (timestamp_col, id_col), starting
+    strictly below the `before` key if given. """
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < before)
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def split_page(rows, per_page, key=message_key):
+    """ Split `rows` (fetched with a limit of per_page + 1) into the page
+    itself and the cursor for the next page (None on the last page). """
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    rows = rows[:per_page]
+    return rows, encode_cursor(*key(rows[-1]))
+
+
+def paginate(query, timestamp_col, id_col, before,
+             per_page=MESSAGES_PER_PAGE, key=message_key):
+    """ Fetch one page of `query`. Returns (rows, next_cursor). """
+
+    rows = (apply_keyset(query, timestamp_col, id_col, before)
+            .limit(per_page + 1)
+            .all())
+
+    return split_page(rows, per_page, key)
@@ -0,0 +1,164 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow (~250ms of CPU at cost 12). Run on request
+threads, a burst of logins can keep every core busy and starve everything
+else. So hashing and checking run on a small dedicated thread pool instead
+(bcrypt releases the GIL while it works):
+
+- at most PASSWORD_POOL_WORKERS passwords are hashed at once, per process
+- at most PASSWORD_POOL_QUEUE_DEPTH more can wait for a worker; past that,
+  `PasswordPoolBusy` is raised right away (the app turns it into a 503)
+  rather than piling up requests behind the pool
+
+Each request waits for its own hash, so a process never has more hashes in
+flight than it has request threads. Unless set, the two sizes come from
+WEB_THREADS (threads per worker process, as `gunicorn --threads`): password
+work may take up to half of them, leaving the rest for other pages. So the
+503s only ever happen with threaded (gthread) or async workers; a sync
+worker serves one request at a time, and never has a second hash waiting.
+
+The work factor is BCRYPT_LOG_ROUNDS. When it changes, existing hashes are
+upgraded the next time their user logs in (see `needs_rehash`).
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+from instrumentation import timed
+
+bcrypt = Bcrypt()
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when the password pool's queue is full."""
+
+
+class PasswordPool:
+    """ A bounded thread pool for password hashing.
+
+    Holds up to `workers` running jobs plus `queue_depth` waiting ones;
+    `run` raises PasswordPoolBusy instead of queueing more than that.
+    """
+
+    def __init__(self, workers, queue_depth):
+        self.workers = workers
+        self.queue_depth = queue_depth
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='passwords')
+        self._slots = BoundedSemaphore(workers + queue_depth)
+        self._lock = Lock()
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, fn, *args):
+        """ Call fn(*args) on the pool and wait for the result. """
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordPoolBusy()
+
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def stats(self):
+        """ Pool size, queue depth and counts, as a dict. """
+
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'running': min(self.in_flight, self.workers),
+                'queued': max(self.in_flight - self.workers, 0),
+                'peak_queued': max(self.peak_in_flight - self.workers, 0),
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def default_pool_size(threads, cpus=None):
+    """ (workers, queue_depth) for a process with `threads` request threads:
+    half of them (at least one) may use the pool, running on up to `cpus`
+    (default: the CPU count) at once. """
+
+    slots = max(math.ceil(threads / 2), 1)
+    workers = min(slots, cpus or os.cpu_count() or 2)
+
+    return workers, slots - workers
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_password_pool():
+    """ This process's PasswordPool, sized from the app config
+    (PASSWORD_POOL_WORKERS, PASSWORD_POOL_QUEUE_DEPTH, or else WEB_THREADS;
+    see default_pool_size). """
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            config = current_app.config
+            workers, queue_depth = default_pool_size(
+                config.get('WEB_THREADS', 1))
+            _pool = PasswordPool(
+                config.get('PASSWORD_POOL_WORKERS', workers),
+                config.get('PASSWORD_POOL_QUEUE_DEPTH', queue_depth))
+
+        return _pool
+
+
+def get_log_rounds():
+    """ bcrypt work factor for new hashes (BCRYPT_LOG_ROUNDS). """
+
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(password):
+    """ bcrypt hash of `password` at the configured cost, as a str. """
+
+    with timed('bcrypt'):
+        hashed = get_password_pool().run(
+            bcrypt.generate_password_hash, password, get_log_rounds())
+
+    return hashed.decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """ Does `password` match the bcrypt hash `hashed`? """
+
+    with timed('bcrypt'):
+        return get_password_pool().run(
+            bcrypt.check_password_hash, hashed, password)
+
+
+def needs_rehash(hashed):
+    """ Was `hashed` made at a different cost than the configured one? """
+
+    # bcrypt hashes look like $2b$<cost>$<salt and hash>
+    return int(hashed.split('$')[2]) != get_log_rounds()
@@ -0,0 +1,189 @@
+"""Slow-query and N+1 detection for Warbler.
+
+A sample of requests (QUERY_SAMPLE_RATE, see instrumentation.py) keep every
+SQL statement they run, with its duration. After the response, each
+statement is reduced to a fingerprint (its shape, with values, parameters
+and IN lists replaced by ?), and:
+
+- a fingerprint run N_PLUS_ONE_THRESHOLD or more times in the request is
+  an N+1 (e.g. a lazy `msg.user` load per message in a list),
+- a statement taking SLOW_QUERY_MS or longer is slow,
+
+and both are logged as warnings on the "warbler.queries" logger. Every
+sampled statement also goes into `query_report`, which totals them by
+route and fingerprint; /metrics/queries ranks those by total time, so the
+most expensive shapes (a slow query, or a fast one run too often) come
+first.
+
+Like the rest of the instrumentation, the report is per worker process.
+"""
+
+import hashlib
+import json
+import logging
+import re
+from collections import Counter
+from threading import Lock
+
+logger = logging.getLogger('warbler.queries')
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_SLOW_QUERY_MS = 100
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+# (route, fingerprint) pairs kept in the report; past this, new ones are
+# counted in `dropped` instead
+MAX_REPORT_ENTRIES = 1000
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PARAMETER = re.compile(r"%\(\w+\)s|%s|\$\d+|(?<![:\w]):\w+")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(statement):
+    """ `statement` with literals and parameters replaced by ?, IN and
+    VALUES lists of any length by (...), and whitespace collapsed. """
+
+    statement = _STRING.sub('?', statement)
+    statement = _PARAMETER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _IN_LIST.sub('IN (...)', statement)
+    statement = _LIST.sub('(...)', statement)
+    statement = _ROWS.sub('(...)', statement)
+
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+def fingerprint(normalized):
+    """ Short id for a normalized statement. """
+
+    return hashlib.blake2b(normalized.encode(), digest_size=6).hexdigest()
+
+
+class QueryReport:
+    """ Thread-safe totals per (route, statement fingerprint). """
+
+    def __init__(self, max_entries=MAX_REPORT_ENTRIES):
+        self.max_entries = max_entries
+        self.requests = Counter()
+        self.dropped = 0
+        self._entries = {}
+        self._lock = Lock()
+
+    def add_request(self, route, statements, slow_seconds, n_plus_one):
+        """ Add one sampled request's `statements` ([(sql, seconds), ...]).
+        Returns (repeated, slow): fingerprints run `n_plus_one` or more
+        times, as {fingerprint: (normalized sql, count)}, and the statements
+        taking `slow_seconds` or longer, as [(fingerprint, sql, seconds)].
+        """
+
+        shapes = {}
+        slow = []
+
+        for statement, seconds in statements:
+            normalized = normalize(statement)
+            key = fingerprint(normalized)
+            shape = shapes.setdefault(key, [normalized, 0, 0.0, 0.0, 0])
+            shape[1] += 1
+            shape[2] += seconds
+            shape[3] = max(shape[3], seconds)
+
+            if seconds >= slow_seconds:
+                shape[4] += 1
+                slow.append((key, normalized, seconds))
+
+        repeated = {key: (shape[0], shape[1])
+                    for key, shape in shapes.items() if shape[1] >= n_plus_one}
+
+        with self._lock:
+            self.requests[route] += 1
+
+            for key, (normalized, count, total, longest, slow_count) in (
+                    shapes.items()):
+                entry = self._entries.get((route, key))
+
+                if entry is None:
+                    if len(self._entries) >= self.max_entries:
+                        self.dropped += 1
+                        continue
+
+                    entry = self._entries[(route, key)] = {
+                        'route': route,
+                        'fingerprint': key,
+                        'sql': normalized,
+                        'executions': 0,
+                        'total_seconds': 0.0,
+                        'max_seconds': 0.0,
+                        'requests': 0,
+                        'max_per_request': 0,
+                        'n_plus_one_requests': 0,
+                        'slow': 0,
+                    }
+
+                entry['executions'] += count
+                entry['total_seconds'] += total
+                entry['max_seconds'] = max(entry['max_seconds'], longest)
+                entry['requests'] += 1
+                entry['max_per_request'] = max(
+                    entry['max_per_request'], count)
+                entry['n_plus_one_requests'] += key in repeated
+                entry['slow'] += slow_count
+
+        return repeated, slow
+
+    def ranked(self, limit=None):
+        """ Entries, most total time first. """
+
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+
+        entries.sort(key=lambda entry: entry['total_seconds'], reverse=True)
+
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.requests.clear()
+            self.dropped = 0
+
+
+query_report = QueryReport()
+
+
+def analyze_request(config, method, path, route, statements):
+    """ Record a sampled request's statements in `query_report`, and log its
+    N+1s and slow statements. """
+
+    slow_seconds = config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS) / 1000
+    n_plus_one = config.get(
+        'N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+
+    repeated, slow = query_report.add_request(
+        route, statements, slow_seconds, n_plus_one)
+
+    for key, (normalized, count) in repeated.items():
+        logger.warning(json.dumps({
+            'problem': 'n_plus_one',
+            'method': method,
+            'path': path,
+            'route': route,
+            'fingerprint': key,
+            'count': count,
+            'sql': normalized,
+        }))
+
+    for key, normalized, seconds in slow:
+        logger.warning(json.dumps({
+            'problem': 'slow_query',
+            'method': method,
+            'path': path,
+            'route': route,
+            'fingerprint': key,
+            'ms': round(seconds * 1000, 2),
+            'sql': normalized,
+        }))
@@ -0,0 +1,145 @@
+"""Read replica routing for Warbler.
+
+With replicas configured (REPLICA_DATABASE_URIS; DATABASE_REPLICA_URLS in
+the environment), GET requests for views marked `@replica_reads` run their
+reads on a replica, picked at random per request. Everything else uses the
+primary:
+
+- other methods, and views that aren't marked;
+- any write (a flush, or an insert/update/delete statement), and every
+  statement after it in that request;
+- the requests right after a write by the same browser: a request that
+  might have written (not GET/HEAD) stores a "primary until" time, now +
+  REPLICA_PIN_SECONDS, in the session, so the page it redirects to shows
+  the change even if the replicas haven't caught up yet. Make that longer
+  than the replicas' usual lag.
+
+Replica connections are pooled with the same SQLALCHEMY_ENGINE_OPTIONS as
+the primary. After a request that used one, the session is closed, so
+objects read from a replica aren't reused by later requests.
+"""
+
+import random
+from threading import Lock
+from time import time
+
+from flask import current_app, g, has_app_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+PIN_KEY = 'primary_until'
+DEFAULT_PIN_SECONDS = 5
+READ_METHODS = ('GET', 'HEAD')
+
+_engines_lock = Lock()
+
+
+def replica_reads(view):
+    """ Mark `view` as only reading, so its GETs may use a replica. """
+
+    view.replica_reads = True
+
+    return view
+
+
+def get_replica_engines(app):
+    """ Engines for `app`'s replicas (made on first use), or []. """
+
+    uris = tuple(app.config.get('REPLICA_DATABASE_URIS') or ())
+    state = app.extensions.get('replicas')
+
+    if state is not None and state[0] == uris:
+        return state[1]
+
+    with _engines_lock:
+        state = app.extensions.get('replicas')
+
+        if state is None or state[0] != uris:
+            if state is not None:
+                for engine in state[1]:
+                    engine.dispose()
+
+            options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+            engines = [create_engine(uri, **options) for uri in uris]
+            state = app.extensions['replicas'] = (uris, engines)
+
+    return state[1]
+
+
+def current_replica():
+    """ The engine the current request reads from, or None for the
+    primary. """
+
+    if has_app_context():
+        return g.get('replica')
+
+    return None
+
+
+def use_primary():
+    """ Run the rest of the current request's statements on the primary
+    (e.g. after writing something it's about to read). """
+
+    if has_app_context():
+        g.replica = None
+
+
+def route_request():
+    """ Choose where the current request reads from (call at the start of
+    each, after `g` is reset). """
+
+    g.replica = None
+
+    if request.method not in READ_METHODS:
+        return
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    if not getattr(view, 'replica_reads', False):
+        return
+
+    if session.get(PIN_KEY, 0) > time():
+        return
+
+    engines = get_replica_engines(current_app)
+
+    if engines:
+        g.replica = random.choice(engines)
+
+
+class RoutingSession(Session):
+    """ Session that runs reads on the current request's replica, if it has
+    one. """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = current_replica() if bind is None else None
+
+        if replica is not None:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                use_primary()
+            else:
+                g.used_replica = True
+                return replica
+
+        return super().get_bind(
+            mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_replicas(app, db):
+    """ Pin sessions to the primary after writes, and release replica
+    connections after each request. `route_request` must be called at the
+    start of each (see app.reset_g). """
+
+    @app.after_request
+    def pin_to_primary(response):
+        if (request.method not in READ_METHODS
+                and get_replica_engines(app)):
+            session[PIN_KEY] = time() + app.config.get(
+                'REPLICA_PIN_SECONDS', DEFAULT_PIN_SECONDS)
+
+        return response
+
+    @app.teardown_request
+    def release_replica(exception):
+        if g.pop('used_replica', False):
+            db.session.close()
@@ -0,0 +1,152 @@
+"""User search for Warbler.
+
+Results are ranked in two tiers:
+
+1. users whose username starts with the query, alphabetically (read off the
+   ix_users_username_prefix btree, in index order)
+2. for queries of 3+ characters, users whose username, bio or location
+   contains something close to the query, nearest first (pg_trgm word
+   similarity, read off the ix_users_search_trgm GiST index)
+
+Both tiers are read with a LIMIT straight off an index, and pages are capped
+at MAX_SEARCH_PAGE, so the cost of a search is bounded by the page depth,
+not by the number of users. Result ids are cached per worker for a short
+while, since the same prefixes get typed over and over.
+"""
+
+from sqlalchemy import literal, select
+from sqlalchemy.sql.elements import Grouping
+
+from caching import TTLCache
+from models import db, User, USERNAME_PREFIX_KEY, USER_SEARCH_DOCUMENT
+
+SEARCH_PAGE_SIZE = 24
+MAX_SEARCH_PAGE = 20
+TYPEAHEAD_LIMIT = 10
+
+# shortest query worth a trigram (fuzzy) search
+MIN_FUZZY_LENGTH = 3
+
+SEARCH_CACHE_SIZE = 2048
+SEARCH_CACHE_TTL = 30
+
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+
+def normalize_query(q):
+    """ Canonical form of a search query (also the cache key). """
+
+    return ' '.join(q.lower().split())
+
+
+def _escape_like(text):
+    """ Escape LIKE wildcards in user input. """
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _prefix_match_ids(q, limit):
+    """ Ids of users whose username starts with `q`, alphabetically. """
+
+    return db.session.scalars(
+        select(User.id)
+        .where(USERNAME_PREFIX_KEY.like(_escape_like(q) + '%', escape='\\'))
+        .order_by(USERNAME_PREFIX_KEY)
+        .limit(limit)).all()
+
+
+def _fuzzy_match_ids(q, limit):
+    """ Ids of users with a username/bio/location word similar to `q`,
+    closest first. """
+
+    query = literal(q)
+    # <% and || bind equally tightly in Postgres, so group the document
+    document = Grouping(USER_SEARCH_DOCUMENT)
+
+    return db.session.scalars(
+        select(User.id)
+        .where(query.op('<%')(document))
+        .order_by(query.op('<<->')(document), User.id)
+        .limit(limit)).all()
+
+
+def ranked_user_ids(q, limit):
+    """ The first `limit` user ids matching `q`, best match first. """
+
+    key = (q, limit)
+    ids = search_cache.get(key)
+
+    if ids is None:
+        ids = _prefix_match_ids(q, limit)
+
+        if len(ids) < limit and len(q) >= MIN_FUZZY_LENGTH:
+            seen = set(ids)
+            ids += [
+                id for id in _fuzzy_match_ids(q, limit)
+                if id not in seen
+            ][:limit - len(ids)]
+
+        search_cache.set(key, ids)
+
+    return ids
+
+
+def _load_users(ids):
+    """ Users for `ids`, in the same order. """
+
+    if not ids:
+        return []
+
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+    return [users[id] for id in ids if id in users]
+
+
+def search_users(q, page=1, per_page=SEARCH_PAGE_SIZE):
+    """ One page of users matching `q`. Returns (users, has_next_page).
+
+    `page` is clamped to 1..MAX_SEARCH_PAGE.
+    """
+
+    q = normalize_query(q)
+    page = min(max(page, 1), MAX_SEARCH_PAGE)
+
+    ids = ranked_user_ids(q, page * per_page + 1)
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    has_next = len(ids) > page * per_page and page < MAX_SEARCH_PAGE
+
+    return _load_users(page_ids), has_next
+
+
+def typeahead(q, limit=TYPEAHEAD_LIMIT):
+    """ Up to `limit` (capped at TYPEAHEAD_LIMIT) best matches for `q`, as
+    small dicts for JSON. """
+
+    limit = min(max(limit, 1), TYPEAHEAD_LIMIT)
+    users = _load_users(ranked_user_ids(normalize_query(q), limit))
+
+    return [
+        {"id": user.id, "username": user.username,
+         "image_url": user.image_url}
+        for user in users
+    ]
+
+
+def list_users_page(after_id=None, per_page=SEARCH_PAGE_SIZE):
+    """ One page of all users by id, for browsing without a query.
+    Returns (users, next_after_id). """
+
+    query = User.query.order_by(User.id)
+
+    if after_id:
+        query = query.filter(User.id > after_id)
+
+    users = query.limit(per_page + 1).all()
+
+    if len(users) <= per_page:
+        return users, None
+
+    users = users[:per_page]
+    return users, users[-1].id
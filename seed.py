@@ -1,19 +1,42 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python3 seed.py [CSV directory]     (default: generator/)
+
+The CSVs are bulk loaded (see bulk_load.py), so this also works for
+production-sized data sets.
+"""
+
+import sys
+
+from flask_migrate import upgrade
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from bulk_load import load_csvs, deferred_indexes
+from timeline import backfill_timelines
+from counters import reconcile_counters
+
+
+def seed_database(directory='generator', report=print):
+    """ Rebuild the database with the migrations, and load the CSVs in
+    `directory` into it. """
+
+    # start from an empty database, with the schema built by the migrations
+    db.drop_all()
+    db.session.execute(db.text('DROP TABLE IF EXISTS alembic_version'))
+    db.session.commit()
+    upgrade()
+
+    load_csvs(directory, report=report)
+    db.session.commit()
 
-db.drop_all()
-db.create_all()
+    reconcile_counters()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    # the timelines are built in one go too: index them afterwards
+    with deferred_indexes(['timelines'], report=report):
+        backfill_timelines()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.commit()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    seed_database(*sys.argv[1:2])
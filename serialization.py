@@ -0,0 +1,177 @@
+"""Serializing messages and users for Warbler's JSON APIs.
+
+The APIs don't need Message/User objects, just a few columns, so they
+select those (MESSAGE_COLUMNS, USER_COLUMNS) and get rows back, skipping
+ORM identity-map and attribute bookkeeping. `message_data` turns rows into
+MessageData, a plain named tuple; `serialize_messages` turns a list of
+those (or of Messages, or rows) into dicts in one pass, with the same keys
+as `Message.serialize()`.
+
+Responses (`encode`) are JSON, with timestamps as RFC 822 dates like
+Flask's jsonify, or MessagePack for clients that send `Accept:
+application/msgpack` (internal consumers), with timestamps as MessagePack
+timestamps. orjson, if installed, encodes the JSON (set JSON_BACKEND=json
+to use the standard library's instead); msgpack is needed for MessagePack,
+otherwise those requests get JSON.
+"""
+
+import json
+from datetime import datetime, timezone
+from operator import attrgetter
+from typing import NamedTuple, Optional
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from models import Message, User
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class MessageData(NamedTuple):
+    """ A message's public fields (as Message.serialize()). """
+
+    id: int
+    text: str
+    timestamp: datetime
+    user_id: int
+
+
+class UserData(NamedTuple):
+    """ A user's public profile fields (as User.serialize()). """
+
+    id: int
+    username: str
+    image_url: Optional[str]
+    header_image_url: Optional[str]
+    bio: Optional[str]
+    location: Optional[str]
+    messages_count: int
+    following_count: int
+    followers_count: int
+    likes_count: int
+
+
+MESSAGE_COLUMNS = tuple(
+    getattr(Message, name) for name in MessageData._fields)
+USER_COLUMNS = tuple(getattr(User, name) for name in UserData._fields)
+
+_message_fields = attrgetter(*MessageData._fields)
+_user_fields = attrgetter(*UserData._fields)
+
+
+def message_data(rows):
+    """ MessageData for each of `rows` (selected with MESSAGE_COLUMNS first;
+    any further columns are dropped). """
+
+    size = len(MessageData._fields)
+
+    return [MessageData._make(row[:size]) for row in rows]
+
+
+def serialize_message(msg):
+    """ Dict for one message (a Message, row or MessageData). """
+
+    return dict(zip(MessageData._fields, _message_fields(msg)))
+
+
+def serialize_messages(messages):
+    """ Dicts for a list of messages (Messages, rows or MessageData). """
+
+    fields = MessageData._fields
+
+    return [dict(zip(fields, values))
+            for values in map(_message_fields, messages)]
+
+
+def serialize_user(user):
+    """ Dict for one user's public profile (a User, row or UserData). """
+
+    return dict(zip(UserData._fields, _user_fields(user)))
+
+
+##############################################################################
+# Encoding
+
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+           'Oct', 'Nov', 'Dec')
+
+
+def format_http_date(value):
+    """ `value` as werkzeug's http_date (which Flask's jsonify uses) would
+    write it, in half the time. Naive datetimes are UTC. """
+
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+
+    return (f"{_WEEKDAYS[value.weekday()]}, {value.day:02d} "
+            f"{_MONTHS[value.month - 1]} {value.year:04d} "
+            f"{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return format_http_date(value)
+
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+def _msgpack_default(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+
+        return msgpack.Timestamp.from_datetime(value)
+
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+def dumps_json(data, backend='orjson'):
+    """ `data` as JSON bytes, with orjson if `backend` is 'orjson' and it's
+    installed. """
+
+    if backend == 'orjson' and orjson is not None:
+        return orjson.dumps(data, default=_json_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    return json.dumps(data, default=_json_default,
+                      separators=(',', ':')).encode()
+
+
+def dumps_msgpack(data):
+    """ `data` as MessagePack bytes. """
+
+    return msgpack.packb(data, default=_msgpack_default)
+
+
+def negotiate(accept):
+    """ Mimetype to respond with, given an Accept header: MessagePack if
+    it's preferred (and available), else JSON. """
+
+    if msgpack is None or not accept:
+        return JSON_MIMETYPE
+
+    return parse_accept_header(accept, MIMEAccept).best_match(
+        (JSON_MIMETYPE,) + MSGPACK_MIMETYPES, JSON_MIMETYPE)
+
+
+def encode(data, mimetype, backend='orjson'):
+    """ `data` as bytes of `mimetype` (from `negotiate`). """
+
+    if mimetype in MSGPACK_MIMETYPES:
+        return dumps_msgpack(data)
+
+    return dumps_json(data, backend)
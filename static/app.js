@@ -4,21 +4,116 @@ const API_ENDPOINT_URL = "http://localhost:5001/api";
 const $messagesList = $("#messages");
 const mytoken = "{{ csrf_token() }}";
 
+// star clicks less than this far apart are sent together, in one request
+const LIKES_FLUSH_DELAY_MS = 300;
+
+// message id -> should it end up liked? (for clicks not sent yet)
+const pendingLikes = new Map();
+// message id -> is it liked, as the server last told us? (for clicked stars)
+const serverLikes = new Map();
+let likesFlushTimer = null;
+
 $messagesList.on("click", ".messages-like", handleStarClick)
 
-async function handleStarClick(event) {
+/** Flip the star right away, and queue the like/unlike to be sent. */
+
+function handleStarClick(event) {
     event.preventDefault();
 
-    const $star = $(event.target)
-    const message_id = $star.closest("li").attr("id");
+    const $message = $(event.target).closest("li");
+    const $star = $message.find(".messages-like i");
+    const messageId = Number($message.attr("id"));
 
-    const response = await axios({
-        url: `${API_ENDPOINT_URL}/messages/${message_id}/likes`,
-        method: "POST",
-        data: {
-            csrf_token: mytoken
-        }
-    })
+    if (!serverLikes.has(messageId)) {
+        serverLikes.set(messageId, $star.hasClass("bi-star-fill"));
+    }
 
     $star.toggleClass("bi-star").toggleClass("bi-star-fill")
-}
\ No newline at end of file
+    pendingLikes.set(messageId, $star.hasClass("bi-star-fill"));
+
+    clearTimeout(likesFlushTimer);
+    likesFlushTimer = setTimeout(sendPendingLikes, LIKES_FLUSH_DELAY_MS);
+}
+
+/** Send every queued like/unlike in one request, then show the stars as
+ * the server has them (unless they've been clicked again since). If the
+ * request fails, the stars go back to how the server last had them. */
+
+async function sendPendingLikes() {
+    const like = [];
+    const unlike = [];
+
+    for (const [messageId, liked] of pendingLikes) {
+        (liked ? like : unlike).push(messageId);
+    }
+    pendingLikes.clear();
+
+    let likes;
+
+    try {
+        const response = await axios({
+            url: `${API_ENDPOINT_URL}/likes`,
+            method: "POST",
+            data: {
+                like,
+                unlike,
+                csrf_token: mytoken
+            }
+        })
+        likes = response.data.likes;
+    } catch (error) {
+        console.error("couldn't save likes", error);
+        likes = {};
+
+        for (const messageId of [...like, ...unlike]) {
+            likes[messageId] = serverLikes.get(messageId);
+        }
+    }
+
+    for (const [messageId, liked] of Object.entries(likes)) {
+        serverLikes.set(Number(messageId), liked);
+
+        if (pendingLikes.has(Number(messageId))) continue;
+
+        showLiked(messageId, liked);
+    }
+}
+
+/** Show the star of message `messageId` as (un)liked. */
+
+function showLiked(messageId, liked) {
+    $messagesList
+        .find(`li[id="${messageId}"] .messages-like i`)
+        .toggleClass("bi-star-fill", liked)
+        .toggleClass("bi-star", !liked)
+}
+
+/** On the first page of the home timeline, add new messages by people we
+ * follow as they're posted (see streams.py). */
+
+const timelineStreamUrl = $messagesList.data("stream");
+
+if (timelineStreamUrl && window.EventSource) {
+    const timelineStream = new EventSource(timelineStreamUrl);
+
+    timelineStream.addEventListener("message", function (event) {
+        const message = JSON.parse(event.data);
+
+        if (!$messagesList.find(`li[id="${message.id}"]`).length) {
+            $messagesList.prepend(message.html);
+        }
+    });
+
+    timelineStream.addEventListener("delete", function (event) {
+        $messagesList.find(`li[id="${JSON.parse(event.data).id}"]`).remove();
+    });
+
+    // some messages didn't make it to us: offer to reload
+    timelineStream.addEventListener("reset", function () {
+        if ($("#new-warbles").length) return;
+
+        $messagesList.before(
+            '<a href="/" class="btn btn-outline-primary mb-2" id="new-warbles">' +
+            'New warbles</a>');
+    });
+}
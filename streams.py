@@ -0,0 +1,409 @@
+"""Live timeline updates for Warbler (server-sent events).
+
+Instead of refreshing the homepage to look for new messages, a browser keeps
+/api/stream/timeline open (see asgi.py) and gets each new message by
+someone it follows as it's committed, with its <li> already rendered.
+
+Views publish events (`publish_message`, `publish_follow`, ...) in the
+transaction that makes the change; they're delivered if it commits. The
+`broker` in each process hands events to that process's open streams, each
+of which only subscribes to the authors its user follows (and themselves).
+
+How events get from the process that commits them to the broker is
+pluggable (STREAM_TRANSPORT):
+
+- "local": straight to this process's broker, after the commit. Enough when
+  one process serves both the pages and the streams (`uvicorn asgi:app`
+  with one worker).
+- "postgres": NOTIFY on the warbler_events channel, sent with the
+  transaction, so any process can publish. Each process serving streams
+  LISTENs on its own connection (STREAM_LISTEN_URL, default DATABASE_URL;
+  it must be a direct connection, not through PgBouncer in transaction
+  mode).
+
+Unset, nothing is published and pages don't open streams.
+
+Each stream buffers at most STREAM_BUFFER_SIZE events for a slow client;
+past that it drops them and tells the client it missed some (a "reset"
+event), as it does after a reconnect when newer messages came in meanwhile.
+Idle streams send a comment every STREAM_HEARTBEAT seconds so proxies keep
+them open, and close after STREAM_TIMEOUT seconds (browsers reconnect by
+themselves).
+"""
+
+import asyncio
+import json
+import logging
+import select as select_module
+from collections import defaultdict
+from threading import Event, Lock, Thread
+
+import psycopg2
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from fragments import LIKE_BUTTON, LIST_ITEM, render_message_body
+from models import db
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'warbler_events'
+
+DEFAULT_BUFFER_SIZE = 100
+DEFAULT_HEARTBEAT = 15
+DEFAULT_TIMEOUT = 300
+
+# session.info key for events waiting on a commit (local transport)
+PENDING_KEY = 'stream_events'
+
+# seconds between attempts to reconnect the LISTEN connection
+RECONNECT_DELAY = 1
+
+# how long browsers wait before reconnecting a closed stream
+RETRY_MS = 3000
+
+
+class Subscription:
+    """ One open stream: `user_id`'s queue of events from the authors they
+    follow. Filled from any thread, read in the stream's event loop. """
+
+    def __init__(self, user_id, author_ids, max_events, loop):
+        self.user_id = user_id
+        self.author_ids = set(author_ids) | {user_id}
+        self.max_events = max_events
+        self.missed = False
+        self._events = []
+        self._ready = asyncio.Event()
+        self._loop = loop
+
+    def put(self, event):
+        """ Queue `event` (thread-safe). """
+
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the stream's loop has closed
+            pass
+
+    def mark_missed(self):
+        """ Tell the client it may have missed events (thread-safe). """
+
+        self.put(None)
+
+    def _put(self, event):
+        if event is None or len(self._events) >= self.max_events:
+            self.missed = True
+        else:
+            self._events.append(event)
+
+        self._ready.set()
+
+    async def get(self, timeout):
+        """ The events queued since the last call, waiting up to `timeout`
+        seconds for one ([] if none came). """
+
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        self._ready.clear()
+        events, self._events = self._events, []
+
+        return events
+
+
+class Broker:
+    """ This process's open streams, by the authors they follow. """
+
+    def __init__(self):
+        self._by_author = defaultdict(set)
+        self._by_user = defaultdict(set)
+        self._lock = Lock()
+        self.dispatched = 0
+        self.delivered = 0
+
+    def subscribe(self, subscription):
+        with self._lock:
+            self._by_user[subscription.user_id].add(subscription)
+
+            for author_id in subscription.author_ids:
+                self._by_author[author_id].add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._discard(self._by_user, subscription.user_id, subscription)
+
+            for author_id in subscription.author_ids:
+                self._discard(self._by_author, author_id, subscription)
+
+    def dispatch(self, event):
+        """ Hand `event` (from a transport) to the streams it's for. """
+
+        with self._lock:
+            if event['type'] == 'follow':
+                self._follow(event)
+                return
+
+            subscriptions = list(self._by_author.get(event['user_id'], ()))
+            self.dispatched += 1
+            self.delivered += len(subscriptions)
+
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def mark_all_missed(self):
+        """ Tell every stream it may have missed events. """
+
+        with self._lock:
+            subscriptions = [subscription
+                             for subscriptions in self._by_user.values()
+                             for subscription in subscriptions]
+
+        for subscription in subscriptions:
+            subscription.mark_missed()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': sum(map(len, self._by_user.values())),
+                'dispatched': self.dispatched,
+                'delivered': self.delivered,
+            }
+
+    def _follow(self, event):
+        author_id = event['author_id']
+
+        for subscription in self._by_user.get(event['user_id'], ()):
+            if author_id == subscription.user_id:
+                continue
+
+            if event['following']:
+                subscription.author_ids.add(author_id)
+                self._by_author[author_id].add(subscription)
+            else:
+                subscription.author_ids.discard(author_id)
+                self._discard(self._by_author, author_id, subscription)
+
+    @staticmethod
+    def _discard(index, key, subscription):
+        subscriptions = index.get(key)
+
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+
+            if not subscriptions:
+                del index[key]
+
+
+broker = Broker()
+
+
+##############################################################################
+# Transports
+
+
+class LocalTransport:
+    """ Delivers events to this process's broker when the session that
+    published them commits. """
+
+    def publish(self, session, event):
+        session.info.setdefault(PENDING_KEY, []).append(event)
+
+    def start(self, broker):
+        pass
+
+    def stop(self):
+        pass
+
+
+@event.listens_for(Session, 'after_commit')
+def _deliver_pending(session):
+    for pending in session.info.pop(PENDING_KEY, ()):
+        broker.dispatch(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+class PostgresTransport:
+    """ Sends events with NOTIFY (so they're delivered on commit, to every
+    process listening), and listens for them on a thread of its own. """
+
+    def __init__(self, listen_url):
+        self.dsn = make_url(listen_url).set(
+            drivername='postgresql').render_as_string(hide_password=False)
+        self._stop = Event()
+        self._thread = None
+
+    def publish(self, session, event):
+        session.execute(select(func.pg_notify(CHANNEL, json.dumps(event))))
+
+    def start(self, broker):
+        """ Start passing notifications to `broker`. """
+
+        self._stop.clear()
+        self._thread = Thread(target=self._run, args=(broker,),
+                              name='stream-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, broker):
+        connected_before = False
+
+        while not self._stop.is_set():
+            connection = None
+
+            try:
+                connection = psycopg2.connect(self.dsn)
+                connection.autocommit = True
+                connection.cursor().execute(f"LISTEN {CHANNEL}")
+
+                # anything sent while we weren't listening is lost
+                if connected_before:
+                    broker.mark_all_missed()
+                connected_before = True
+
+                self._listen(connection, broker)
+            except psycopg2.Error:
+                logger.exception("stream listener lost its connection")
+                self._stop.wait(RECONNECT_DELAY)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _listen(self, connection, broker):
+        while not self._stop.is_set():
+            if not select_module.select([connection], [], [], 1)[0]:
+                continue
+
+            connection.poll()
+
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+
+                try:
+                    broker.dispatch(json.loads(notify.payload))
+                except (ValueError, KeyError):
+                    logger.warning("bad stream event: %r", notify.payload)
+
+
+def get_transport(app):
+    """ `app`'s transport (see STREAM_TRANSPORT), or None if streams are
+    off. """
+
+    name = app.config.get('STREAM_TRANSPORT')
+
+    if not name:
+        return None
+
+    transports = app.extensions.setdefault('stream_transports', {})
+
+    if name not in transports:
+        if name == 'local':
+            transports[name] = LocalTransport()
+        elif name == 'postgres':
+            transports[name] = PostgresTransport(
+                app.config.get('STREAM_LISTEN_URL')
+                or app.config['SQLALCHEMY_DATABASE_URI'])
+        else:
+            raise ValueError(f"Unknown STREAM_TRANSPORT: {name}")
+
+    return transports[name]
+
+
+##############################################################################
+# Publishing (call before committing)
+
+
+def publish(event):
+    transport = get_transport(current_app)
+
+    if transport is not None:
+        transport.publish(db.session, event)
+
+
+def publish_message(msg):
+    """ `msg` was posted. Call after it's flushed. """
+
+    publish({
+        'type': 'message',
+        'id': msg.id,
+        'user_id': msg.user_id,
+        'body': str(render_message_body(msg)),
+    })
+
+
+def publish_message_deleted(msg):
+    publish({'type': 'delete', 'id': msg.id, 'user_id': msg.user_id})
+
+
+def publish_follow(user_id, author_id, following=True):
+    """ `user_id` started (or stopped) following `author_id`. """
+
+    publish({
+        'type': 'follow',
+        'user_id': user_id,
+        'author_id': author_id,
+        'following': following,
+    })
+
+
+##############################################################################
+# The event stream
+
+
+def format_event(event, user_id):
+    """ `event` as a server-sent event for `user_id`'s stream. Messages come
+    as their <li>, with a like star unless they're the user's own. """
+
+    if event['type'] != 'message':
+        return (f"event: {event['type']}\n"
+                f"data: {json.dumps({'id': event['id']})}\n\n")
+
+    buttons = '' if event['user_id'] == user_id else LIKE_BUTTON
+    data = {
+        'id': event['id'],
+        'user_id': event['user_id'],
+        'html': str(LIST_ITEM.format(
+            event['id'], Markup(event['body']), buttons)),
+    }
+
+    return f"id: {event['id']}\nevent: message\ndata: {json.dumps(data)}\n\n"
+
+
+async def event_stream(subscription, heartbeat, timeout):
+    """ The text of a stream for `subscription` (subscribed to `broker`;
+    unsubscribed when it ends): its events as they come, a comment every
+    `heartbeat` seconds without any, for `timeout` seconds. """
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+
+        while (remaining := deadline - loop.time()) > 0:
+            events = await subscription.get(min(heartbeat, remaining))
+
+            if subscription.missed:
+                subscription.missed = False
+                yield "event: reset\ndata: {}\n\n"
+            elif not events:
+                yield ": heartbeat\n\n"
+
+            for item in events:
+                yield format_event(item, subscription.user_id)
+    finally:
+        broker.unsubscribe(subscription)
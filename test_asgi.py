@@ -0,0 +1,189 @@
+"""Async API (/api/v2) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import os
+from unittest import TestCase
+
+from starlette.testclient import TestClient
+
+from models import db, User, Message, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from asgi import app as asgi_app
+from passwords import default_pool_size
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def session_cookie(user_id):
+    """ A Flask session cookie value signing in `user_id`. """
+
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+class AsgiTestCase(TestCase):
+    """ Test cases for the async API, and the Flask app mounted under it. """
+
+    def setUp(self):
+        """ Set up for async API tests: u1 follows u2, who has posted. """
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        reset_caches()
+
+        with app.test_client() as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u2_id
+
+            c.post('/messages/new', data={'text': 'hello'})
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+        self.message_id = Message.query.filter_by(text='hello').one().id
+
+        # entering runs the app's startup (and exiting its shutdown)
+        self.client = self.enterContext(TestClient(asgi_app))
+
+
+    def tearDown(self):
+        """ Tear down for async API tests. """
+
+        db.session.rollback()
+
+
+    def sign_in(self, user_id):
+        self.client.cookies.set(
+            app.config['SESSION_COOKIE_NAME'], session_cookie(user_id))
+
+
+    def test_feed(self):
+        """ Test the feed matches the Flask API's timeline. """
+
+        self.sign_in(self.u1_id)
+
+        resp = self.client.get('/api/v2/feed')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [msg['text'] for msg in resp.json()['messages']], ['hello'])
+        self.assertIsNone(resp.json()['next'])
+
+        with app.test_client() as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            self.assertEqual(resp.json(), c.get('/api/timeline').json)
+
+
+    def test_unauthorized(self):
+        """ Test the API needs a signed in user. """
+
+        resp = self.client.get('/api/v2/feed')
+        self.assertEqual(resp.status_code, 401)
+
+        self.client.cookies.set(app.config['SESSION_COOKIE_NAME'], 'forged')
+        resp = self.client.get('/api/v2/feed')
+        self.assertEqual(resp.status_code, 401)
+
+
+    def test_user_detail(self):
+        """ Test a user's profile and messages. """
+
+        self.sign_in(self.u1_id)
+
+        resp = self.client.get(f'/api/v2/users/{self.u2_id}')
+        data = resp.json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['user']['username'], 'u2')
+        self.assertEqual(data['user']['followers_count'], 1)
+        self.assertEqual([msg['id'] for msg in data['messages']],
+                         [self.message_id])
+
+        resp = self.client.get('/api/v2/users/0')
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(
+            f'/api/v2/users/{self.u2_id}', params={'before': '%%%'})
+        self.assertEqual(resp.status_code, 400)
+
+
+    def test_likes(self):
+        """ Test liking, and listing liked messages. """
+
+        self.sign_in(self.u1_id)
+
+        resp = self.client.post(
+            '/api/v2/likes', json={'like': [self.message_id, 0]})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {
+            'likes': {str(self.message_id): True, '0': False},
+            'likes_count': 1,
+        })
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+        resp = self.client.get('/api/v2/likes')
+        self.assertEqual([msg['id'] for msg in resp.json()['messages']],
+                         [self.message_id])
+
+        resp = self.client.post(
+            '/api/v2/likes', json={'unlike': [self.message_id]})
+        self.assertEqual(resp.json()['likes_count'], 0)
+
+        resp = self.client.post(
+            '/api/v2/likes', json={'like': [1], 'unlike': [1]})
+        self.assertEqual(resp.status_code, 400)
+
+        # only JSON is read (as /api/likes), so a form changes nothing
+        resp = self.client.post(
+            '/api/v2/likes', data={'like': str(self.message_id)})
+        self.assertEqual(resp.json(), {'likes': {}, 'likes_count': 0})
+
+
+    def test_flask_mounted(self):
+        """ Test the rest of the site is served by the Flask app. """
+
+        self.sign_in(self.u1_id)
+
+        resp = self.client.get(f'/users/{self.u2_id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('hello', resp.text)
+
+
+    def test_flask_threads(self):
+        """ Test the password pool is sized for the threads running Flask
+        views, so concurrent logins don't get a 503 by default. """
+
+        self.assertEqual(app.config['WEB_THREADS'],
+                         int(os.environ.get('WEB_THREADS', 10)))
+        self.assertGreater(
+            sum(default_pool_size(app.config['WEB_THREADS'])), 1)
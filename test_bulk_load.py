@@ -0,0 +1,148 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Follows, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from bulk_load import load_csvs
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+USERS_CSV = """\
+id,email,username,image_url,password,bio,header_image_url,location
+1,a@email.com,alice,/a.png,$2b$12$x,"likes, commas",/h.png,Here
+2,b@email.com,bob,/b.png,$2b$12$x,,/h.png,There
+3,c@email.com,carol,/c.png,$2b$12$x,,/h.png,
+"""
+
+MESSAGES_CSV = '''\
+text,timestamp,user_id
+first,2020-01-01 10:00:00,1
+"quoted ""text""",2020-01-02 10:00:00,2
+third,2020-01-03 10:00:00,2
+'''
+
+FOLLOWS_CSV = """\
+user_being_followed_id,user_following_id
+1,2
+1,3
+2,1
+"""
+
+
+def schema_objects():
+    """ Names of every index and constraint in the database. """
+
+    return set(db.session.scalars(text("""
+        SELECT indexname FROM pg_indexes WHERE schemaname = 'public'
+        UNION ALL
+        SELECT conname FROM pg_constraint
+        WHERE connamespace = 'public'::regnamespace
+        """)))
+
+
+class BulkLoadTestCase(TestCase):
+    """ Test cases for loading CSVs with bulk_load. """
+
+    def setUp(self):
+        """ Set up for bulk load tests: empty tables, and a CSV folder. """
+
+        User.query.delete()
+        db.session.commit()
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.write_csvs(USERS_CSV, MESSAGES_CSV, FOLLOWS_CSV)
+
+
+    def tearDown(self):
+        """ Tear down for bulk load tests. """
+
+        db.session.rollback()
+        self.folder.cleanup()
+
+
+    def write_csvs(self, users, messages, follows):
+        for name, content in (('users.csv', users),
+                              ('messages.csv', messages),
+                              ('follows.csv', follows)):
+            with open(os.path.join(self.folder.name, name), 'w') as file:
+                file.write(content)
+
+
+    def assert_loaded(self, loaded):
+        self.assertEqual(loaded, {'users': 3, 'messages': 3, 'follows': 3})
+
+        alice = db.session.get(User, 1)
+        bob = db.session.get(User, 2)
+
+        self.assertEqual(alice.bio, "likes, commas")
+        self.assertEqual([msg.text for msg in bob.messages],
+                         ['quoted "text"', 'third'])
+        self.assertEqual({user.id for user in alice.followers}, {2, 3})
+
+        # new rows get ids after the loaded ones
+        user = User(email="d@email.com", username="dave", password="x")
+        db.session.add(user)
+        db.session.flush()
+
+        self.assertEqual(user.id, 4)
+
+
+    def test_load_with_copy(self):
+        """ Test loading with COPY, with indexes rebuilt afterwards. """
+
+        before = schema_objects()
+        reports = []
+
+        loaded = load_csvs(self.folder.name, report=reports.append)
+
+        self.assert_loaded(loaded)
+        self.assertEqual(schema_objects(), before)
+        self.assertIn("rows/s", reports[0])
+        self.assertIn("rebuilt", reports[-1])
+
+
+    def test_load_with_inserts(self):
+        """ Test loading with INSERTs (for databases without COPY). """
+
+        loaded = load_csvs(
+            self.folder.name, report=lambda line: None, use_copy=False)
+
+        self.assert_loaded(loaded)
+
+
+    def test_load_bad_data(self):
+        """ Test constraints are checked when rebuilt, and a failed load
+        changes nothing. """
+
+        before = schema_objects()
+        self.write_csvs(USERS_CSV, MESSAGES_CSV, FOLLOWS_CSV + "1,99\n")
+
+        with self.assertRaises(IntegrityError):
+            load_csvs(self.folder.name, report=lambda line: None)
+
+        db.session.rollback()
+
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(schema_objects(), before)
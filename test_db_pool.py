@@ -0,0 +1,76 @@
+"""Connection pool settings tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_db_pool.py
+
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool
+
+from db_pool import (engine_options, pool_stats, connection_budget,
+                     checkout_stats, TimedQueuePool)
+
+
+class DbPoolTestCase(TestCase):
+    """ Test cases for pool options and checkout stats. """
+
+    def setUp(self):
+        """ Set up for pool tests. """
+
+        checkout_stats.clear()
+
+
+    def test_engine_options(self):
+        """ Test pool options come from DB_* variables. """
+
+        options = engine_options({
+            'DB_POOL_SIZE': '2',
+            'DB_MAX_OVERFLOW': '0',
+            'DB_POOL_PRE_PING': 'false',
+        })
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(connection_budget(options, 4), (2, 8))
+
+
+    def test_pgbouncer(self):
+        """ Test PgBouncer mode turns SQLAlchemy's pool off. """
+
+        options = engine_options({'DB_PGBOUNCER': '1', 'DB_POOL_SIZE': '9'})
+
+        self.assertEqual(options, {'poolclass': NullPool})
+        self.assertEqual(connection_budget(options, 4, threads=2), (2, 8))
+
+
+    def test_checkout_stats(self):
+        """ Test checkout waits, timeouts and saturation are counted. """
+
+        engine = create_engine(
+            "postgresql:///warbler_test",
+            **engine_options({'DB_POOL_SIZE': '1', 'DB_MAX_OVERFLOW': '0',
+                              'DB_POOL_TIMEOUT': '0.05'}))
+
+        try:
+            with engine.connect():
+                self.assertEqual(pool_stats(engine)['saturation'], 1)
+
+                with self.assertRaises(PoolTimeoutError):
+                    engine.connect()
+
+            stats = pool_stats(engine)
+
+            self.assertEqual(stats['checkouts'], 2)
+            self.assertEqual(stats['timeouts'], 1)
+            self.assertGreaterEqual(stats['max_wait_seconds'], 0.05)
+            self.assertEqual(stats['checked_out'], 0)
+            self.assertEqual(stats['idle'], 1)
+        finally:
+            engine.dispose()
@@ -0,0 +1,281 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event, update
+
+from models import db, User, Follows, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from follow_graph import (IdSet, FollowGraph, follow_graph, add_follow,
+                          remove_follow)
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class IdSetTestCase(TestCase):
+    """ Test cases for IdSet. """
+
+    def test_membership(self):
+        """ Test ids are kept sorted and distinct, and found. """
+
+        ids = IdSet([5, 1, 3, 3])
+
+        self.assertEqual(list(ids), [1, 3, 5])
+        self.assertEqual(ids.ids.itemsize, 4)
+        self.assertIn(3, ids)
+        self.assertNotIn(4, ids)
+        self.assertNotIn(6, ids)
+        self.assertEqual(ids.among([1, 2, 5]), {1, 5})
+
+
+    def test_intersection(self):
+        """ Test intersecting sets of similar and very different sizes. """
+
+        evens = IdSet(range(0, 1000, 2))
+
+        self.assertEqual(list(evens.intersection(IdSet(range(0, 1000, 3)))),
+                         list(range(0, 1000, 6)))
+        self.assertEqual(list(IdSet([4, 5]).intersection(evens)), [4])
+        self.assertEqual(list(evens.intersection(IdSet())), [])
+
+
+    def test_with_without(self):
+        """ Test copies with an id added or removed. """
+
+        ids = IdSet([1, 5])
+
+        self.assertEqual(list(ids.with_id(3)), [1, 3, 5])
+        self.assertEqual(list(ids.without_id(1)), [5])
+        self.assertIs(ids.with_id(5), ids)
+        self.assertEqual(list(ids), [1, 5])
+
+
+class FollowGraphTestCase(TestCase):
+    """ Test cases for the follow graph cache, and the views using it. """
+
+    def setUp(self):
+        """ Set up for follow graph tests: u1 follows u2. """
+
+        User.query.delete()
+        # the bulk delete leaves users loaded by earlier tests in the session
+        db.session.expunge_all()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+
+        add_follow(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        reset_caches()
+
+
+    def tearDown(self):
+        """ Tear down for follow graph tests. """
+
+        db.session.rollback()
+
+
+    def user(self, user_id):
+        """ `user_id`'s row as a new request would load it. """
+
+        db.session.expire_all()
+
+        return db.session.get(User, user_id)
+
+
+    def follow_elsewhere(self, follower_id, followed_id):
+        """ Follow as another worker would: in the database, without
+        touching this worker's cache. """
+
+        db.session.execute(
+            Follows.__table__.insert().values(
+                user_following_id=follower_id,
+                user_being_followed_id=followed_id))
+        db.session.execute(
+            update(User)
+            .where(User.id.in_([follower_id, followed_id]))
+            .values(follows_version=User.follows_version + 1))
+        db.session.commit()
+
+
+    def count_statements(self, func):
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        return result, len(statements)
+
+
+    def test_cached(self):
+        """ Test sets are loaded once, then served from the cache. """
+
+        u1 = self.user(self.u1_id)
+
+        following, count = self.count_statements(
+            lambda: follow_graph.following(u1))
+        self.assertEqual(list(following), [self.u2_id])
+        self.assertEqual(count, 1)
+
+        following, count = self.count_statements(
+            lambda: follow_graph.following(u1))
+        self.assertEqual(list(following), [self.u2_id])
+        self.assertEqual(count, 0)
+
+        self.assertEqual(list(follow_graph.followers(self.user(self.u2_id))),
+                         [self.u1_id])
+
+
+    def test_changed_elsewhere(self):
+        """ Test a set cached before another worker's follow isn't used once
+        the user's row shows it. """
+
+        follow_graph.following(self.user(self.u1_id))
+        self.follow_elsewhere(self.u1_id, self.u3_id)
+
+        self.assertEqual(list(follow_graph.following(self.user(self.u1_id))),
+                         [self.u2_id, self.u3_id])
+        self.assertEqual(follow_graph.stats()['stale'], 1)
+
+
+    def test_lagging_row(self):
+        """ Test a set loaded for an older row (e.g. from a lagging replica)
+        doesn't replace a newer one. """
+
+        old_u1 = self.user(self.u1_id)
+        db.session.expunge(old_u1)
+
+        self.follow_elsewhere(self.u1_id, self.u3_id)
+        new_u1 = self.user(self.u1_id)
+        follow_graph.following(new_u1)
+
+        follow_graph.following(old_u1)
+
+        _, count = self.count_statements(
+            lambda: follow_graph.following(new_u1))
+        self.assertEqual(count, 0)
+
+
+    def test_updated_on_commit(self):
+        """ Test this worker's follows update its cached sets when they
+        commit, not before, and not if rolled back. """
+
+        follow_graph.following(self.user(self.u1_id))
+        follow_graph.followers(self.user(self.u3_id))
+
+        self.assertTrue(add_follow(self.u1_id, self.u3_id))
+        self.assertFalse(add_follow(self.u1_id, self.u3_id))
+        db.session.commit()
+
+        u1 = self.user(self.u1_id)
+        u3 = db.session.get(User, self.u3_id)
+
+        (following, followers), count = self.count_statements(lambda: (
+            follow_graph.following(u1), follow_graph.followers(u3)))
+        self.assertEqual(list(following), [self.u2_id, self.u3_id])
+        self.assertEqual(list(followers), [self.u1_id])
+        self.assertEqual(count, 0)
+
+        self.assertTrue(remove_follow(self.u1_id, self.u2_id))
+        db.session.rollback()
+        self.assertIn(self.u2_id, follow_graph.following(self.user(self.u1_id)))
+
+        self.assertTrue(remove_follow(self.u1_id, self.u2_id))
+        self.assertFalse(remove_follow(self.u1_id, self.u2_id))
+        db.session.commit()
+        self.assertEqual(list(follow_graph.following(self.user(self.u1_id))),
+                         [self.u3_id])
+
+
+    def test_other_graph(self):
+        """ Test another worker's graph reloads a set this worker's follow
+        changed. """
+
+        other = FollowGraph(10, None)
+        other.following(self.user(self.u1_id))
+
+        add_follow(self.u1_id, self.u3_id)
+        db.session.commit()
+
+        self.assertEqual(list(other.following(self.user(self.u1_id))),
+                         [self.u2_id, self.u3_id])
+
+
+    def test_deleted_user(self):
+        """ Test deleting a user drops them from their followers' sets. """
+
+        follow_graph.following(self.user(self.u1_id))
+
+        with app.test_client() as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u2_id
+
+            c.post('/users/delete')
+
+        self.assertEqual(list(follow_graph.following(self.user(self.u1_id))),
+                         [])
+
+
+    def test_follow_views(self):
+        """ Test following twice only counts once, and follow buttons show
+        follows made on other workers right away. """
+
+        with app.test_client() as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u3_id}')
+            c.post(f'/users/follow/{self.u3_id}')
+
+            self.assertEqual(self.user(self.u3_id).followers_count, 1)
+
+            resp = c.get(f'/users/{self.u3_id}')
+            self.assertIn(f'action="/users/stop-following/{self.u3_id}"',
+                          resp.text)
+
+            c.post(f'/users/stop-following/{self.u3_id}')
+            c.post(f'/users/stop-following/{self.u3_id}')
+
+            self.assertEqual(self.user(self.u3_id).followers_count, 0)
+
+            resp = c.post('/users/stop-following/0')
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.get(f'/users/{self.u3_id}')
+            self.assertIn(f'action="/users/follow/{self.u3_id}"', resp.text)
+
+            self.follow_elsewhere(self.u1_id, self.u3_id)
+
+            resp = c.get(f'/users/{self.u3_id}')
+            self.assertIn(f'action="/users/stop-following/{self.u3_id}"',
+                          resp.text)
@@ -0,0 +1,252 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from instrumentation import HISTOGRAMS, server_timing, RequestStats
+from query_analysis import normalize, fingerprint, query_report, QueryReport
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def parse_server_timing(header):
+    """ {name: (duration, description)} from a Server-Timing header. """
+
+    metrics = {}
+
+    for metric in header.split(', '):
+        name, *params = metric.split(';')
+        params = dict(param.split('=', 1) for param in params)
+        metrics[name] = (float(params['dur']), params.get('desc'))
+
+    return metrics
+
+
+class InstrumentationTestCase(TestCase):
+    """ Test cases for per-request timing and /metrics. """
+
+    def setUp(self):
+        """ Set up for instrumentation tests. """
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u1.messages.append(Message(text="hello"))
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+        reset_caches()
+
+        for histogram in HISTOGRAMS:
+            histogram.clear()
+
+        query_report.clear()
+        self.query_config = {name: app.config[name] for name in (
+            'QUERY_SAMPLE_RATE', 'SLOW_QUERY_MS', 'N_PLUS_ONE_THRESHOLD')}
+
+
+    def tearDown(self):
+        """ Tear down for instrumentation tests. """
+
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+        app.config['METRICS_PUBLIC'] = False
+        app.config['TESTING'] = True
+        app.config.update(self.query_config)
+
+
+    def test_server_timing(self):
+        """ Test each response says how much SQL and template work it took. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}')
+            timing = parse_server_timing(resp.headers['Server-Timing'])
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(timing['db'][0], 0)
+            self.assertRegex(timing['db'][1], r'^"SQL \([1-9]\d*\)"$')
+            self.assertGreater(timing['template'][0], 0)
+            self.assertGreaterEqual(timing['total'][0], timing['db'][0])
+
+
+    def test_server_timing_bcrypt(self):
+        """ Test logins report their time in bcrypt. """
+
+        with self.client as c:
+            resp = c.post('/login', data={
+                'username': 'u1',
+                'password': 'password',
+            })
+            timing = parse_server_timing(resp.headers['Server-Timing'])
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertGreater(timing['bcrypt'][0], 0)
+
+
+    def test_format(self):
+        """ Test the Server-Timing header for given stats. """
+
+        stats = RequestStats()
+        stats.statements = 3
+        stats.db_seconds = 0.0125
+        stats.add('template', 0.002)
+        stats.add('template', 0.001)
+
+        self.assertEqual(
+            server_timing(stats, 0.05),
+            'db;desc="SQL (3)";dur=12.50, template;dur=3.00, total;dur=50.00')
+
+
+    def test_metrics(self):
+        """ Test /metrics has per-route histograms and cache stats. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.get(f'/users/{self.u1_id}')
+            c.get(f'/users/{self.u1_id}')
+            c.get('/users/0')
+
+            resp = c.get('/metrics')
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(
+                'warbler_request_seconds_count{route="/users/<int:user_id>",'
+                'method="GET",status="200"} 2',
+                text)
+            self.assertIn(
+                'warbler_request_seconds_count{route="/users/<int:user_id>",'
+                'method="GET",status="404"} 1',
+                text)
+            self.assertIn(
+                'warbler_request_db_statements_bucket'
+                '{route="/users/<int:user_id>",method="GET",le="+Inf"} 3',
+                text)
+            self.assertIn('# TYPE warbler_fragment_cache_hits_total counter',
+                          text)
+            self.assertIn('warbler_like_buffer_pending 0', text)
+            self.assertIn('# TYPE warbler_db_pool_checkouts_total counter',
+                          text)
+            self.assertIn('warbler_db_pool_saturation', text)
+
+
+    def test_metrics_token(self):
+        """ Test /metrics can require a token. """
+
+        app.config['METRICS_TOKEN'] = 'sekrit'
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 401)
+
+        resp = self.client.get(
+            '/metrics', headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(resp.status_code, 200)
+
+
+    def test_metrics_closed_without_token(self):
+        """ Test /metrics is off without a token, unless made public. """
+
+        app.config['TESTING'] = False
+
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics/queries').status_code, 401)
+
+        app.config['METRICS_PUBLIC'] = True
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+    def test_normalize(self):
+        """ Test statements differing only in values have the same shape. """
+
+        self.assertEqual(
+            normalize("SELECT users.id FROM users\n"
+                      "WHERE users.id IN (%(id_1_1)s, %(id_1_2)s) "
+                      "AND users.username = 'o''brien' LIMIT 20"),
+            "SELECT users.id FROM users WHERE users.id IN (...) "
+            "AND users.username = ? LIMIT ?")
+        self.assertEqual(
+            normalize("SELECT * FROM likes WHERE message_id IN (1, 2, 3)"),
+            normalize("SELECT * FROM likes WHERE message_id IN (%s)"))
+        self.assertEqual(
+            fingerprint(normalize("SELECT 1 FROM t2 WHERE x = %(pk_1)s")),
+            fingerprint(normalize("SELECT 1 FROM t2 WHERE x = 42")))
+
+    def test_query_report(self):
+        """ Test repeated shapes are flagged as N+1s, slow statements as
+        slow, and the report ranks shapes by total time. """
+
+        report = QueryReport()
+        load_user = "SELECT * FROM users WHERE users.id = %(pk_1)s"
+        statements = [("SELECT * FROM messages LIMIT %(param_1)s", 0.02)]
+        statements += [(load_user, 0.004)] * 10
+
+        repeated, slow = report.add_request('/', statements, 0.01, 5)
+
+        self.assertEqual(list(repeated.values()),
+                         [(normalize(load_user), 10)])
+        self.assertEqual([sql for _, sql, _ in slow],
+                         ["SELECT * FROM messages LIMIT ?"])
+
+        report.add_request('/', [(load_user, 0.004)], 0.01, 5)
+        ranked = report.ranked()
+
+        self.assertEqual(report.requests['/'], 2)
+        self.assertEqual(ranked[0]['sql'], normalize(load_user))
+        self.assertEqual(ranked[0]['executions'], 11)
+        self.assertEqual(ranked[0]['requests'], 2)
+        self.assertEqual(ranked[0]['max_per_request'], 10)
+        self.assertEqual(ranked[0]['n_plus_one_requests'], 1)
+        self.assertEqual(ranked[1]['slow'], 1)
+
+    def test_query_metrics(self):
+        """ Test sampled requests are analysed, logged and reported. """
+
+        app.config.update(QUERY_SAMPLE_RATE=1, SLOW_QUERY_MS=0,
+                          N_PLUS_ONE_THRESHOLD=1)
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            with self.assertLogs('warbler.queries', 'WARNING') as logs:
+                c.get(f'/users/{self.u1_id}')
+
+            self.assertTrue(any('"n_plus_one"' in line for line in logs.output))
+            self.assertTrue(any('"slow_query"' in line for line in logs.output))
+
+            app.config['QUERY_SAMPLE_RATE'] = 0
+            resp = c.get('/metrics/queries')
+            report = resp.json
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(report['sampled_requests'],
+                             {'/users/<int:user_id>': 1})
+            self.assertTrue(report['queries'])
+            totals = [query['total_seconds'] for query in report['queries']]
+            self.assertEqual(totals, sorted(totals, reverse=True))
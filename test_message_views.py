@@ -20,6 +20,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from testing import reset_caches
+from fragments import fragment_cache
+from pagination import MESSAGES_PER_PAGE
+from likes import set_likes, like_buffer, toggle_like, LikeBufferUnavailable
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -58,6 +62,7 @@ class MessageViewsTestCase(TestCase):
         self.u1 = u1
 
         self.client = app.test_client()
+        reset_caches()
     
 
     def tearDown(self):
@@ -117,6 +122,104 @@ class MessageViewsTestCase(TestCase):
             self.assertIn("test message", html)
 
 
+    def test_show_message_not_modified(self):
+        """ Test an unchanged message page gets a 304 until it's liked. """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        test_msg = Message(text="likeable")
+        u2.messages.append(test_msg)
+        db.session.commit()
+        msg_id = test_msg.id
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/messages/{msg_id}')
+            etag = resp.headers['ETag']
+
+            resp = c.get(f'/messages/{msg_id}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f'/api/messages/{msg_id}/likes')
+
+            resp = c.get(f'/messages/{msg_id}',
+                         headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bi-star-fill", resp.get_data(as_text=True))
+
+
+    def test_show_message_like_state(self):
+        """ Test the like star reflects the viewer's like on the message. """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        test_msg = Message(text="likeable")
+        u2.messages.append(test_msg)
+        self.u1.liked_messages.append(test_msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/messages/{test_msg.id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bi-star-fill", html)
+
+
+    def test_message_list_fragments(self):
+        """ Test message list items are rendered once, with the like star
+        added per viewer, and re-rendered after a profile change. """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        test_msg = Message(text="cached warble")
+        self.u1.messages.append(test_msg)
+        u2.liked_messages.append(test_msg)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("cached warble", html)
+            self.assertNotIn("messages-like", html) # own message: no star
+            self.assertEqual(fragment_cache.stats()['entries'], 1)
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = u2_id
+
+            hits = fragment_cache.hits
+            resp = c.get(f'/users/{self.u1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(fragment_cache.hits, hits + 1)
+            self.assertIn("cached warble", html)
+            self.assertIn("bi-star-fill", html)
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post('/users/profile', data={
+                'username': 'renamed',
+                'email': 'u1@email.com',
+                'password': 'password'
+            })
+            self.assertEqual(fragment_cache.stats()['entries'], 0)
+
+            resp = c.get(f'/users/{self.u1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@renamed", html)
+
+
     def test_delete_message(self):
         """ Test route to delete a message.  """
 
@@ -136,6 +239,39 @@ class MessageViewsTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("test message", html)
+            self.assertEqual(len(fragment_cache), 0)
+
+
+    def test_message_and_like_counters(self):
+        """ Test posting, liking and deleting keep counters right. """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post('/messages/new', data={'text': "counted"})
+            msg_id = Message.query.filter_by(text="counted").one().id
+
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 1)
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = u2_id
+
+            c.post(f'/api/messages/{msg_id}/likes')
+
+            self.assertEqual(User.query.get(u2_id).likes_count, 1)
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{msg_id}/delete')
+
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 0)
+            self.assertEqual(User.query.get(u2_id).likes_count, 0)
 
 
     def test_like_message(self):
@@ -162,6 +298,25 @@ class MessageViewsTestCase(TestCase):
             self.assertIn("test homepage", html)
 
 
+    def test_like_message_bad_id(self):
+        """ Test liking a missing or malformed message id fails cleanly. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post('/messages/likes', data={'message_id': 'x'})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.post('/messages/likes', data={})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.post('/messages/likes', data={'message_id': 0})
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertFalse(toggle_like(self.u1_id, 0))
+
+
     def test_unlike_message(self):
         """ Test route to unlike a message. """
 
@@ -183,4 +338,196 @@ class MessageViewsTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("test homepage", html)
\ No newline at end of file
+            self.assertIn("test homepage", html)
+
+    def test_set_likes_api(self):
+        """ Test liking/unliking many messages in one request. """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        msgs = [Message(text=f"warble {i}") for i in range(3)]
+        u2.messages.extend(msgs)
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+
+        set_likes(self.u1_id, like_ids=[ids[2]])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.post('/api/likes', json={'like': ids[:2]})
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            data = {'like': ids[:2], 'unlike': [ids[2]]}
+            resp = c.post('/api/likes', json=data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {
+                'likes': {
+                    str(ids[0]): True,
+                    str(ids[1]): True,
+                    str(ids[2]): False,
+                },
+                'likes_count': 2,
+            })
+
+            # the same request again changes nothing
+            resp = c.post('/api/likes', json=data)
+
+            self.assertEqual(resp.json['likes_count'], 2)
+            self.assertEqual(
+                {like.message_id for like in Like.query.all()},
+                set(ids[:2]))
+
+            resp = c.post('/api/likes', json={'like': [0]})
+            self.assertEqual(resp.json['likes'], {'0': False})
+
+            resp = c.post('/api/likes', json={'like': ids, 'unlike': ids})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.post('/api/likes', json={'like': ['1; DROP']})
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_write_behind_likes(self):
+        """ Test buffered likes: collapsed, visible to the user right away,
+        and written in one flush. """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        msgs = [Message(text=f"warble {i}") for i in range(3)]
+        u2.messages.extend(msgs)
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+
+        set_likes(self.u1_id, like_ids=[ids[2]])
+        db.session.commit()
+
+        # flushed by hand below, not by the background thread
+        app.config['LIKES_FLUSH_INTERVAL'] = 3600
+        like_buffer.start(app)
+
+        try:
+            # the flusher starts with the first like, in this process
+            self.assertIsNone(like_buffer._thread)
+
+            with self.client as c:
+                with c.session_transaction() as change_session:
+                    change_session[CURR_USER_KEY] = self.u1_id
+
+                c.post('/api/likes', json={'like': ids[:2], 'unlike': [ids[2]]})
+                self.assertTrue(like_buffer._thread.is_alive())
+                c.post(f'/api/messages/{ids[1]}/likes')
+                c.post(f'/api/messages/{ids[1]}/likes')
+                resp = c.post('/api/likes', json={'like': [ids[0]]})
+
+                self.assertEqual(resp.json, {
+                    'likes': {str(ids[0]): True},
+                    'likes_count': 2,
+                })
+                self.assertEqual(like_buffer.stats()['pending'], 3)
+                self.assertEqual(
+                    {like.message_id for like in Like.query.all()}, {ids[2]})
+
+                resp = c.get(f'/messages/{ids[1]}')
+                self.assertIn("bi-star-fill", resp.get_data(as_text=True))
+                self.assertIsNone(resp.headers.get('ETag'))
+
+                self.assertEqual(like_buffer.flush(), 3)
+
+            db.session.expire_all()
+
+            self.assertEqual(
+                {like.message_id for like in Like.query.all()}, set(ids[:2]))
+            self.assertEqual(db.session.get(User, self.u1_id).likes_count, 2)
+            self.assertEqual(like_buffer.stats()['pending'], 0)
+            self.assertFalse(like_buffer.has_pending(self.u1_id))
+
+        finally:
+            like_buffer.stop()
+            app.config['LIKES_FLUSH_INTERVAL'] = 1.0
+
+
+    def test_write_behind_single_process(self):
+        """ Test write-behind likes refuse to run with several workers. """
+
+        app.config['WEB_CONCURRENCY'] = 2
+
+        try:
+            with self.assertRaises(LikeBufferUnavailable):
+                like_buffer.start(app)
+            self.assertFalse(like_buffer.enabled)
+        finally:
+            app.config['WEB_CONCURRENCY'] = 1
+
+
+    def test_user_messages_pagination(self):
+        """ Test keyset pagination of a user's messages, page and API. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            for i in range(MESSAGES_PER_PAGE + 5):
+                self.u1.messages.append(Message(text=f"msg {i}"))
+            db.session.commit()
+
+            resp = c.get(f'/api/users/{self.u1_id}/messages')
+            first_page = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(first_page['messages']), MESSAGES_PER_PAGE)
+            self.assertIsNotNone(first_page['next'])
+
+            resp = c.get(
+                f'/api/users/{self.u1_id}/messages',
+                query_string={'before': first_page['next']})
+            second_page = resp.get_json()
+
+            self.assertEqual(len(second_page['messages']), 5)
+            self.assertIsNone(second_page['next'])
+
+            seen = {msg['id'] for msg in first_page['messages']}
+            self.assertFalse(
+                seen & {msg['id'] for msg in second_page['messages']})
+
+            resp = c.get(
+                f'/users/{self.u1_id}',
+                query_string={'before': first_page['next']})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("msg 0", html)
+            self.assertNotIn("Older warbles", html)
+
+
+    def test_bad_cursor(self):
+        """ Test that an undecodable cursor is a 400. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/api/timeline', query_string={'before': 'nope'})
+
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_liked_messages_api(self):
+        """ Test the liked messages API lists liked messages. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            test_msg = Message(text="liked message")
+            self.u1.messages.append(test_msg)
+            self.u1.liked_messages.append(test_msg)
+            db.session.commit()
+
+            resp = c.get(f'/api/users/{self.u1_id}/liked_messages')
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [msg['id'] for msg in data['messages']], [test_msg.id])
@@ -0,0 +1,159 @@
+"""SQL statement count tests.
+
+Guards against N+1 queries creeping back into the message list views: each
+route below must run a fixed number of statements however many messages are
+on the page.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from timeline import backfill_timelines
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 5
+MESSAGES_PER_AUTHOR = 10
+
+# maximum number of SQL statements each route may run (once the logged-in
+# user is cached)
+MAX_STATEMENTS = {
+    'homepage': 5,
+    'show_user': 4,
+    'show_liked_messages': 2,
+    'show_message': 3,
+}
+
+
+class StatementCounter:
+    """ Context manager recording every SQL statement sent to the db. """
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class QueryCountTestCase(TestCase):
+    """ Test cases for SQL statements issued per route. """
+
+    def setUp(self):
+        """ Set up a user following several authors with messages, and
+        liking messages by several authors they don't follow. """
+
+        User.query.delete()
+
+        viewer = User.signup("viewer", "viewer@email.com", "password", None)
+
+        for i in range(NUM_AUTHORS * 2):
+            author = User.signup(
+                f"author{i}", f"author{i}@email.com", "password", None)
+
+            if i < NUM_AUTHORS:
+                viewer.following.append(author)
+
+            for j in range(MESSAGES_PER_AUTHOR):
+                msg = Message(text=f"message {i}-{j}")
+                author.messages.append(msg)
+
+                if i >= NUM_AUTHORS:
+                    viewer.liked_messages.append(msg)
+
+        db.session.commit()
+
+        backfill_timelines()
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+        self.msg_id = msg.id
+
+        self.client = app.test_client()
+        reset_caches()
+
+
+    def tearDown(self):
+        """ Tear down for query count tests. """
+
+        db.session.rollback()
+
+
+    def assert_max_statements(self, endpoint, url):
+        """ GET `url` as the viewer and check the statement budget. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.viewer_id
+
+            # a warm worker (the logged-in user is cached), but an empty
+            # identity map, as a real request would have
+            c.get(url)
+            db.session.remove()
+
+            with StatementCounter() as counter:
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLessEqual(
+                counter.count,
+                MAX_STATEMENTS[endpoint],
+                "\n\n".join(counter.statements))
+
+
+    def test_homepage(self):
+        """ Test statements for the homepage timeline. """
+
+        self.assert_max_statements('homepage', '/')
+
+
+    def test_show_user(self):
+        """ Test statements for a user profile. """
+
+        self.assert_max_statements('show_user', f'/users/{self.author_id}')
+
+
+    def test_show_liked_messages(self):
+        """ Test statements for a user's liked messages. """
+
+        self.assert_max_statements(
+            'show_liked_messages', f'/users/{self.viewer_id}/liked_messages')
+
+
+    def test_show_message(self):
+        """ Test statements for a single message. """
+
+        self.assert_max_statements('show_message', f'/messages/{self.msg_id}')
@@ -0,0 +1,232 @@
+"""Query plan tests.
+
+Loads the seed CSVs, requests each hot route, and EXPLAINs every SELECT the
+route ran. With sequential scans (and hash/merge joins) disabled the planner
+only falls back to one, or to walking a whole index, when no index can serve
+the query, so a full scan in any plan means an index for that query shape is
+missing.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import json
+import os
+from csv import DictReader
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from counters import reconcile_counters
+from timeline import backfill_timelines
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class StatementRecorder:
+    """ Context manager recording (statement, parameters) for every SELECT
+    sent to the db. """
+
+    def __init__(self):
+        self.selects = []
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.selects.append((statement, parameters))
+
+
+# partial indexes are small by design; walking one whole is fine
+PARTIAL_INDEXES = {
+    index.name
+    for table in db.metadata.tables.values()
+    for index in table.indexes
+    if index.dialect_options['postgresql']['where'] is not None
+}
+
+
+def find_full_scans(plan, limited=False):
+    """ Relation names scanned in full anywhere in a JSON plan tree: every
+    Seq Scan, and index scans with no index condition (walking the whole
+    index) unless a Limit above them stops the walk early. """
+
+    found = []
+    node_type = plan['Node Type']
+
+    if node_type == 'Seq Scan':
+        found.append(plan['Relation Name'])
+
+    if (node_type in ('Index Scan', 'Index Only Scan')
+            and 'Index Cond' not in plan
+            and plan['Index Name'] not in PARTIAL_INDEXES
+            and not limited):
+        found.append(plan['Relation Name'])
+
+    limited = limited or node_type == 'Limit'
+
+    for child in plan.get('Plans', []):
+        found.extend(find_full_scans(child, limited))
+
+    return found
+
+
+class QueryPlanTestCase(TestCase):
+    """ Test cases for the query plans behind the hot routes. """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Load the seed dataset once for all plan tests. """
+
+        db.drop_all()
+        db.create_all()
+
+        with open('generator/users.csv') as users:
+            db.session.bulk_insert_mappings(User, DictReader(users))
+
+        with open('generator/messages.csv') as messages:
+            db.session.bulk_insert_mappings(Message, DictReader(messages))
+
+        with open('generator/follows.csv') as follows:
+            db.session.bulk_insert_mappings(Follows, DictReader(follows))
+
+        db.session.commit()
+
+        reconcile_counters()
+        backfill_timelines()
+        db.session.commit()
+
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+
+        viewer = User.query.filter(User.following_count > 0).first()
+        msg = Message.query.filter(Message.user_id != viewer.id).first()
+
+        # like a few messages so the like lookups have rows to find
+        viewer.liked_messages.extend(Message.query.limit(5).all())
+        db.session.commit()
+
+        cls.viewer_id = viewer.id
+        cls.search = viewer.username[:4]
+        cls.msg_id = msg.id
+        cls.author_id = msg.user_id
+
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Leave an empty database behind for the other test modules. """
+
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+
+
+    def setUp(self):
+        """ Set up for query plan tests. """
+
+        self.client = app.test_client()
+        reset_caches()
+
+
+    def assert_no_full_scans(self, url):
+        """ GET `url` as the viewer, then EXPLAIN every SELECT it ran. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.viewer_id
+
+            db.session.remove()
+
+            with StatementRecorder() as recorder:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(recorder.selects)
+
+        connection = db.engine.raw_connection()
+
+        try:
+            cursor = connection.cursor()
+            # only plans that can be driven by indexes
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("SET enable_hashjoin = off")
+            cursor.execute("SET enable_mergejoin = off")
+
+            for statement, parameters in recorder.selects:
+                cursor.execute(
+                    f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                plan = cursor.fetchone()[0]
+
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+
+                self.assertEqual(
+                    find_full_scans(plan[0]['Plan']), [],
+                    f"{url} scans a whole table for:\n{statement}")
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+    def test_homepage(self):
+        """ Test plans for the home timeline. """
+
+        self.assert_no_full_scans('/')
+
+
+    def test_search_users(self):
+        """ Test plans for username search. """
+
+        self.assert_no_full_scans(f'/users?q={self.search}')
+
+
+    def test_show_user(self):
+        """ Test plans for a user profile. """
+
+        self.assert_no_full_scans(f'/users/{self.author_id}')
+
+
+    def test_show_following(self):
+        """ Test plans for the list of followed users. """
+
+        self.assert_no_full_scans(f'/users/{self.viewer_id}/following')
+
+
+    def test_show_followers(self):
+        """ Test plans for the list of followers. """
+
+        self.assert_no_full_scans(f'/users/{self.author_id}/followers')
+
+
+    def test_show_liked_messages(self):
+        """ Test plans for liked messages. """
+
+        self.assert_no_full_scans(f'/users/{self.viewer_id}/liked_messages')
+
+
+    def test_show_message(self):
+        """ Test plans for a single message. """
+
+        self.assert_no_full_scans(f'/messages/{self.msg_id}')
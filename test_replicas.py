@@ -0,0 +1,159 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# a second database, warbler_test_replica, stands in for the replica (it's
+# created if it doesn't exist)
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import select, text
+
+from models import db, User, Message, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from replicas import get_replica_engines, PIN_KEY
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+REPLICA_URL = "postgresql:///warbler_test_replica"
+
+with db.engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT') as connection:
+    if not connection.execute(text(
+            "SELECT 1 FROM pg_database WHERE datname = 'warbler_test_replica'"
+    )).scalar():
+        connection.execute(text("CREATE DATABASE warbler_test_replica"))
+
+
+class ReplicaTestCase(TestCase):
+    """ Test cases for sending reads to a replica. """
+
+    def setUp(self):
+        """ Set up a user on the primary, and a copy of them with a
+        different bio on the replica. """
+
+        app.config['REPLICA_DATABASE_URIS'] = [REPLICA_URL]
+        (self.replica,) = get_replica_engines(app)
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u1.bio = "bio on the primary"
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        row = dict(db.session.execute(
+            select(User.__table__).where(User.id == u1.id)).one()._mapping)
+        row['bio'] = "bio on the replica"
+
+        with self.replica.begin() as connection:
+            connection.execute(User.__table__.insert(), row)
+
+        self.client = app.test_client()
+        reset_caches()
+
+
+    def tearDown(self):
+        """ Tear down for replica tests. """
+
+        db.session.rollback()
+        app.config['REPLICA_DATABASE_URIS'] = []
+        get_replica_engines(app)
+
+
+    def login(self, c):
+        with c.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.u1_id
+
+
+    def test_reads_use_replica(self):
+        """ Test marked GET views read from the replica. """
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f'/users/{self.u1_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bio on the replica", html)
+
+
+    def test_other_views_use_primary(self):
+        """ Test views that aren't marked read from the primary. """
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get('/users/profile')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bio on the primary", html)
+
+
+    def test_writes_pin_to_primary(self):
+        """ Test a write goes to the primary, and that browser's next reads
+        do too until the pin runs out. """
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post('/messages/new', data={'text': 'written'},
+                          follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bio on the primary", html)
+            self.assertIn("written", html)
+            self.assertEqual(
+                Message.query.filter_by(user_id=self.u1_id).count(), 1)
+
+            with self.replica.connect() as connection:
+                self.assertEqual(connection.execute(
+                    text("SELECT count(*) FROM messages")).scalar(), 0)
+
+            with c.session_transaction() as change_session:
+                self.assertIn(PIN_KEY, change_session)
+                change_session[PIN_KEY] = 0
+
+            reset_caches()
+
+            resp = c.get(f'/users/{self.u1_id}')
+            self.assertIn("bio on the replica", resp.get_data(as_text=True))
+
+
+    def test_no_replicas(self):
+        """ Test everything uses the primary without replicas. """
+
+        app.config['REPLICA_DATABASE_URIS'] = []
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f'/users/{self.u1_id}')
+            self.assertIn("bio on the primary", resp.get_data(as_text=True))
+
+            resp = c.post('/messages/new', data={'text': 'written'})
+
+            with c.session_transaction() as change_session:
+                self.assertNotIn(PIN_KEY, change_session)
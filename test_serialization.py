@@ -0,0 +1,130 @@
+"""Serialization tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_serialization.py
+
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+import msgpack
+from sqlalchemy import select
+from werkzeug.http import http_date
+
+from models import db, User, Message, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from serialization import (MESSAGE_COLUMNS, message_data, serialize_message,
+                           serialize_messages, serialize_user, dumps_json,
+                           format_http_date, negotiate)
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SerializationTestCase(TestCase):
+    """ Test cases for API serialization. """
+
+    def setUp(self):
+        """ Set up for serialization tests. """
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u1.messages.append(Message(text="one"))
+        u1.messages.append(Message(text="two"))
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+        reset_caches()
+
+
+    def tearDown(self):
+        """ Tear down for serialization tests. """
+
+        db.session.rollback()
+        app.config['JSON_BACKEND'] = 'orjson'
+
+
+    def test_rows_match_models(self):
+        """ Test rows serialize as their Message/User would. """
+
+        messages = Message.query.order_by(Message.id).all()
+        rows = message_data(db.session.execute(
+            select(*MESSAGE_COLUMNS).order_by(Message.id)))
+
+        self.assertEqual(serialize_messages(rows),
+                         [msg.serialize() for msg in messages])
+        self.assertEqual(serialize_message(rows[0]), messages[0].serialize())
+
+        user = User.query.get(self.u1_id)
+        self.assertEqual(serialize_user(user), user.serialize())
+
+
+    def test_json_backends(self):
+        """ Test both JSON backends encode as Flask's jsonify does. """
+
+        data = {'messages': serialize_messages(Message.query.all())}
+
+        with app.test_request_context():
+            expected = json.loads(app.json.dumps(data))
+
+        self.assertEqual(json.loads(dumps_json(data)), expected)
+        self.assertEqual(json.loads(dumps_json(data, 'json')), expected)
+
+        for value in (datetime(2023, 1, 9, 7, 5, 3, 999999),
+                      datetime(1999, 12, 31, 23, 59, 59,
+                               tzinfo=timezone(timedelta(hours=-5)))):
+            self.assertEqual(format_http_date(value), http_date(value))
+
+
+    def test_negotiate(self):
+        """ Test MessagePack is only sent to clients that prefer it. """
+
+        self.assertEqual(negotiate(None), 'application/json')
+        self.assertEqual(negotiate('*/*'), 'application/json')
+        self.assertEqual(negotiate('application/msgpack'),
+                         'application/msgpack')
+        self.assertEqual(
+            negotiate('application/json, application/msgpack;q=0.5'),
+            'application/json')
+
+
+    def test_msgpack_api(self):
+        """ Test the message list APIs answer in MessagePack when asked. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/api/users/{self.u1_id}/messages',
+                         headers={'Accept': 'application/msgpack'})
+            data = msgpack.unpackb(resp.data, timestamp=3)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'application/msgpack')
+            self.assertIn('Accept', resp.headers['Vary'])
+            self.assertEqual([msg['text'] for msg in data['messages']],
+                             ['two', 'one'])
+            self.assertEqual(data['messages'][0]['timestamp'].replace(
+                tzinfo=None), Message.query.filter_by(text='two').one()
+                .timestamp)
+
+            resp = c.get(f'/api/users/{self.u1_id}/messages')
+            self.assertEqual(resp.content_type, 'application/json')
+            self.assertEqual(len(resp.json['messages']), 2)
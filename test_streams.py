@@ -0,0 +1,250 @@
+"""Live timeline update (server-sent events) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_streams.py
+
+
+import asyncio
+import os
+import time
+from threading import Event, Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from starlette.testclient import TestClient
+
+from models import db, User, Message, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from asgi import app as asgi_app
+from streams import (Broker, PostgresTransport, Subscription, broker,
+                     format_event, publish)
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def session_cookie(user_id):
+    """ A Flask session cookie value signing in `user_id`. """
+
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+def post_message(user_id, text):
+    with app.test_client() as c:
+        with c.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = user_id
+
+        c.post('/messages/new', data={'text': text})
+
+
+class StreamsTestCase(TestCase):
+    """ Test cases for streams.py, and the stream in asgi.py. """
+
+    def setUp(self):
+        """ Set up for stream tests: u1 follows u2; streams are on. """
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        reset_caches()
+
+        with app.test_client() as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+        self.config = {key: app.config[key] for key in (
+            'STREAM_TRANSPORT', 'STREAM_HEARTBEAT', 'STREAM_TIMEOUT')}
+        app.config['STREAM_TRANSPORT'] = 'local'
+
+
+    def tearDown(self):
+        """ Tear down for stream tests. """
+
+        db.session.rollback()
+        app.config.update(self.config)
+
+
+    def test_broker(self):
+        """ Test events reach the streams of their author's followers, within
+        the buffer limit. """
+
+        test_broker = Broker()
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            subscription = Subscription(1, [2], 2, loop)
+            test_broker.subscribe(subscription)
+
+            message = {'type': 'message', 'id': 10, 'user_id': 2, 'body': ''}
+            thread = Thread(target=test_broker.dispatch, args=(message,))
+            thread.start()
+            thread.join()
+
+            self.assertEqual(await subscription.get(1), [message])
+
+            # not following 3 yet
+            test_broker.dispatch({**message, 'user_id': 3})
+            self.assertEqual(await subscription.get(0.05), [])
+
+            test_broker.dispatch({'type': 'follow', 'user_id': 1,
+                                  'author_id': 3, 'following': True})
+            test_broker.dispatch({**message, 'user_id': 3})
+            self.assertEqual(len(await subscription.get(1)), 1)
+
+            for _ in range(3):
+                test_broker.dispatch(message)
+            self.assertEqual(len(await subscription.get(1)), 2)
+            self.assertTrue(subscription.missed)
+
+            test_broker.unsubscribe(subscription)
+            self.assertEqual(test_broker.stats(), {
+                'streams': 0, 'dispatched': 6, 'delivered': 5})
+
+        asyncio.run(run())
+
+
+    def test_local_transport(self):
+        """ Test events are delivered when their transaction commits. """
+
+        with patch.object(broker, 'dispatch') as dispatch:
+            post_message(self.u2_id, 'hello')
+
+            msg = Message.query.filter_by(text='hello').one()
+            event = dispatch.call_args.args[0]
+
+            self.assertEqual(event['type'], 'message')
+            self.assertEqual(event['id'], msg.id)
+            self.assertIn('hello', event['body'])
+
+            dispatch.reset_mock()
+            publish({'type': 'delete', 'id': msg.id, 'user_id': msg.user_id})
+            db.session.rollback()
+            db.session.commit()
+
+            dispatch.assert_not_called()
+
+
+    def test_postgres_transport(self):
+        """ Test events go through NOTIFY to a listening transport. """
+
+        transport = PostgresTransport(app.config['SQLALCHEMY_DATABASE_URI'])
+        received = []
+        done = Event()
+
+        class Receiver:
+            def dispatch(self, event):
+                received.append(event)
+                done.set()
+
+        transport.start(Receiver())
+        self.addCleanup(transport.stop)
+
+        event = {'type': 'delete', 'id': 1, 'user_id': self.u2_id}
+
+        # keep sending until the listener has started listening
+        for _ in range(50):
+            transport.publish(db.session, event)
+            db.session.commit()
+
+            if done.wait(0.1):
+                break
+
+        self.assertEqual(received[0], event)
+
+
+    def test_format_event(self):
+        """ Test messages are sent as list items, starred unless one's own. """
+
+        event = {'type': 'message', 'id': 7, 'user_id': 2, 'body': '<p>hi</p>'}
+
+        text = format_event(event, 1)
+        self.assertTrue(text.startswith('id: 7\nevent: message\ndata: '))
+        self.assertIn('<li class=\\"list-group-item\\" id=\\"7\\"><p>hi</p>',
+                      text)
+        self.assertIn('messages-like', text)
+
+        self.assertNotIn('messages-like', format_event(event, 2))
+
+
+    def test_stream(self):
+        """ Test the stream sends a followed user's new message. """
+
+        app.config['STREAM_HEARTBEAT'] = 0.2
+        app.config['STREAM_TIMEOUT'] = 1
+
+        def post_when_subscribed():
+            deadline = time.monotonic() + 5
+
+            while (broker.stats()['streams'] == 0
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+
+            post_message(self.u2_id, 'live')
+
+        poster = Thread(target=post_when_subscribed)
+
+        with TestClient(asgi_app) as client:
+            resp = client.get('/api/stream/timeline')
+            self.assertEqual(resp.status_code, 401)
+
+            client.cookies.set(
+                app.config['SESSION_COOKIE_NAME'], session_cookie(self.u1_id))
+
+            poster.start()
+            resp = client.get('/api/stream/timeline')
+            poster.join()
+
+            msg_id = Message.query.filter_by(text='live').one().id
+
+            self.assertEqual(resp.headers['content-type'],
+                             'text/event-stream; charset=utf-8')
+            self.assertTrue(resp.text.startswith('retry: '))
+            self.assertIn(f'id: {msg_id}\nevent: message\n', resp.text)
+            self.assertIn(': heartbeat', resp.text)
+            self.assertEqual(broker.stats()['streams'], 0)
+
+            # reconnecting after missing it
+            resp = client.get('/api/stream/timeline',
+                              headers={'Last-Event-ID': str(msg_id - 1)})
+            self.assertIn('event: reset', resp.text)
+
+            app.config['STREAM_TRANSPORT'] = ''
+            resp = client.get('/api/stream/timeline')
+            self.assertEqual(resp.status_code, 404)
+
+
+    def test_homepage_stream(self):
+        """ Test the homepage opens the stream when streams are on. """
+
+        with app.test_client() as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/')
+            self.assertIn('data-stream="/api/stream/timeline"', resp.text)
+
+            app.config['STREAM_TRANSPORT'] = ''
+            resp = c.get('/')
+            self.assertNotIn('data-stream', resp.text)
@@ -0,0 +1,207 @@
+"""Timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, TimelineEntry, connect_db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from timeline import (get_timeline, backfill_timelines, refresh_fanout_mode,
+                      trim_timelines)
+import timeline
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """ Test cases for the precomputed home timelines. """
+
+    def setUp(self):
+        """ Set up for timeline tests. """
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+
+        db.session.commit()
+
+        self.u1 = u1
+        self.u2 = u2
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+        reset_caches()
+
+
+    def tearDown(self):
+        """ Tear down for timeline tests. """
+
+        db.session.rollback()
+        app.config.pop('TIMELINE_FANOUT_LIMIT', None)
+
+
+    def timeline_message_ids(self, user_id):
+        """ Message ids stored on the timeline of `user_id`. """
+
+        return {
+            entry.message_id
+            for entry in TimelineEntry.query.filter_by(user_id=user_id)
+        }
+
+
+    def post_as(self, user_id, text):
+        """ Post a message through the add_message route. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = user_id
+
+            c.post('/messages/new', data={'text': text})
+
+        return Message.query.filter_by(text=text).one()
+
+
+    def follow(self, follower_id, followed_id):
+        """ Follow through the start_following route. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = follower_id
+
+            c.post(f'/users/follow/{followed_id}')
+
+
+    def test_post_fans_out_to_followers(self):
+        """ Posting adds the message to the author's and followers'
+        timelines. """
+
+        self.follow(self.u1_id, self.u2_id)
+        msg = self.post_as(self.u2_id, "fan out")
+
+        self.assertIn(msg.id, self.timeline_message_ids(self.u2_id))
+        self.assertIn(msg.id, self.timeline_message_ids(self.u1_id))
+
+
+    def test_follow_and_unfollow(self):
+        """ Following copies in old messages, unfollowing removes them. """
+
+        msg = self.post_as(self.u2_id, "before follow")
+        self.assertNotIn(msg.id, self.timeline_message_ids(self.u1_id))
+
+        self.follow(self.u1_id, self.u2_id)
+        self.assertIn(msg.id, self.timeline_message_ids(self.u1_id))
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+
+        self.assertNotIn(msg.id, self.timeline_message_ids(self.u1_id))
+
+
+    def test_delete_message_removes_entries(self):
+        """ Deleting a message removes it from every timeline. """
+
+        self.follow(self.u1_id, self.u2_id)
+        msg = self.post_as(self.u2_id, "soon gone")
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/messages/{msg_id}/delete')
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(message_id=msg_id).count(), 0)
+
+
+    def test_fanout_on_read(self):
+        """ Authors above the fan-out limit are merged in at read time. """
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+
+        self.follow(self.u1_id, self.u2_id)
+        msg = self.post_as(self.u2_id, "celebrity post")
+
+        self.assertTrue(User.query.get(self.u2_id).fanout_on_read)
+        self.assertNotIn(msg.id, self.timeline_message_ids(self.u1_id))
+
+        timeline = get_timeline(User.query.get(self.u1_id))
+        self.assertIn(msg.id, [m.id for m in timeline])
+
+
+    def test_backfill_timelines(self):
+        """ Backfill rebuilds timelines from messages and follows. """
+
+        self.u1.following.append(self.u2)
+        msg = Message(text="backfilled")
+        self.u2.messages.append(msg)
+        db.session.commit()
+
+        self.assertNotIn(msg.id, self.timeline_message_ids(self.u1_id))
+
+        backfill_timelines()
+        db.session.commit()
+
+        self.assertIn(msg.id, self.timeline_message_ids(self.u1_id))
+        self.assertIn(msg.id, self.timeline_message_ids(self.u2_id))
+
+
+    def test_fanout_hysteresis(self):
+        """ Authors only switch back to fan-out-on-write well below the
+        limit, and then get their recent messages copied to followers. """
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10
+
+        self.follow(self.u1_id, self.u2_id)
+        msgs = [self.post_as(self.u2_id, f"post {i}") for i in range(3)]
+
+        u2 = User.query.get(self.u2_id)
+        u2.fanout_on_read = True
+        db.session.query(TimelineEntry).filter_by(user_id=self.u1_id).delete()
+
+        # just under the limit: still fanned out on read
+        u2.followers_count = 10
+        refresh_fanout_mode(u2)
+        self.assertTrue(u2.fanout_on_read)
+
+        u2.followers_count = 8
+        with patch.object(timeline, 'FANOUT_SWITCH_BACKFILL_LIMIT', 2):
+            refresh_fanout_mode(u2)
+
+        self.assertFalse(u2.fanout_on_read)
+        self.assertEqual(self.timeline_message_ids(self.u1_id),
+                         {msgs[1].id, msgs[2].id})
+
+
+    def test_trim_timelines(self):
+        """ Trimming keeps the newest entries of each timeline. """
+
+        msgs = [self.post_as(self.u2_id, f"post {i}") for i in range(3)]
+
+        self.assertEqual(trim_timelines(keep=2), 1)
+        db.session.commit()
+
+        self.assertEqual(self.timeline_message_ids(self.u2_id),
+                         {msgs[1].id, msgs[2].id})
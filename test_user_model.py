@@ -9,6 +9,7 @@ import os
 from unittest import TestCase
 
 from models import db, User, Message, Follows, connect_db
+from counters import reconcile_counters
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -86,6 +87,18 @@ class UserModelTestCase(TestCase):
         self.assertFalse(self.u1.is_followed_by(self.u2))
 
 
+    def test_following_ids_among(self):
+        """ Tests the batch User.following_ids_among instance method. """
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual(
+            self.u1.following_ids_among([self.u2_id, u3.id]), {self.u2_id})
+        self.assertEqual(self.u2.following_ids_among([self.u1_id]), set())
+        self.assertEqual(self.u1.following_ids_among([]), set())
+
+
     def test_user_signup(self):
         """ Tests if the User.signup class method works. """
 
@@ -130,3 +143,38 @@ class UserModelTestCase(TestCase):
         self.assertFalse(User.authenticate(self.username, 'cupcake'))
         # Test incorrect username
         self.assertFalse(User.authenticate('fake', self.password))
+
+
+    def test_authenticate_rehashes(self):
+        """ Test authenticate upgrades a hash made at an old cost. """
+
+        old_hash = self.u1.password
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+        try:
+            user = User.authenticate(self.username, self.password)
+
+            self.assertNotEqual(user.password, old_hash)
+            self.assertTrue(user.password.startswith('$2b$04$'))
+            self.assertTrue(User.authenticate(self.username, self.password))
+
+            # already at the configured cost: left alone
+            new_hash = user.password
+            User.authenticate(self.username, self.password)
+            self.assertEqual(user.password, new_hash)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+
+    def test_reconcile_counters(self):
+        """ Test reconcile_counters repairs drifted counters. """
+
+        # setUp follows through the ORM, bypassing the counters
+        self.assertEqual(self.u1.following_count, 0)
+
+        self.assertEqual(reconcile_counters(), 2)
+        db.session.commit()
+
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        self.assertEqual(reconcile_counters(), 0)
@@ -11,6 +11,12 @@ from models import db, User, Message, Follows, connect_db, Like
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import app, CURR_USER_KEY, g
+from testing import reset_caches
+from current_user import current_user_cache
+from search import SEARCH_PAGE_SIZE, TYPEAHEAD_LIMIT
+from passwords import PasswordPool, PasswordPoolBusy, default_pool_size
+import passwords
+from threading import Event, Thread
 
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -44,6 +50,7 @@ class UserViewsTestCase(TestCase):
         self.u2_id = u2.id
 
         self.client = app.test_client()
+        reset_caches()
 
 
     def tearDown(self):
@@ -141,6 +148,97 @@ class UserViewsTestCase(TestCase):
             self.assertIn("Invalid credentials.", html)
 
 
+    def test_login_pool_busy(self):
+        """ Test logins fail fast with a 503 when the password pool is
+        full. """
+
+        started = Event()
+        release = Event()
+
+        def hold_worker():
+            started.set()
+            release.wait()
+
+        # one worker, no queue, and the worker kept busy
+        pool = PasswordPool(workers=1, queue_depth=0)
+        busy = Thread(target=pool.run, args=(hold_worker,))
+        old_pool = passwords._pool
+        passwords._pool = pool
+
+        try:
+            busy.start()
+            started.wait()
+
+            with self.client as c:
+                resp = c.post('/login', data={
+                    'username': self.username,
+                    'password': self.password
+                })
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            self.assertEqual(pool.stats()['rejected'], 1)
+        finally:
+            release.set()
+            busy.join()
+            pool.shutdown()
+            passwords._pool = old_pool
+
+
+    def test_pool_rejects_concurrent_overflow(self):
+        """ Test concurrent hashes past the pool's workers and queue are
+        rejected, while the rest complete. """
+
+        pool = PasswordPool(workers=2, queue_depth=1)
+        running = Event()
+        release = Event()
+        results = []
+
+        def hold_worker():
+            running.set()
+            release.wait()
+
+        def submit():
+            try:
+                pool.run(hold_worker)
+                results.append('done')
+            except PasswordPoolBusy:
+                results.append('busy')
+
+        threads = [Thread(target=submit) for _ in range(6)]
+
+        try:
+            for thread in threads:
+                thread.start()
+
+            running.wait()
+
+            # the three over capacity fail without waiting
+            for _ in range(100):
+                if results.count('busy') == 3:
+                    break
+                release.wait(0.01)
+
+            self.assertEqual(results, ['busy'] * 3)
+            self.assertEqual(pool.stats()['rejected'], 3)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+            pool.shutdown()
+
+        self.assertEqual(results.count('done'), 3)
+        self.assertEqual(pool.stats()['completed'], 3)
+
+
+    def test_default_pool_size(self):
+        """ Test the pool takes at most half of a process's threads. """
+
+        self.assertEqual(default_pool_size(1, cpus=4), (1, 0))
+        self.assertEqual(default_pool_size(8, cpus=4), (4, 0))
+        self.assertEqual(default_pool_size(32, cpus=4), (4, 12))
+
+
     def test_logout(self):
         """ Test route for logging out current user. """
 
@@ -167,6 +265,129 @@ class UserViewsTestCase(TestCase):
             self.assertIn("test user index", html)
 
 
+    def add_users(self, count):
+        """ Add `count` users named user00, user01, ... (no signup, so no
+        password hashing). """
+
+        db.session.add_all([
+            User(username=f"user{i:02}", email=f"user{i:02}@email.com",
+                 password="not-a-hash")
+            for i in range(count)
+        ])
+        db.session.commit()
+
+
+    def test_list_users_pages(self):
+        """ Test listing users without a query a page at a time. """
+
+        self.add_users(SEARCH_PAGE_SIZE)
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            resp = c.get('/users')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@u1<", html)
+            self.assertNotIn(f"@user{SEARCH_PAGE_SIZE - 1:02}", html)
+            self.assertIn('id="next-page"', html)
+
+            last_id = User.query.order_by(User.id).offset(
+                SEARCH_PAGE_SIZE - 1).first().id
+            resp = c.get(f'/users?after={last_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f"@user{SEARCH_PAGE_SIZE - 1:02}", html)
+            self.assertNotIn("@u1<", html)
+            self.assertNotIn('id="next-page"', html)
+
+
+    def test_search_users(self):
+        """ Test ranked search: username prefix matches first, then fuzzy
+        matches on bio and location. """
+
+        hiker = User.signup("hiker", "hiker@email.com", "password", None)
+        hiker.bio = "Loves the mountains"
+        climber = User.signup("climber", "climber@email.com", "password",
+                              None)
+        climber.location = "Mountain View"
+        mountaineer = User.signup("mountaineer", "m@email.com", "password",
+                                  None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            resp = c.get('/users?q=Mountain')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@hiker", html)
+            self.assertIn("@climber", html)
+            self.assertLess(html.index("@mountaineer"), html.index("@hiker"))
+            self.assertNotIn("@u1", html)
+
+            resp = c.get('/users?q=nobody-by-that-name')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Sorry, no users found", html)
+
+            # LIKE wildcards in the query are taken literally
+            resp = c.get('/users?q=%25')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Sorry, no users found", html)
+
+
+    def test_search_users_pages(self):
+        """ Test paging through search results. """
+
+        self.add_users(SEARCH_PAGE_SIZE + 1)
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            resp = c.get('/users?q=user')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@user00", html)
+            self.assertNotIn(f"@user{SEARCH_PAGE_SIZE:02}", html)
+            self.assertIn("/users?q=user&page=2", html)
+
+            resp = c.get('/users?q=user&page=2')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f"@user{SEARCH_PAGE_SIZE:02}", html)
+            self.assertNotIn("@user00", html)
+            self.assertNotIn('id="next-page"', html)
+
+
+    def test_search_users_api(self):
+        """ Test the typeahead endpoint is capped at TYPEAHEAD_LIMIT. """
+
+        self.add_users(TYPEAHEAD_LIMIT + 2)
+
+        with self.client as c:
+            resp = c.get('/api/users/search?q=user')
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            resp = c.get('/api/users/search?q=user&limit=3')
+            users = resp.json['users']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([user['username'] for user in users],
+                             ["user00", "user01", "user02"])
+
+            resp = c.get('/api/users/search?q=user&limit=1000')
+            self.assertEqual(len(resp.json['users']), TYPEAHEAD_LIMIT)
+
+
     def test_show_user(self):
         """ Test route for lising of users. """
 
@@ -240,6 +461,24 @@ class UserViewsTestCase(TestCase):
             self.assertIn("u2", html)
 
 
+    def test_follow_counters(self):
+        """ Test following/unfollowing keeps the follow counters right. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+            self.assertEqual(User.query.get(self.id).following_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+
+            self.assertEqual(User.query.get(self.id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+
     def test_stop_following(self):
         """ Test route to stop following other users. """
 
@@ -290,6 +529,37 @@ class UserViewsTestCase(TestCase):
             # another opportunity to test more specific edits
 
 
+    def test_current_user_cache(self):
+        """ Test the logged-in user is cached between requests, and that
+        editing the profile refreshes it. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            c.get('/')
+            hits = current_user_cache.hits
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(current_user_cache.hits, hits + 1)
+            self.assertIn("@u1<", html)
+
+            data = {
+                'username': 'renamed',
+                'email': 'u1@email.com',
+                'password': self.password
+            }
+            c.post('/users/profile', data=data)
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@renamed<", html)
+            self.assertNotIn("@u1<", html)
+
+
     def test_delete_user(self):
         """ Test route to delete user. """
 
@@ -304,6 +574,40 @@ class UserViewsTestCase(TestCase):
             self.assertIn("test signup page", html)
 
 
+    def test_deleted_elsewhere(self):
+        """ Test a user deleted behind their cached snapshot (e.g. on another
+        worker) is logged out, rather than breaking pages. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            c.get(f'/users/{self.id}')
+            self.assertIsNotNone(current_user_cache.get(self.id))
+
+            User.query.filter_by(id=self.id).delete()
+            db.session.commit()
+            db.session.expunge_all()
+
+            resp = c.post('/messages/new', data={'text': 'ghost'})
+            self.assertEqual(resp.status_code, 302)
+            self.assertNotIn(CURR_USER_KEY, session)
+            self.assertIsNone(current_user_cache.get(self.id))
+
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+            current_user_cache.set(
+                self.id, (self.id, 'u1', 'u1@email.com', None, None, None,
+                          None))
+
+            resp = c.get('/')
+            self.assertEqual(resp.status_code, 302)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+            resp = c.get('/')
+            self.assertEqual(resp.status_code, 200)
+
+
     def test_homepage(self):
         """ Test route to show homepage. """
 
@@ -318,4 +622,127 @@ class UserViewsTestCase(TestCase):
             self.assertIn("test homepage", html)
 
 
+    def test_homepage_not_modified(self):
+        """ Test an unchanged homepage gets a 304, and a changed one
+        doesn't. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            resp = c.get('/')
+            etag = resp.headers['ETag']
+
+            self.assertTrue(etag.startswith('W/'))
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            c.post('/messages/new', data={'text': 'something new'})
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("something new", html)
+
+
+    def test_homepage_not_modified_older_changes(self):
+        """ Test the homepage's ETag changes when a followed user deletes a
+        message that isn't their newest, or changes their avatar. """
+
+        def post_as(user_id, path, data=None):
+            with app.test_client() as other:
+                with other.session_transaction() as change_session:
+                    change_session[CURR_USER_KEY] = user_id
+
+                other.post(path, data=data)
+
+        post_as(self.id, f'/users/follow/{self.u2_id}')
+        post_as(self.u2_id, '/messages/new', {'text': 'first warble'})
+        post_as(self.u2_id, '/messages/new', {'text': 'second warble'})
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            etag = c.get('/').headers['ETag']
+            resp = c.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            older = Message.query.filter_by(text='first warble').one()
+            post_as(self.u2_id, f'/messages/{older.id}/delete')
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("first warble", resp.text)
+
+            etag = resp.headers['ETag']
+            User.query.filter_by(id=self.u2_id).update(
+                {'image_url': '/static/images/new-avatar.png'})
+            db.session.commit()
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("new-avatar.png", resp.text)
+
+
+    def test_profile_not_modified(self):
+        """ Test profile pages get a 304 until the profile changes, and
+        pages showing flashes are never cached. """
+
+        with self.client as c:
+            with c.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = self.id
+
+            resp = c.get(f'/users/{self.u2_id}')
+            etag = resp.headers['ETag']
+
+            resp = c.get(f'/users/{self.u2_id}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # following u2 changes their follower count, and flashes nothing
+            c.post(f'/users/follow/{self.u2_id}')
+
+            resp = c.get(f'/users/{self.u2_id}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+            with c.session_transaction() as change_session:
+                change_session['_flashes'] = [('success', 'Hi!')]
+
+            resp = c.get(f'/users/{self.u2_id}',
+                         headers={'If-None-Match': resp.headers['ETag']})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('ETag', resp.headers)
+            self.assertIn("Hi!", resp.get_data(as_text=True))
+
+
+    def test_static_caching(self):
+        """ Test fingerprinted static files are cached for good, and other
+        responses are not stored. """
+
+        with self.client as c:
+            html = c.get('/login').get_data(as_text=True)
+
+            self.assertIn('/static/app.js?v=', html)
+
+            url = html.split('src="')[-1].split('"')[0]
+            resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+
+            resp = c.get('/static/app.js')
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+            resp = c.get('/login')
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+
     # test app.before_request & app.after_request routes?
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""Helpers shared by the test modules."""
+
+from current_user import current_user_cache
+from follow_graph import follow_graph
+from fragments import fragment_cache
+from search import search_cache
+
+
+def reset_caches():
+    """ Empty this process's caches, so each test starts from the database
+    (call from setUp). """
+
+    current_user_cache.clear()
+    follow_graph.clear()
+    fragment_cache.clear()
+    search_cache.clear()
@@ -0,0 +1,305 @@
+"""Precomputed home timelines for Warbler (fan-out-on-write).
+
+When a message is posted it is copied into the `timelines` table for its
+author and for every follower, so the homepage reads one pre-sorted slice
+instead of filtering `messages` by everyone the user follows.
+
+Authors with more than TIMELINE_FANOUT_LIMIT followers are switched to
+fan-out-on-read: their messages are not copied to followers, and are merged
+into the timeline when it is read instead. They only switch back once they
+drop FANOUT_HYSTERESIS below the limit, so a few follows and unfollows
+around it don't flip them back and forth.
+
+Timelines keep the TIMELINE_MAX_ENTRIES newest entries per user; older ones
+are deleted by `flask trim-timelines` (run it periodically, e.g. from cron).
+"""
+
+from flask import current_app
+from sqlalchemy import (delete, exists, func, literal, or_, select, true,
+                        tuple_, update, union_all)
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import apply_keyset, message_key
+
+DEFAULT_FANOUT_LIMIT = 10000
+TIMELINE_LENGTH = 100
+
+# how many of an author's messages get copied in when someone follows them
+FOLLOW_BACKFILL_LIMIT = 800
+
+# how many of an author's messages get copied to each follower when they
+# switch back to fan-out-on-write (in the follow request: keep it small)
+FANOUT_SWITCH_BACKFILL_LIMIT = 50
+
+# fan-out-on-read authors switch back below (1 - this) x the limit
+FANOUT_HYSTERESIS = 0.1
+
+# entries kept per timeline by trim_timelines
+TIMELINE_MAX_ENTRIES = 1000
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+
+def get_fanout_limit():
+    """ Follower count above which an author is fanned out on read. """
+
+    return current_app.config.get(
+        'TIMELINE_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+
+
+def _insert_entries(rows):
+    """ Insert (user_id, message_id, timestamp) rows from a select,
+    skipping entries that are already on the timeline. """
+
+    db.session.execute(
+        insert(TimelineEntry)
+        .from_select(TIMELINE_COLUMNS, rows)
+        .on_conflict_do_nothing())
+
+
+def fan_out_message(msg):
+    """ Add a newly posted `msg` to its author's timeline and, unless the
+    author is fanned out on read, to the timeline of every follower.
+
+    Call after the message has been flushed (it needs an id).
+    """
+
+    rows = select(
+        literal(msg.user_id), literal(msg.id), literal(msg.timestamp))
+
+    if not msg.user.fanout_on_read:
+        to_followers = (
+            select(
+                Follows.user_following_id,
+                literal(msg.id),
+                literal(msg.timestamp))
+            .where(Follows.user_being_followed_id == msg.user_id))
+        rows = union_all(rows, to_followers)
+
+    _insert_entries(rows)
+
+
+def add_followed_messages(follower_id, followed_user):
+    """ Copy the most recent messages of `followed_user` into the timeline
+    of `follower_id` after a new follow. """
+
+    if followed_user.fanout_on_read:
+        return
+
+    recent = (
+        select(literal(follower_id), Message.id, Message.timestamp)
+        .where(Message.user_id == followed_user.id)
+        .order_by(Message.timestamp.desc())
+        .limit(FOLLOW_BACKFILL_LIMIT))
+
+    _insert_entries(recent)
+
+
+def remove_followed_messages(follower_id, followed_id):
+    """ Drop messages by `followed_id` from the timeline of `follower_id`
+    after an unfollow. """
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == follower_id)
+        .where(TimelineEntry.message_id.in_(
+            select(Message.id).where(Message.user_id == followed_id)))
+        .execution_options(synchronize_session=False))
+
+
+def refresh_fanout_mode(user):
+    """ Switch `user` between fan-out-on-write and fan-out-on-read after
+    their follower count changed.
+
+    When an author drops back to fan-out-on-write, their most recent
+    FANOUT_SWITCH_BACKFILL_LIMIT messages are copied to their followers'
+    timelines, since they were only being merged in at read time until now.
+    """
+
+    limit = get_fanout_limit()
+
+    if user.fanout_on_read:
+        on_read = user.followers_count >= limit * (1 - FANOUT_HYSTERESIS)
+    else:
+        on_read = user.followers_count > limit
+
+    if on_read == user.fanout_on_read:
+        return
+
+    user.fanout_on_read = on_read
+
+    if not on_read:
+        recent = (
+            select(Message.id, Message.timestamp)
+            .where(Message.user_id == user.id)
+            .order_by(Message.timestamp.desc())
+            .limit(FANOUT_SWITCH_BACKFILL_LIMIT)
+            .subquery())
+
+        _insert_entries(
+            select(Follows.user_following_id, recent.c.id, recent.c.timestamp)
+            .join(recent, true())
+            .where(Follows.user_being_followed_id == user.id))
+
+
+def trim_timelines(keep=TIMELINE_MAX_ENTRIES):
+    """ Delete all but the `keep` newest entries of every timeline. Returns
+    the number of entries deleted. """
+
+    rank = func.row_number().over(
+        partition_by=TimelineEntry.user_id,
+        order_by=(TimelineEntry.timestamp.desc(),
+                  TimelineEntry.message_id.desc()))
+
+    ranked = select(
+        TimelineEntry.user_id,
+        TimelineEntry.message_id,
+        rank.label('rank')).subquery()
+
+    result = db.session.execute(
+        delete(TimelineEntry)
+        .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id).in_(
+            select(ranked.c.user_id, ranked.c.message_id)
+            .where(ranked.c.rank > keep)))
+        .execution_options(synchronize_session=False))
+
+    return result.rowcount
+
+
+def fanout_on_read_authors_query(user_id):
+    """ Select of the ids of users followed by `user_id` whose messages are
+    not fanned out to follower timelines. """
+
+    return (
+        select(User.id)
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .where(Follows.user_following_id == user_id)
+        .where(User.fanout_on_read))
+
+
+def get_fanout_on_read_author_ids(user_id):
+    """ Ids of users followed by `user_id` whose messages are not fanned
+    out to follower timelines. """
+
+    return db.session.scalars(fanout_on_read_authors_query(user_id)).all()
+
+
+def timeline_query(user_id, limit=TIMELINE_LENGTH, before=None,
+                   columns=(Message,)):
+    """ Select of the `limit` most recent messages on `user_id`'s
+    precomputed timeline (before the `before` key, if given); of just
+    `columns` of them, if given. """
+
+    return (apply_keyset(
+                select(*columns)
+                .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                .where(TimelineEntry.user_id == user_id),
+                TimelineEntry.timestamp,
+                TimelineEntry.message_id,
+                before)
+            .limit(limit))
+
+
+def pulled_messages_query(author_ids, limit=TIMELINE_LENGTH, before=None,
+                          columns=(Message,)):
+    """ Select of the `limit` most recent messages by fanned-out-on-read
+    `author_ids` (before the `before` key, if given). """
+
+    return (apply_keyset(
+                select(*columns).where(Message.user_id.in_(author_ids)),
+                Message.timestamp,
+                Message.id,
+                before)
+            .limit(limit))
+
+
+def newer_messages_query(user_id, after_id):
+    """ Select of whether `user_id`'s timeline has any message with an id
+    above `after_id` (ids only grow, so: posted since). """
+
+    return select(or_(
+        exists().where(TimelineEntry.user_id == user_id,
+                       TimelineEntry.message_id > after_id),
+        exists().where(
+            Message.user_id.in_(fanout_on_read_authors_query(user_id)),
+            Message.id > after_id)))
+
+
+def merge_timeline(messages, pulled, limit=TIMELINE_LENGTH):
+    """ The `limit` most recent of a timeline's `messages` and its `pulled`
+    ones, newest first. """
+
+    merged = {msg.id: msg for msg in messages + pulled}
+
+    return sorted(merged.values(), key=message_key, reverse=True)[:limit]
+
+
+def get_timeline(user, limit=TIMELINE_LENGTH, before=None, columns=None):
+    """ Return the `limit` most recent messages for the home timeline of
+    `user`, newest first.
+
+    `before` is an optional (timestamp, id) key to page from (see
+    pagination.py). Authors are loaded along with the messages. With
+    `columns` (which must include Message.id and Message.timestamp), returns
+    rows of those instead.
+    """
+
+    if columns is None:
+        def load(query):
+            return db.session.scalars(
+                query.options(joinedload(Message.user))).all()
+
+        columns = (Message,)
+    else:
+        def load(query):
+            return db.session.execute(query).all()
+
+    messages = load(timeline_query(user.id, limit, before, columns))
+
+    pulled_author_ids = get_fanout_on_read_author_ids(user.id)
+
+    if pulled_author_ids:
+        pulled = load(
+            pulled_messages_query(pulled_author_ids, limit, before, columns))
+
+        messages = merge_timeline(messages, pulled, limit)
+
+    return messages
+
+
+def backfill_timelines():
+    """ Rebuild every timeline from `messages` and `follows`.
+
+    Recomputes each user's fan-out mode first, and trims the timelines to
+    TIMELINE_MAX_ENTRIES after. Returns the number of timeline entries
+    written.
+    """
+
+    follower_counts = (
+        select(func.count())
+        .select_from(Follows)
+        .where(Follows.user_being_followed_id == User.id)
+        .scalar_subquery())
+
+    db.session.execute(
+        update(User).values(
+            fanout_on_read=follower_counts > get_fanout_limit())
+        .execution_options(synchronize_session=False))
+
+    db.session.execute(delete(TimelineEntry))
+
+    own = select(Message.user_id, Message.id, Message.timestamp)
+
+    to_followers = (
+        select(Follows.user_following_id, Message.id, Message.timestamp)
+        .join(Message, Message.user_id == Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .where(User.fanout_on_read.is_(False)))
+
+    _insert_entries(union_all(own, to_followers))
+    trim_timelines()
+
+    return db.session.scalar(
+        select(func.count()).select_from(TimelineEntry))